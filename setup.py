@@ -8,11 +8,18 @@ setup(
         'Click',
         'numpy',
         'pandas',
+        'scipy',
         'tables'
     ],
+    extras_require={
+        'uproot': ['uproot>=5', 'awkward>=2']
+    },
     entry_points='''
         [console_scripts]
         extractImgFromVEGAS_St2=vimgextractor.script.convert:cli 
+        extractImgFromVEGAS_St2_batch=vimgextractor.script.batch:cli
+        extractImgBenchmark=vimgextractor.script.benchmark:cli
+        extractImgValidateUproot=vimgextractor.script.validate:cli
     ''',
     include_package_data=True
     
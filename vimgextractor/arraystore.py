@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""
+Module for the NPY array-store output format.
+
+An array store is a directory holding the same logical tables as the HDF5
+output (Event_Info, the image tables, Array_Info, Telescope_Info and the
+pixel arrays of sparse image tables). Every table is a sequence of
+fixed-dtype .npy shards of about SHARD_BYTES of appended rows, which can be
+opened with np.load(mmap_mode='r') without copying:
+
+    store/
+        manifest.json
+        Event_Info/Event_Info.000000.npy
+        VTS/VTS.000000.npy
+        VTS_pixels/index/index.000000.npy   (sparse mode)
+        ...
+
+The manifest lists, for every table, its dtype, title, attributes and
+shards (file and number of rows), plus the attributes of the store. It is
+written last (atomically) when the store is closed, so shards that are not
+in the manifest are ignored and a crashed writer leaves the previous
+content readable.
+
+ArrayStore implements the subset of the tables.File interface used by the
+converter (create_table, create_group, create_earray, get_node, root
+attribute access, Table.row/append/read/read_coordinates/modify_coordinates/
+get_where_list/read_where/flush, attrs), so that the same code writes both formats. Each writer
+process writes its own store, without locks; stores are merged like HDF5
+shards.
+"""
+
+import json
+import os
+import re
+import shutil
+
+import numexpr
+import numpy as np
+import tables
+
+MANIFEST = 'manifest.json'
+FORMAT_NAME = 'vimgextractor-npy'
+FORMAT_VERSION = 1
+
+OUTPUT_FORMATS = ['hdf5', 'npy']
+
+# extension of the shard files written for each output format
+SHARD_EXTENSIONS = {'hdf5': '.h5', 'npy': '.npystore'}
+
+# size (bytes) of the pending rows written as one .npy shard by Table.flush
+SHARD_BYTES = 32 * 2 ** 20
+
+
+def _to_dtype(description):
+    """numpy dtype of a table description (IsDescription class, dict of Cols or dtype)."""
+    if isinstance(description, np.dtype):
+        return description
+    if isinstance(description, type) and issubclass(description, tables.IsDescription):
+        description = description.columns
+    return tables.Description(description)._v_dtype
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+class AttributeSet:
+    """User attributes of a node, stored in the manifest."""
+
+    def __init__(self, values=None):
+        self.__dict__['_values'] = dict(values or {})
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._values[name] = _to_json(value)
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __setitem__(self, name, value):
+        self._values[name] = _to_json(value)
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def _f_list(self, attrset='user'):
+        return sorted(self._values)
+
+    def _f_copy(self, where):
+        for name, value in self._values.items():
+            where._v_attrs[name] = value
+
+
+class Node:
+
+    def __init__(self, store, path, title=''):
+        self._store = store
+        self._v_pathname = path
+        self._v_name = path.rsplit('/', 1)[-1]
+        self._v_title = title
+        self._v_attrs = AttributeSet()
+
+    @property
+    def attrs(self):
+        return self._v_attrs
+
+    @property
+    def name(self):
+        return self._v_name
+
+    @property
+    def _v_parent(self):
+        return self._store.get_node(self._v_pathname.rsplit('/', 1)[0] or '/')
+
+
+class Row:
+    """Row buffer of a Table, like tables.tableextension.Row."""
+
+    def __init__(self, table):
+        self._table = table
+        self._record = np.zeros(1, dtype=table.dtype)[0]
+
+    def __getitem__(self, name):
+        return self._record[name]
+
+    def __setitem__(self, name, value):
+        self._record[name] = value
+
+    def append(self):
+        self._table._add_pending(np.array([self._record], dtype=self._table.dtype))
+        self._record = np.zeros(1, dtype=self._table.dtype)[0]
+
+
+class Table(Node):
+    """Table (or 1-D array) stored as a sequence of .npy shards.
+
+    Appended rows are kept in memory and written as one new shard by
+    flush() once they reach SHARD_BYTES, so that tables written in small
+    blocks do not end up as many small files. The remaining rows are written
+    when the store is flushed or closed, or before the table is read.
+    """
+
+    def __init__(self, store, path, dtype, title='', shards=None):
+        Node.__init__(self, store, path, title)
+        self.dtype = np.dtype(dtype)
+        self.shards = list(shards or [])
+        self._pending = []
+        self._pending_bytes = 0
+        self._cache = {}
+        self._row = None
+
+    @property
+    def colnames(self):
+        return list(self.dtype.names or [])
+
+    @property
+    def nrows(self):
+        return sum(n for _, n in self.shards) + sum(len(rows) for rows in self._pending)
+
+    def __len__(self):
+        return self.nrows
+
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = Row(self)
+        return self._row
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if rows.ndim == 0:
+            rows = rows.reshape(1)
+        if len(rows) > 0:
+            self._add_pending(rows.copy())
+
+    def _add_pending(self, rows):
+        self._pending.append(rows)
+        self._pending_bytes += rows.nbytes
+
+    def flush(self):
+        """Write the pending rows as a new shard if they reach SHARD_BYTES."""
+        if self._pending_bytes >= SHARD_BYTES:
+            self.write_pending()
+
+    def write_pending(self):
+        """Write the pending rows as a new shard, whatever their size."""
+        if not self._pending:
+            return
+        rows = np.concatenate(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        directory = self._store._node_dir(self._v_pathname)
+        os.makedirs(directory, exist_ok=True)
+        name = '{}.{:06d}.npy'.format(self._v_name, len(self.shards))
+        np.save(os.path.join(directory, name), rows)
+        self.shards.append((name, len(rows)))
+
+    def shard_arrays(self, mmap_mode='r'):
+        """
+        :return: list of the (memory-mapped) arrays of the shards, pending
+                 rows being written first
+        """
+        self.write_pending()
+        directory = self._store._node_dir(self._v_pathname)
+        out = []
+        for name, _ in self.shards:
+            if name not in self._cache:
+                self._cache[name] = np.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+            out.append(self._cache[name])
+        return out
+
+    def read(self, start=None, stop=None, field=None):
+        """Rows [start, stop) (as a copy)."""
+        self.write_pending()
+        nrows = sum(n for _, n in self.shards)
+        start, stop, _ = slice(start, stop).indices(nrows)
+        parts = []
+        offset = 0
+        for array, (_, n) in zip(self.shard_arrays(), self.shards):
+            lo, hi = max(start - offset, 0), min(stop - offset, n)
+            if lo < hi:
+                parts.append(array[lo:hi])
+            offset += n
+        out = np.concatenate(parts) if parts else np.zeros(0, dtype=self.dtype)
+        return out[field] if field is not None else out
+
+    def read_coordinates(self, coords, field=None):
+        """Rows at the given (sorted or not) row numbers."""
+        self.write_pending()
+        coords = np.asarray(coords, dtype=np.int64)
+        bounds = np.cumsum([0] + [n for _, n in self.shards])
+        out = np.zeros(len(coords), dtype=self.dtype)
+        shard = np.searchsorted(bounds, coords, side='right') - 1
+        for k, array in enumerate(self.shard_arrays()):
+            sel = np.flatnonzero(shard == k)
+            if len(sel):
+                out[sel] = array[coords[sel] - bounds[k]]
+        return out[field] if field is not None else out
+
+    def modify_coordinates(self, coords, rows):
+        """
+        Overwrite the rows at the given row numbers. Pending rows are written
+        first; every shard holding modified rows is rewritten and replaced
+        atomically.
+        """
+        self.write_pending()
+        coords = np.asarray(coords, dtype=np.int64)
+        rows = np.asarray(rows, dtype=self.dtype)
+        bounds = np.cumsum([0] + [n for _, n in self.shards])
+        shard = np.searchsorted(bounds, coords, side='right') - 1
+        directory = self._store._node_dir(self._v_pathname)
+        for k in np.unique(shard):
+            name = self.shards[k][0]
+            sel = np.flatnonzero(shard == k)
+            array = np.load(os.path.join(directory, name))
+            array[coords[sel] - bounds[k]] = rows[sel]
+            tmp = os.path.join(directory, name + '.tmp.npy')
+            np.save(tmp, array)
+            os.replace(tmp, os.path.join(directory, name))
+            self._cache.pop(name, None)
+        return len(coords)
+
+    def get_where_list(self, condition, condvars=None, sort=False):
+        """
+        Row numbers of the rows satisfying a numexpr condition on the
+        columns (as tables.Table.get_where_list, always sorted), evaluated
+        shard by shard.
+        """
+        self.write_pending()
+        names = [name for name in set(re.findall(r'[A-Za-z_]\w*', condition)) if name in self.colnames]
+        parts = []
+        offset = 0
+        for array, (_, n) in zip(self.shard_arrays(), self.shards):
+            variables = dict(condvars or {})
+            for name in names:
+                column = array[name]
+                # numexpr has no unsigned or small integer types
+                if column.dtype.kind == 'u' or (column.dtype.kind == 'i' and column.dtype.itemsize < 4):
+                    column = column.astype(np.int64)
+                variables[name] = column
+            mask = numexpr.evaluate(condition, local_dict=variables, global_dict={})
+            parts.append(np.flatnonzero(np.broadcast_to(mask, (n,))) + offset)
+            offset += n
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def read_where(self, condition, condvars=None, field=None):
+        """Rows satisfying a numexpr condition on the columns."""
+        return self.read_coordinates(self.get_where_list(condition, condvars), field=field)
+
+    def _f_copy(self, newparent, start=None, stop=None, **kwargs):
+        table = newparent._store.create_table(newparent, self._v_name, self.dtype, self._v_title)
+        self._v_attrs._f_copy(table)
+        rows = self.read(start, stop)
+        if len(rows):
+            table.append(rows)
+            table.flush()
+        return table
+
+    def _manifest(self):
+        return {'kind': 'table', 'dtype': np.lib.format.dtype_to_descr(self.dtype),
+                'title': self._v_title, 'attrs': self._v_attrs._values,
+                'shards': [[name, n] for name, n in self.shards]}
+
+
+class Group(Node):
+
+    def __init__(self, store, path, title=''):
+        Node.__init__(self, store, path, title)
+        self._v_children = {}
+
+    def __getattr__(self, name):
+        children = self.__dict__.get('_v_children', {})
+        if name in children:
+            return children[name]
+        raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self._v_children
+
+    def _f_get_child(self, name):
+        return self._v_children[name]
+
+    def _f_iter_nodes(self, classname=None):
+        kinds = {'Table': Table, 'EArray': Table, 'Group': Group, None: Node}
+        for name in sorted(self._v_children):
+            node = self._v_children[name]
+            if isinstance(node, kinds[classname]):
+                yield node
+
+    def _f_copy(self, newparent, recursive=True, **kwargs):
+        group = newparent._store.create_group(newparent, self._v_name, self._v_title)
+        self._v_attrs._f_copy(group)
+        if recursive:
+            for node in self._v_children.values():
+                node._f_copy(newparent=group, **kwargs)
+        return group
+
+    def _manifest(self):
+        return {'kind': 'group', 'title': self._v_title, 'attrs': self._v_attrs._values,
+                'children': {name: node._manifest() for name, node in self._v_children.items()}}
+
+
+class ArrayStore:
+    """Array-store output, opened like a tables.File.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store.
+    mode : str
+        'r' to read, 'a' to create or append to a store, 'w' to create
+        a new store (removing an existing one).
+    title : str
+        Title of a new store.
+    """
+
+    def __init__(self, path, mode='a', title=''):
+        if mode not in ['r', 'a', 'w']:
+            raise ValueError('Invalid mode: {}.'.format(mode))
+        self.path = path
+        self.mode = mode
+        if mode == 'w' and os.path.exists(path):
+            shutil.rmtree(path)
+        self.root = Group(self, '/', title)
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                content = json.load(f)
+            if content.get('format') != FORMAT_NAME or content.get('version') != FORMAT_VERSION:
+                raise ValueError('Invalid array store: {}.'.format(path))
+            self.root._v_title = content.get('title', '')
+            self._load(self.root, content['root'])
+        elif mode == 'r':
+            raise IOError('No array store at {}'.format(path))
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.isopen = True
+
+    def _load(self, group, content):
+        group._v_attrs = AttributeSet(content['attrs'])
+        for name, child in content['children'].items():
+            path = (group._v_pathname.rstrip('/') + '/' + name)
+            if child['kind'] == 'group':
+                node = Group(self, path, child['title'])
+                self._load(node, child)
+            else:
+                node = Table(self, path, np.lib.format.descr_to_dtype(_descr(child['dtype'])),
+                             child['title'], [tuple(s) for s in child['shards']])
+                node._v_attrs = AttributeSet(child['attrs'])
+            group._v_children[name] = node
+
+    def _node_dir(self, path):
+        return os.path.join(self.path, *path.strip('/').split('/'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, path):
+        try:
+            self.get_node(path)
+            return True
+        except KeyError:
+            return False
+
+    def get_node(self, path):
+        node = self.root
+        for name in path.strip('/').split('/'):
+            if name:
+                if not isinstance(node, Group) or name not in node._v_children:
+                    raise KeyError(path)
+                node = node._v_children[name]
+        return node
+
+    def _add(self, where, node_class, name, *args):
+        parent = self.get_node(where) if isinstance(where, str) else where
+        if name in parent._v_children:
+            raise ValueError('Node already exists: {}.'.format(name))
+        node = node_class(self, parent._v_pathname.rstrip('/') + '/' + name, *args)
+        parent._v_children[name] = node
+        return node
+
+    def create_table(self, where, name, description, title='', **kwargs):
+        """Create a table; HDF5 storage options (filters, chunkshape, ...) are ignored."""
+        return self._add(where, Table, name, _to_dtype(description), title)
+
+    def create_earray(self, where, name, atom, shape=(0,), title='', **kwargs):
+        """Create a 1-D array of atoms, stored like a table without fields."""
+        if tuple(shape) != (0,):
+            raise ValueError('Invalid array shape: {}.'.format(shape))
+        return self._add(where, Table, name, atom.dtype, title)
+
+    def create_group(self, where, name, title=''):
+        return self._add(where, Group, name, title)
+
+    def walk_tables(self, group=None):
+        group = self.root if group is None else group
+        for node in group._v_children.values():
+            if isinstance(node, Group):
+                for table in self.walk_tables(node):
+                    yield table
+            else:
+                yield node
+
+    def flush(self):
+        """Write the pending rows of all tables and the manifest."""
+        if self.mode == 'r':
+            return
+        for table in self.walk_tables():
+            table.write_pending()
+        content = {'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                   'title': self.root._v_title, 'root': self.root._manifest()}
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def close(self):
+        if self.isopen:
+            self.flush()
+            self.isopen = False
+
+
+def _descr(descr):
+    """Turn the JSON lists of a dtype descr back into tuples."""
+    if isinstance(descr, str):
+        return descr
+    out = []
+    for field in descr:
+        name, sub = field[0], field[1]
+        sub = _descr(sub) if isinstance(sub, list) else sub
+        out.append((name, sub, tuple(field[2])) if len(field) > 2 else (name, sub))
+    return out
+
+
+def open_output(path, mode='a', title='', output_format='hdf5'):
+    """
+    Open an output file of the given format: a tables.File for 'hdf5',
+    an ArrayStore for 'npy'.
+    """
+    if output_format == 'hdf5':
+        return tables.open_file(path, mode=mode, title=title)
+    if output_format == 'npy':
+        return ArrayStore(path, mode=mode, title=title)
+    raise ValueError('Invalid output format: {}.'.format(output_format))
+
+
+def output_exists(path, output_format='hdf5'):
+    """Whether an output file (or a closed array store) exists at path."""
+    if output_format == 'npy':
+        return os.path.exists(os.path.join(path, MANIFEST))
+    return os.path.exists(path)
+
+
+def remove_output(path):
+    """Delete an output file or array store."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
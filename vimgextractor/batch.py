@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Module for converting many stage 2 files into one output file.
+
+Each input file is converted into a shard by a pool of worker processes,
+and the shards are merged into the output file in input order. After each
+merge a row is added to the /Manifest table of the output file in the same
+open file, so an interrupted batch can be rerun and skips the files that
+are already in the output.
+"""
+
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+
+import vimgextractor.row_types as row_types
+from vimgextractor.arraystore import SHARD_EXTENSIONS, open_output, output_exists, remove_output
+from vimgextractor.instrument import NO_STATS, file_size
+from vimgextractor.dedup import index_path, checked_index_path
+from vimgextractor.parallel import convert_shard, merge_shard, load_key_index
+from vimgextractor.query import index_output
+from vimgextractor.sources import SYNTHETIC_PREFIX
+
+logger = logging.getLogger(__name__)
+
+
+def expand_inputs(patterns):
+    """
+    Expand glob patterns into a list of unique files, keeping the given order.
+    """
+    files = []
+    for pattern in patterns:
+        if pattern.startswith(SYNTHETIC_PREFIX):
+            if pattern not in files:
+                files.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            logger.warning('No file matches {}'.format(pattern))
+        for match in matches:
+            match = os.path.abspath(match)
+            if match not in files:
+                files.append(match)
+    return files
+
+
+def _manifest_key(input_file, start_event, stop_event):
+    if not input_file.startswith(SYNTHETIC_PREFIX):
+        input_file = os.path.abspath(input_file)
+    return (input_file,
+            -1 if start_event is None else start_event,
+            -1 if stop_event is None else stop_event)
+
+
+def read_manifest(output_path, output_format='hdf5'):
+    """
+    :return: set of (input_file, start_event, stop_event) already in the output file
+    """
+    if not output_exists(output_path, output_format):
+        return set()
+    with open_output(output_path, mode="r", output_format=output_format) as f:
+        if '/Manifest' not in f:
+            return set()
+        return {(row['input_file'].decode(), int(row['start_event']), int(row['stop_event']))
+                for row in f.root.Manifest.read()}
+
+
+def _append_manifest(out, key, num_events):
+    if '/Manifest' not in out:
+        out.create_table(out.root, 'Manifest', row_types.Manifest,
+                         "Table of converted input files")
+    row = out.root.Manifest.row
+    row['input_file'], row['start_event'], row['stop_event'] = key
+    row['num_events'] = num_events
+    row.append()
+    out.root.Manifest.flush()
+
+
+def convert_batch(extractor, input_files, n_workers=1, max_events=None,
+                  start_event=None, stop_event=None, shard_dir=None, mp_context='spawn', stats=None):
+    """
+    Convert several stage 2 files into the output file of the extractor.
+
+    Files (with the same entry range) already listed in the output file's
+    manifest are skipped.
+
+    :param extractor: configured ImageExtractor
+    :param input_files: list of files or glob patterns
+    :param n_workers: number of files converted concurrently
+    :param max_events: maximum number of events converted per file
+    :param start_event: first entry converted in each file
+    :param stop_event: last entry (inclusive) converted in each file
+    :param shard_dir: directory for the per-file shards, defaults to a
+                      directory next to the output file
+    :param mp_context: multiprocessing start method of the workers
+    :param stats: instrument.RunStats collecting the merge times and merged events
+    :return: number of events added to the output file
+    """
+    stats = stats or NO_STATS
+    if max_events is not None:
+        first = 0 if start_event is None else start_event
+        last = first + max_events - 1
+        stop_event = last if stop_event is None else min(stop_event, last)
+
+    done = read_manifest(extractor.output_path, extractor.output_format)
+    todo = []
+    for input_file in expand_inputs(input_files):
+        key = _manifest_key(input_file, start_event, stop_event)
+        if key in done:
+            logger.info("Skipping {}: already converted".format(input_file))
+        else:
+            todo.append((input_file, key))
+    logger.info("{} files to convert, {} already done".format(len(todo), len(done)))
+    if not todo:
+        return 0
+
+    if shard_dir is None:
+        shard_dir = extractor.output_path + '.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(extractor.output_path))[0]
+
+    num_added = 0
+    known_keys = checked_index_path(extractor.output_path, extractor.output_format) \
+        if extractor.dedup == 'skip' else None
+    context = multiprocessing.get_context(mp_context) if mp_context else None
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+        futures = []
+        for k, (input_file, key) in enumerate(todo):
+            shard_path = os.path.join(shard_dir, '{}.batch{:05d}{}'.format(
+                base, k, SHARD_EXTENSIONS[extractor.output_format]))
+            remove_output(shard_path)
+            futures.append(pool.submit(convert_shard, extractor, input_file, shard_path,
+                                       start_event, stop_event, known_keys))
+
+        # merge in input order so that the output does not depend on scheduling
+        failed = []
+        key_index = None
+        for (input_file, key), future in zip(todo, futures):
+            try:
+                shard_path = future.result()
+            except Exception as e:
+                logger.error("Conversion of {} failed: {}".format(input_file, e))
+                failed.append(input_file)
+                continue
+            size_before = file_size(extractor.output_path)
+            with stats.timer('merge'):
+                with open_output(extractor.output_path, mode="a", title="Output File",
+                                 output_format=extractor.output_format) as out:
+                    if key_index is None and extractor.dedup != 'append':
+                        key_index = load_key_index(out, extractor.output_path)
+                    num_events = merge_shard(out, shard_path, extractor.output_format,
+                                             key_index, extractor.dedup, name=input_file)
+                    _append_manifest(out, key, num_events)
+            stats.bytes_written += file_size(extractor.output_path) - size_before
+            stats.event_done(num_events)
+            remove_output(shard_path)
+            num_added += num_events
+            logger.info("Merged {} events from {}".format(num_events, input_file))
+
+        if key_index is not None:
+            with open_output(extractor.output_path, mode="a", output_format=extractor.output_format) as out:
+                key_index.save(index_path(extractor.output_path), out.root.Event_Info)
+        if extractor.index_columns and num_added:
+            with stats.timer('index'):
+                index_output(extractor.output_path, extractor.index_columns, extractor.output_format)
+    if not os.listdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    if failed:
+        raise RuntimeError('Conversion failed for {} files: {}'.format(len(failed), ', '.join(failed)))
+    return num_added
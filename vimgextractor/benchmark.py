@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Module for benchmarking the conversion hot paths.
+
+Every benchmark times a fixed amount of work on synthetic data, so that it
+runs without ROOT or VEGAS:
+
+    squarecam        : SquareCam construction (buildSquareCamera and
+                       build_oversampled_camera)
+    trace_converter  : TraceConverter.convert of (4, 500) events
+    camera_mapping   : rebinning of batches of 64 (4, 500) events with one
+                       sparse product (vimgextractor.mapping)
+    cleaning         : per-event reset, tailcut cleaning and L2 averaging,
+                       as done in VARootFile.read_st2_calib_channel_charge
+    cleaning_pool    : the same, decoding into the slots of a ring of buffer
+                       blocks that are zeroed when reused
+    hdf5_row_append  : image rows written with one Row.append and flush each
+    hdf5_block_append: the same rows written through BlockWriter
+    synthetic_source : event generation of SyntheticSource alone
+    end_to_end       : ImageExtractor.process_data on a SyntheticSource
+    end_to_end_sparse: the same with cleaning and sparse images
+    end_to_end_pipelined: the same as end_to_end in pipelined mode
+
+A result holds the throughput (items per second, best of the repeats) and
+the peak memory of the Python (and NumPy) allocations of one run, measured
+with tracemalloc in a separate untimed run. Results can be saved as a
+baseline and later runs compared against it; since throughput depends on
+the machine, a baseline is only meaningful on the machine it was made on.
+"""
+
+import gc
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import tables
+
+from vimgextractor.buffers import BufferPool
+from vimgextractor.cleaning import L2_CHANNELS, tailcut_clean, average_l2_channels
+from vimgextractor.instrument import peak_rss
+from vimgextractor.sources import SyntheticSource
+from vimgextractor.writer import BlockWriter
+
+# relative drop of throughput reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def _synthetic_events(n, seed=0):
+    """(charge, tzero, snr) of n synthetic events with all telescopes triggered."""
+    source = SyntheticSource(n, seed=seed, trigger_prob=1.0)
+    events = [source.generate_event(entry) for entry in range(n)]
+    return [(charge, tzero, snr) for _, charge, tzero, snr, _ in events]
+
+
+def bench_squarecam(n):
+    from vimgextractor.squarecam import SquareCam
+    pixvals = np.zeros(500)
+
+    def run():
+        for _ in range(n):
+            SquareCam(pixvals, pic_size=54)
+    return run, None
+
+
+def bench_trace_converter(n):
+    from vimgextractor.image import TraceConverter
+    converter = TraceConverter({'VTS': 'float32'}, 500)
+    charges = [charge for charge, _, _ in _synthetic_events(min(n, 64))]
+
+    def run():
+        for i in range(n):
+            converter.convert(charges[i % len(charges)])
+    return run, None
+
+
+def bench_camera_mapping(n):
+    from vimgextractor.mapping import get_mapping
+    mapping = get_mapping('rebinning')
+    charges = np.stack([charge for charge, _, _ in _synthetic_events(64)])
+
+    def run():
+        for _ in range(n // 64):
+            mapping.apply(charges, dtype='float32')
+    return run, None
+
+
+def bench_cleaning(n):
+    events = _synthetic_events(min(n, 64))
+    tels = [0, 1, 2, 3]
+    allCharge = np.zeros((4, 500))
+    allTZero = np.zeros((4, 500))
+    allSNR = np.zeros((4, 500))
+    allValid = np.zeros((4, 500), dtype=bool)
+
+    def run():
+        for i in range(n):
+            charge, tzero, snr = events[i % len(events)]
+            allCharge.fill(0)
+            allTZero.fill(0)
+            allSNR.fill(0)
+            allValid.fill(False)
+            allCharge[:, :499] = charge[:, :499]
+            allTZero[:, :499] = tzero[:, :499]
+            allSNR[:, :499] = snr[:, :499]
+            allValid[:, :499] = True
+            tailcut_clean(allCharge, allTZero, allSNR, picture_thresh=5.0, boundary_thresh=2.5,
+                          valid=allValid, inplace=True)
+            average_l2_channels(allCharge, L2_CHANNELS, tels=tels, inplace=True)
+    return run, None
+
+
+def bench_cleaning_pool(n):
+    events = _synthetic_events(min(n, 64))
+    tels = [0, 1, 2, 3]
+    pool = BufferPool(2, 64)
+    allSNR = np.zeros((4, 500))
+    allValid = np.zeros((4, 500), dtype=bool)
+
+    def run():
+        for i in range(n):
+            charge, tzero, snr = events[i % len(events)]
+            block, j, _ = pool.slots()
+            allCharge, allTZero = block.charge[j], block.tzero[j]
+            allSNR.fill(0)
+            allValid.fill(False)
+            allCharge[:, :499] = charge[:, :499]
+            allTZero[:, :499] = tzero[:, :499]
+            allSNR[:, :499] = snr[:, :499]
+            allValid[:, :499] = True
+            tailcut_clean(allCharge, allTZero, allSNR, picture_thresh=5.0, boundary_thresh=2.5,
+                          valid=allValid, inplace=True)
+            average_l2_channels(allCharge, L2_CHANNELS, tels=tels, inplace=True)
+            pool.release()
+    return run, None
+
+
+class _ImageRow(tables.IsDescription):
+    event_index = tables.Int32Col(pos=0)
+    image_charge = tables.Float32Col(shape=(499,), pos=1)
+    image_peak_times = tables.Float32Col(shape=(499,), pos=2)
+
+
+def _hdf5_append(n, blocked):
+    images = np.random.default_rng(0).normal(size=(64, 499)).astype(np.float32)
+    workdir = tempfile.mkdtemp(prefix='vimg_bench_')
+
+    def run():
+        path = os.path.join(workdir, 'bench.h5')
+        with tables.open_file(path, mode='w') as f:
+            table = f.create_table(f.root, 'VTS', _ImageRow, expectedrows=n)
+            if blocked:
+                writer = BlockWriter(table)
+                for i in range(n):
+                    row = writer.row()
+                    row['event_index'] = i
+                    row['image_charge'] = images[i % 64]
+                    row['image_peak_times'] = images[i % 64]
+                    writer.append()
+                writer.close()
+            else:
+                row = table.row
+                for i in range(n):
+                    row['event_index'] = i
+                    row['image_charge'] = images[i % 64]
+                    row['image_peak_times'] = images[i % 64]
+                    row.append()
+                    table.flush()
+        os.remove(path)
+    return run, lambda: shutil.rmtree(workdir)
+
+
+def bench_hdf5_row_append(n):
+    return _hdf5_append(n, blocked=False)
+
+
+def bench_hdf5_block_append(n):
+    return _hdf5_append(n, blocked=True)
+
+
+def bench_synthetic_source(n):
+    source = SyntheticSource(n)
+
+    def run():
+        for _ in source.read_events():
+            pass
+    return run, None
+
+
+def _end_to_end(n, **kwargs):
+    from vimgextractor.image_extractor import ImageExtractor
+    workdir = tempfile.mkdtemp(prefix='vimg_bench_')
+    path = os.path.join(workdir, 'bench.h5')
+
+    def run():
+        if os.path.exists(path):
+            os.remove(path)
+        ImageExtractor(path, **kwargs).process_data(SyntheticSource(n))
+    return run, lambda: shutil.rmtree(workdir)
+
+
+def bench_end_to_end(n):
+    return _end_to_end(n)
+
+
+def bench_end_to_end_sparse(n):
+    return _end_to_end(n, img_mode='sparse', cleaning={'img': 5.0, 'brd': 2.5})
+
+
+def bench_end_to_end_pipelined(n):
+    return _end_to_end(n, pipelined=True)
+
+
+def bench_end_to_end_selection(n):
+    # header cuts rejecting most synthetic events before they are generated
+    return _end_to_end(n, selection={'n_tels': (3, None), 'mc_energy': (0.3, None)})
+
+
+# name -> (setup function, number of items per run, unit of the items)
+BENCHMARKS = OrderedDict([
+    ('squarecam', (bench_squarecam, 20, 'cameras')),
+    ('trace_converter', (bench_trace_converter, 5000, 'events')),
+    ('camera_mapping', (bench_camera_mapping, 6400, 'events')),
+    ('cleaning', (bench_cleaning, 2000, 'events')),
+    ('cleaning_pool', (bench_cleaning_pool, 2000, 'events')),
+    ('hdf5_row_append', (bench_hdf5_row_append, 5000, 'rows')),
+    ('hdf5_block_append', (bench_hdf5_block_append, 5000, 'rows')),
+    ('synthetic_source', (bench_synthetic_source, 1000, 'events')),
+    ('end_to_end', (bench_end_to_end, 2000, 'events')),
+    ('end_to_end_sparse', (bench_end_to_end_sparse, 2000, 'events')),
+    ('end_to_end_pipelined', (bench_end_to_end_pipelined, 2000, 'events')),
+    ('end_to_end_selection', (bench_end_to_end_selection, 2000, 'events')),
+])
+
+
+def run_benchmark(name, scale=1.0, repeat=3, memory=True):
+    """
+    Run one benchmark.
+
+    :param name: name of a benchmark in BENCHMARKS
+    :param scale: factor applied to the number of items per run
+    :param repeat: number of timed runs, the best one is kept
+    :param memory: also measure the peak traced memory of one run
+    :return: dict with items, unit, seconds, throughput and peak_memory (bytes or None)
+    """
+    if name not in BENCHMARKS:
+        raise ValueError('Invalid benchmark: {}.'.format(name))
+    setup, items, unit = BENCHMARKS[name]
+    items = max(1, int(items * scale))
+    run, cleanup = setup(items)
+    try:
+        run()  # warm-up: caches, JIT and first-time imports
+        times = []
+        for _ in range(repeat):
+            gc.collect()
+            t0 = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - t0)
+        peak = None
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            try:
+                run()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        if cleanup is not None:
+            cleanup()
+    best = min(times)
+    return {'items': items, 'unit': unit, 'seconds': best,
+            'throughput': items / best if best > 0 else float('inf'),
+            'peak_memory': peak}
+
+
+def run_benchmarks(names=None, scale=1.0, repeat=3, memory=True, callback=None):
+    """
+    Run several benchmarks.
+
+    :param names: benchmark names, defaults to all of BENCHMARKS
+    :param callback: function called with (name, result) after each benchmark
+    :return: report dict with 'machine', 'results' and 'peak_rss'
+    """
+    names = list(BENCHMARKS) if names is None else list(names)
+    results = OrderedDict()
+    for name in names:
+        results[name] = run_benchmark(name, scale=scale, repeat=repeat, memory=memory)
+        if callback is not None:
+            callback(name, results[name])
+    return {'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                        'numpy': np.__version__, 'tables': tables.__version__,
+                        'cpu_count': os.cpu_count()},
+            'results': results,
+            'peak_rss': peak_rss()}
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_reports(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the throughputs of a report with those of a baseline report.
+
+    :param tolerance: relative drop of throughput accepted before a
+                      benchmark is reported as a regression
+    :return: list of (name, throughput, baseline throughput, ratio, regressed)
+             for the benchmarks present in both reports
+    """
+    out = []
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        ref = baseline['results'][name]['throughput']
+        ratio = result['throughput'] / ref if ref > 0 else float('inf')
+        out.append((name, result['throughput'], ref, ratio, ratio < 1. - tolerance))
+    return out
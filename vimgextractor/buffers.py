@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Module for the event buffers filled by the event sources.
+
+An EventBlock holds the charge and tzero arrays of up to block_size
+consecutive events, as (block_size, 4, 500) float64 arrays, in process
+memory or in a shared memory segment. Sources decode the events of a read
+directly into the slots of blocks and yield views of the slots, so that
+events are neither copied nor overwritten by later events while they are
+in use.
+
+A BufferPool hands out the slots and recycles the blocks:
+
+* with num_blocks, the blocks are preallocated and reused as a ring. Each
+  yielded event is owned by the consumer until it calls release() (once
+  per event, in the order of the events); a block is reused once all its
+  events are released, and its used slots are then zeroed in one pass.
+  When every block is in use, the source waits (backpressure).
+* without num_blocks, a new block is allocated whenever the current one is
+  full and nothing needs to be released: the events stay valid as long as
+  the consumer keeps them.
+
+Shared memory blocks can be attached by other processes from their
+handle (see EventBlock.attach), to pass batches of events without
+pickling their arrays.
+"""
+
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NUM_TELS = 4
+NUM_CHANNELS = 500
+
+
+class PoolClosed(RuntimeError):
+    """Raised by BufferPool.acquire once the pool is closed."""
+
+
+class EventBlock:
+    """Charge and tzero arrays of a block of consecutive events.
+
+    Parameters
+    ----------
+    size : int
+        Number of event slots.
+    num_tels, num_channels : int
+        Telescopes and channels of an event.
+    shm : multiprocessing.shared_memory.SharedMemory or None
+        Shared memory segment holding the arrays, None for process memory.
+    """
+
+    def __init__(self, size, num_tels=NUM_TELS, num_channels=NUM_CHANNELS, shm=None):
+        self.size = size
+        self.num_tels = num_tels
+        self.num_channels = num_channels
+        self.shm = shm
+        shape = (size, num_tels, num_channels)
+        if shm is None:
+            self.charge = np.zeros(shape)
+            self.tzero = np.zeros(shape)
+        else:
+            nbytes = int(np.prod(shape)) * 8
+            self.charge = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            self.tzero = np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=nbytes)
+        # slots handed out, and handed out events not released yet
+        self.count = 0
+        self.pending = 0
+        # no more slots will be handed out until the block is recycled
+        self.sealed = False
+
+    @classmethod
+    def shared(cls, size, num_tels=NUM_TELS, num_channels=NUM_CHANNELS):
+        """Block in a new (zeroed) shared memory segment."""
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=2 * size * num_tels * num_channels * 8)
+        return cls(size, num_tels, num_channels, shm=shm)
+
+    @property
+    def handle(self):
+        """(name, size, num_tels, num_channels) of a shared memory block, for attach()."""
+        if self.shm is None:
+            raise ValueError('Invalid block: not in shared memory.')
+        return self.shm.name, self.size, self.num_tels, self.num_channels
+
+    @classmethod
+    def attach(cls, handle):
+        """Map the shared memory block of a handle, e.g. in another process."""
+        from multiprocessing import shared_memory
+        name, size, num_tels, num_channels = handle
+        return cls(size, num_tels, num_channels, shm=shared_memory.SharedMemory(name=name))
+
+    def reset(self):
+        """Zero the used slots and make the block empty."""
+        self.charge[:self.count] = 0.
+        self.tzero[:self.count] = 0.
+        self.count = 0
+        self.pending = 0
+        self.sealed = False
+
+    def close(self, unlink=False):
+        """Unmap a shared memory block (and free it with unlink)."""
+        if self.shm is None:
+            return
+        self.charge = self.tzero = None
+        if unlink:
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # views of the arrays are still in use: unmapped when they are freed
+            pass
+        self.shm = None
+
+
+class BufferPool:
+    """Event slots in recycled (or newly allocated) EventBlocks.
+
+    Parameters
+    ----------
+    num_blocks : int or None
+        Number of preallocated blocks reused as a ring, None to allocate
+        new blocks without releases.
+    block_size : int
+        Number of events per block.
+    shared : bool
+        Allocate the (preallocated) blocks in shared memory, freed by close().
+    """
+
+    def __init__(self, num_blocks=None, block_size=64, num_tels=NUM_TELS, num_channels=NUM_CHANNELS,
+                 shared=False):
+        if block_size < 1 or (num_blocks is not None and num_blocks < 1):
+            raise ValueError('Invalid buffer pool: {} blocks of {} events.'.format(num_blocks, block_size))
+        if shared and num_blocks is None:
+            raise ValueError('Invalid buffer pool: shared memory needs num_blocks.')
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_tels = num_tels
+        self.num_channels = num_channels
+        self.shared = shared
+        self.closed = False
+        self._blocks = [self._new_block() for _ in range(num_blocks or 0)]
+        self._free = deque(self._blocks)
+        self._current = None
+        # block of every handed out event not released yet, in order
+        self._outstanding = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def recycling(self):
+        return self.num_blocks is not None
+
+    def _new_block(self):
+        if self.shared:
+            return EventBlock.shared(self.block_size, self.num_tels, self.num_channels)
+        return EventBlock(self.block_size, self.num_tels, self.num_channels)
+
+    def acquire(self):
+        """
+        Take an empty block, waiting for one to be recycled if they are all in use.
+
+        :return: EventBlock
+        """
+        if not self.recycling:
+            return self._new_block()
+        with self._cond:
+            while not self._free and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                raise PoolClosed('Buffer pool closed.')
+            block = self._free.popleft()
+        block.reset()
+        return block
+
+    def slots(self, n=1):
+        """
+        Hand out the next (at most n) consecutive slots of the current block.
+
+        :return: (block, start, stop), the slots [start, stop) of the block
+        """
+        if self._current is None or self._current.count == self._current.size:
+            self.seal()
+            self._current = self.acquire()
+        block = self._current
+        start = block.count
+        stop = min(start + n, block.size)
+        block.count = stop
+        if self.recycling:
+            with self._cond:
+                block.pending += stop - start
+                self._outstanding.extend([block] * (stop - start))
+        return block, start, stop
+
+    def seal(self):
+        """Stop handing out slots of the current block (e.g. at the end of a read)."""
+        block, self._current = self._current, None
+        if block is not None and self.recycling:
+            with self._cond:
+                block.sealed = True
+                self._recycle(block)
+
+    def _recycle(self, block):
+        if block.sealed and block.pending == 0:
+            self._free.append(block)
+            self._cond.notify()
+
+    def release(self, n=1):
+        """Give back the n oldest handed out events."""
+        if not self.recycling:
+            return
+        with self._cond:
+            for _ in range(n):
+                block = self._outstanding.popleft()
+                block.pending -= 1
+                self._recycle(block)
+
+    def close(self):
+        """Wake up the sources waiting for a block and free shared memory."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self.shared:
+            for block in self._blocks:
+                block.close(unlink=True)
+
+
+def iter_slots(pool, entries):
+    """
+    Split entries into pieces written to consecutive slots of the pool.
+
+    :return: iterator of (block, start, entries of the piece), the piece
+             going to the slots [start, start + len(piece)) of the block
+    """
+    k = 0
+    while k < len(entries):
+        block, start, stop = pool.slots(len(entries) - k)
+        yield block, start, entries[k:k + stop - start]
+        k += stop - start
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Module for keeping output files free of duplicated events.
+
+Every Event_Info row is identified by its (run_number, event_number) key.
+The keys of an output file are kept sorted, with the Event_Info row of
+each key, in a sidecar file next to it (<output>.keys.npz), so that the
+keys of a whole conversion are tested with one searchsorted instead of a
+scan of Event_Info. The policies of a conversion are:
+
+    skip    : events whose key is already in the output are not converted
+              (they are dropped with the headers, before any decoding)
+    replace : they are converted and overwrite their Event_Info row in
+              place; the images of the old event stay in the image tables,
+              detached (event_index -1)
+    append  : every event is appended, without looking at the keys
+
+Within one conversion only the first event of a key is kept (except with
+append). The sidecar records the number of Event_Info rows it covers and
+an identifier also stored in the Event_Info attributes: rows appended
+since it was saved (e.g. with append, or by an interrupted run) are added
+from the run_number and event_number columns when it is loaded, and it is
+rebuilt from these columns if it belongs to another file.
+"""
+
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from vimgextractor.arraystore import open_output, output_exists
+from vimgextractor.simjoin import event_keys
+
+logger = logging.getLogger(__name__)
+
+DEDUP_POLICIES = ['skip', 'replace', 'append']
+
+INDEX_SUFFIX = '.keys.npz'
+
+# bumped when the sidecar content changes
+INDEX_VERSION = 1
+
+# rows of Event_Info read at a time when catching up
+READ_BLOCK_SIZE = 1000000
+
+
+def index_path(output_path):
+    return output_path.rstrip('/') + INDEX_SUFFIX
+
+
+def row_keys(run_number, event_number):
+    """
+    Keys of events, with the run and event numbers cast like the UInt32
+    run_number and event_number columns of Event_Info.
+    """
+    return event_keys(np.asarray(run_number).astype(np.uint32),
+                      np.asarray(event_number).astype(np.uint32))
+
+
+def header_keys(headers):
+    """Keys of the events of a read_headers array, as they are written."""
+    return row_keys(headers['fRunNum'], headers['fArrayEventNum'])
+
+
+def first_occurrences(keys):
+    """Boolean mask of the first occurrence of each key."""
+    mask = np.zeros(len(keys), dtype=bool)
+    mask[np.unique(keys, return_index=True)[1]] = True
+    return mask
+
+
+class KeyIndex:
+    """Sorted keys of the Event_Info rows of an output file.
+
+    Parameters
+    ----------
+    keys : numpy array
+        Sorted keys.
+    rows : numpy array
+        Event_Info row of each key.
+    nrows : int
+        Number of Event_Info rows covered by the index.
+    uid : str or None
+        Identifier of the index, stored in the Event_Info attributes.
+    """
+
+    def __init__(self, keys=None, rows=None, nrows=0, uid=None):
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else np.asarray(keys, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.nrows = int(nrows)
+        self.uid = uid
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """
+        :param keys: keys to look up (see row_keys)
+        :return: Event_Info row of each key, -1 for keys not in the index
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.rows[pos], -1)
+
+    def add(self, keys, rows):
+        """Insert keys (of the given Event_Info rows) keeping the index sorted."""
+        keys = np.asarray(keys, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        pos = np.searchsorted(self.keys, keys[order], side='right')
+        self.keys = np.insert(self.keys, pos, keys[order])
+        self.rows = np.insert(self.rows, pos, np.asarray(rows, dtype=np.int64)[order])
+
+    def catch_up(self, table):
+        """Add the keys of the Event_Info rows appended since the index was built."""
+        for start in range(self.nrows, table.nrows, READ_BLOCK_SIZE):
+            stop = min(start + READ_BLOCK_SIZE, table.nrows)
+            self.add(row_keys(table.read(start, stop, field='run_number'),
+                              table.read(start, stop, field='event_number')),
+                     np.arange(start, stop))
+        self.nrows = max(self.nrows, table.nrows)
+
+    def save(self, path, table):
+        """
+        Write the index to path, atomically, and its identifier to the
+        attributes of the Event_Info table.
+        """
+        if self.uid is None:
+            self.uid = uuid.uuid4().hex
+        if getattr(table.attrs, 'key_index_uid', None) != self.uid:
+            table.attrs.key_index_uid = self.uid
+        tmp = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp, version=np.array(INDEX_VERSION), uid=np.array(self.uid), nrows=np.array(self.nrows),
+                 keys=self.keys, rows=self.rows)
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path):
+        """
+        :return: KeyIndex saved in path, without checking which file it
+                 belongs to, or None if it cannot be read
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != INDEX_VERSION:
+                    return None
+                return cls(data['keys'], data['rows'], int(data['nrows']), str(data['uid']))
+        except Exception as e:
+            logger.warning('Cannot read key index {}: {}'.format(path, e))
+            return None
+
+    @classmethod
+    def load(cls, path, table=None):
+        """
+        Key index of an output file, from its sidecar if it belongs to the
+        file, completed with the rows appended since it was saved.
+
+        :param table: Event_Info table of the output file, None if it has none yet
+        :return: KeyIndex
+        """
+        if table is None:
+            return cls()
+        uid = getattr(table.attrs, 'key_index_uid', None)
+        index = cls.read(path) if uid is not None else None
+        if index is None or index.uid != uid or index.nrows > table.nrows:
+            if index is not None:
+                logger.info('Rebuilding outdated key index {}'.format(path))
+            index = cls(uid=uid)
+        index.catch_up(table)
+        return index
+
+
+def checked_index_path(output_path, output_format='hdf5'):
+    """
+    :return: path of the key index sidecar of an output file if it belongs
+             to the file (all its keys are in the file), else None
+    """
+    path = index_path(output_path)
+    if not os.path.exists(path) or not output_exists(output_path, output_format):
+        return None
+    with open_output(output_path, mode='r', output_format=output_format) as f:
+        if '/Event_Info' not in f:
+            return None
+        uid = getattr(f.root.Event_Info.attrs, 'key_index_uid', None)
+        nrows = f.root.Event_Info.nrows
+    try:
+        with np.load(path) as data:
+            if int(data['version']) == INDEX_VERSION and str(data['uid']) == uid and int(data['nrows']) <= nrows:
+                return path
+    except Exception as e:
+        logger.warning('Cannot read key index {}: {}'.format(path, e))
+    return None
+
+
+def image_references(rows, image_names):
+    """
+    Image rows referenced by Event_Info rows.
+
+    :param image_names: image tables in the order of the 'indices' column (tel_id mode)
+    :return: list of (image table name, array of image rows, 0 for none)
+    """
+    out = []
+    for colname in rows.dtype.names:
+        if colname == 'indices':
+            for j, name in enumerate(image_names):
+                out.append((name, rows[colname][:, j]))
+        elif colname.endswith('_indices'):
+            out.append((colname[:-len('_indices')], rows[colname]))
+    return out
+
+
+def detach_images(f, rows, image_names):
+    """Set the event_index of the images of Event_Info rows to -1."""
+    for name, index in image_references(rows, image_names):
+        index = np.unique(index[index > 0])
+        if len(index):
+            table = f.get_node('/' + name)
+            images = table.read_coordinates(index)
+            images['event_index'] = -1
+            table.modify_coordinates(index, images)
+
+
+class RowReplacer:
+    """Event_Info rows overwriting existing rows, written by close().
+
+    Parameters
+    ----------
+    f : tables.File or ArrayStore
+        Output file.
+    image_names : list of str
+        Image tables in the order of the 'indices' column (tel_id mode).
+    """
+
+    def __init__(self, f, image_names):
+        self.file = f
+        self.table = f.root.Event_Info
+        self.image_names = image_names
+        self._coords = []
+        self._rows = []
+        self._next = None
+
+    def row(self, coord):
+        """Return a zeroed record replacing the Event_Info row coord."""
+        self._next = (coord, np.zeros(1, dtype=self.table.dtype))
+        return self._next[1][0]
+
+    def append(self):
+        """Commit the record returned by the last call to row()."""
+        coord, row = self._next
+        self._coords.append(coord)
+        self._rows.append(row)
+        self._next = None
+
+    def close(self):
+        """
+        Detach the images of the replaced rows and overwrite them.
+
+        :return: number of replaced rows
+        """
+        if not self._coords:
+            return 0
+        coords = np.asarray(self._coords, dtype=np.int64)
+        detach_images(self.file, self.table.read_coordinates(coords), self.image_names)
+        self.table.modify_coordinates(coords, np.concatenate(self._rows))
+        self.table.flush()
+        num_replaced = len(coords)
+        self._coords, self._rows = [], []
+        return num_replaced
@@ -1,31 +1,30 @@
-import numpy as np
-from vimgextractor.squarecam import SquareCam
+from vimgextractor.mapping import get_mapping
 
 IMAGE_SHAPES = {"VTS":(54,54)}
 TEL_NUM_PIXELS_OVER_SAMPLED = {"VTS":2916}
 TEL_NUM_PIXELS = {"VTS":499}
 
 class TraceConverter:
-    def __init__(self,img_dtypes,pixvar_length,img_dim_order='channels_last'):
+    def __init__(self,img_dtypes,pixvar_length,img_dim_order='channels_last',mapping='oversampling'):
         self.img_dtypes = img_dtypes
         if img_dim_order in ['channels_first','channels_last']:
             self.img_dim_order = img_dim_order
         else:
             raise ValueError('Invalid dimension ordering: {}.'.format(img_dim_order))
         self.pixvar_length  = pixvar_length
-        dummy_img           = np.zeros(pixvar_length)
-        self.cam_           = SquareCam(dummy_img,pic_size=IMAGE_SHAPES['VTS'][0])
+        # sparse (cells x pixels) weights of the camera mapping method (see vimgextractor.mapping)
+        self.mapping_       = get_mapping(mapping,IMAGE_SHAPES['VTS'][0],pixvar_length)
 
-    def convert(self,charge):
+    def convert(self,charge,normalize=False):
         """
-        :param charge: a numpy array of dimension (500, )
-        :return: images numpy array of dimension (1, 54, 54) or (54,54,1)
+        :param charge: a numpy array of dimension (500, ) or a batch of dimension (..., 500)
+        :param normalize: average the pixels of each cell instead of summing them, for peak times
+        :return: images numpy array of dimension (1, 54, 54) or (54,54,1),
+                 with the leading batch dimensions prepended for batched input
         """
-    
-        self.cam_.load_pixVal(charge)
-        img = self.cam_.get_simple_oversampled_image()
-        img = img.astype(self.img_dtypes['VTS'])        
+        imgs = self.mapping_.apply(charge,dtype=self.img_dtypes['VTS'],normalize=normalize)
+        lead_shape = imgs.shape[:-2]
         if(self.img_dim_order == 'channels_first'):
-            return img.reshape((1,IMAGE_SHAPES['VTS'][0],IMAGE_SHAPES['VTS'][1])) 
+            return imgs.reshape(lead_shape + (1,IMAGE_SHAPES['VTS'][0],IMAGE_SHAPES['VTS'][1])) 
         else:
-            return img.reshape((IMAGE_SHAPES['VTS'][0],IMAGE_SHAPES['VTS'][1],1)) 
+            return imgs.reshape(lead_shape + (IMAGE_SHAPES['VTS'][0],IMAGE_SHAPES['VTS'][1],1)) 
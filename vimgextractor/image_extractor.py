@@ -12,7 +12,21 @@ import numpy as np
 
 import vimgextractor.row_types as row_types
 import vimgextractor.image as image 
-from vimgextractor.vegas_io import VARootFile 
+import vimgextractor.profiles as profiles
+import vimgextractor.sparse as sparse
+import vimgextractor.pipeline as pipeline
+import vimgextractor.parallel as parallel
+import vimgextractor.batch as batch
+import vimgextractor.instrument as instrument
+import vimgextractor.arraystore as arraystore
+import vimgextractor.dedup as dedup
+import vimgextractor.query as query
+import vimgextractor.buffers as buffers
+from vimgextractor.sources import open_source
+from vimgextractor.writer import BlockWriter
+from vimgextractor.mapping import MAPPING_METHODS
+from vimgextractor.selection import get_selection
+from vimgextractor.dedup import DEDUP_POLICIES
 import os.path as path
 
 data_dir = path.dirname(__file__)+'/data/'
@@ -29,7 +43,11 @@ class ImageExtractor:
                  storage_mode='tel_type',
                  img_mode='1D',
                  img_dim_order='channels_last',
-                 force_all_telescopes=False,is_gamma=True,one_D_image_oversampled=False):
+                 force_all_telescopes=False,is_gamma=True,one_D_image_oversampled=False,
+                 block_size=1024,output_profile='default',cleaning=None,
+                 pipelined=False,queue_size=64,progress_interval=60.,output_format='hdf5',
+                 mapping='oversampling',source_options=None,selection=None,dedup='skip',
+                 index_columns=None,buffer_block_size=64):
         if os.path.isdir(os.path.dirname(output_path)):
             self.output_path = output_path
         else:
@@ -40,7 +58,7 @@ class ImageExtractor:
         else:
             raise ValueError('Invalid storage mode: {}.'.format(storage_mode))
 
-        if img_mode in ['1D','2D']:
+        if img_mode in ['1D','2D','sparse']:
             self.img_mode = img_mode
         else:
             raise ValueError('Invalid img_mode: {}.'.format(img_mode))        
@@ -50,14 +68,61 @@ class ImageExtractor:
         else:
             raise ValueError('Invalid dimension ordering: {}.'.format(img_dim_order))
 
+        # 'hdf5' file, or 'npy' array store directory (see vimgextractor.arraystore)
+        if output_format in arraystore.OUTPUT_FORMATS:
+            self.output_format = output_format
+        else:
+            raise ValueError('Invalid output format: {}.'.format(output_format))
+
+        # camera mapping of the 2D and oversampled 1D images (see vimgextractor.mapping)
+        if mapping in MAPPING_METHODS:
+            self.mapping = mapping
+        else:
+            raise ValueError('Invalid mapping: {}.'.format(mapping))
+
         self.trace_converter= image.TraceConverter(
             self.img_dtypes,
             500,
-            img_dim_order = self.img_dim_order
+            img_dim_order = self.img_dim_order,
+            mapping = self.mapping
             )
         self.force_all_telescopes  = force_all_telescopes
         self.is_gamma    = is_gamma
         self.one_D_image_oversampled = one_D_image_oversampled
+        # number of rows gathered per table before each append/flush
+        self.block_size = block_size
+        # compression, chunk shape and expected-row settings of the output tables
+        self.output_profile = profiles.get_output_profile(output_profile)
+        # picture/boundary thresholds, e.g. {'img':5.0,'brd':2.5}, or None for no cleaning
+        self.cleaning = cleaning
+        # run reading, image conversion and writing in separate threads
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        # events per block of the ring of buffers the source decodes into
+        # (see vimgextractor.buffers)
+        self.buffer_block_size = buffer_block_size
+        # seconds between progress messages (None for none); the stage
+        # timers of the last conversion are kept in self.stats
+        self.progress_interval = progress_interval
+        self.stats = None
+        # options of the stage 2 file reader, e.g. {'backend':'rdf','threads':8}
+        self.source_options = source_options or {}
+        # header and image cuts (see vimgextractor.selection), e.g.
+        # {'n_tels':(2,None),'size':(400,None)}, or None to convert every event
+        self.selection = get_selection(selection)
+
+        # events already in the output file (same run and event number) are
+        # skipped, replaced or appended again (see vimgextractor.dedup)
+        if dedup in DEDUP_POLICIES:
+            self.dedup = dedup
+        else:
+            raise ValueError('Invalid dedup policy: {}.'.format(dedup))
+        # key index of another output whose events are skipped too, set for
+        # the shards of parallel conversions
+        self.known_keys = None
+        # Event_Info columns indexed after each conversion (see vimgextractor.query),
+        # e.g. query.INDEX_COLUMNS, or None for no indexes
+        self.index_columns = index_columns
     def select_telescopes(self,data_file):
         """
         dummy method for getting telescope type for now. 
@@ -71,16 +136,235 @@ class ImageExtractor:
         else:
             attributes.particle_type   =   101
 
-    def process_data(self,filename,max_events=None):
-        #Open output hdf5 file
-        f = tables.open_file(self.output_path, mode="a", title="Output File")
+    def get_sim_values(self,simData,run_number=0):
+        """
+        Event_Info values taken from the simulation data of an event.
+
+        :param run_number: run number of events without simulation data
+        """
+        if(simData is not None):
+            return {'run_number'  : simData.fRunNum,
+                    'particle_id' : simData.fCORSIKAParticleID,
+                    'core_x'      : simData.fCoreEastM,
+                    'core_y'      : simData.fCoreSouthM*-1,
+                    'mc_energy'   : simData.fEnergyGeV/1000.,
+                    'alt'         : (90 - simData.fPrimaryZenithDeg)*np.pi/180.,
+                    'az'          : simData.fPrimaryAzimuthDeg*np.pi/180.}
+        else:
+            return {'run_number':run_number,'particle_id':0,'core_x':0,'core_y':0,
+                    'mc_energy':0,'alt':0,'az':0}
+
+    def transform_event(self,event,selected_tels,selection=None):
+        """
+        Convert the charge and tzero arrays of an event into the image
+        column values of its triggered telescopes.
+
+        :param event: (event number, sim values, charge, tzero, triggered tels)
+        :param selection: Selection of the image cuts, defaults to self.selection
+        :return: (event number, sim values, list of (tel_type, tel_id, image values or None)),
+                 or None if the event fails the image cuts of the selection
+        """
+        i,sim_values,charge,tzero,triggeredTels = event
+        if(self.force_all_telescopes):
+            triggeredTels=[1,2,3,4]        
+
+        selection = self.selection if selection is None else selection
+        images = []
+        num_images = 0
+        for tel_type in selected_tels.keys():
+            for tel_id in sorted(selected_tels[tel_type]):
+                if tel_id in triggeredTels and (selection is None or selection.pass_image(charge[tel_id -1,:])):
+                    num_images += 1
+                    pixel_vector = charge[tel_id -1,:] 
+                    timing_vector = tzero[tel_id -1,:] 
+                    logger.debug('Storing image from tel_type {} ({} pixels)'.format(tel_type,len(pixel_vector)))
+                    images.append((tel_type,tel_id,self.convert_image(tel_type,pixel_vector,timing_vector)))
+                else:
+                    images.append((tel_type,tel_id,None))
+        if selection is not None and not selection.pass_event(num_images):
+            return None
+        return i,sim_values,images
+
+    def convert_image(self,tel_type,pixel_vector,timing_vector):
+        """
+        :return: dict of image column values for the current img_mode
+        """
+        if self.img_mode == '2D' or self.one_D_image_oversampled:
+            imgs      = self.trace_converter.convert(pixel_vector)
+            time_imgs = self.trace_converter.convert(timing_vector,normalize=True)
+        if self.img_mode == '2D':
+            return {'image':imgs}
+        elif self.img_mode == '1D':
+            if(self.one_D_image_oversampled):
+                return {'image_charge':imgs.reshape(-1),'image_peak_times':time_imgs.reshape(-1)}
+            else:
+                # copies, so that records do not refer to the buffers of the source
+                return {'image_charge':pixel_vector[:499].astype(self.img_dtypes[tel_type]),
+                        'image_peak_times':timing_vector[:499].astype(self.img_dtypes[tel_type])}
+        elif self.img_mode == 'sparse':
+            if(self.one_D_image_oversampled):
+                return {'sparse':(imgs.reshape(-1),time_imgs.reshape(-1))}
+            else:
+                return {'sparse':(pixel_vector[:499].astype(self.img_dtypes[tel_type]),
+                                  timing_vector[:499].astype(self.img_dtypes[tel_type]))}
+
+    def replace_row(self,record,replace_rows):
+        """
+        :return: Event_Info row replaced by a converted event, or None to append it
+        """
+        if not replace_rows:
+            return None
+        i,sim_values,images = record
+        return replace_rows.get(int(dedup.row_keys(sim_values['run_number'],i)))
+
+    def write_event(self,record,selected_tels,writers,replace_row=None):
+        """
+        Append a converted event to the event and image table writers.
+
+        :param replace_row: Event_Info row overwritten by the event (with the
+                            dedup.RowReplacer of writers), None to append it
+        """
+        event_writer,image_writers,sparse_writers,replacer = writers
+        i,sim_values,images = record
+
+        if replace_row is None:
+            event_row = event_writer.row()
+            event_index = event_writer.nrows
+        else:
+            event_row = replacer.row(replace_row)
+            event_index = replace_row
+
+        tel_index_vectors = {tel_type:[] for tel_type in selected_tels}
+        all_tel_index_vector = []
+        num_images = 0
+        for tel_type,tel_id,values in images:
+            key = tel_type if self.storage_mode == 'tel_type' else tel_id
+            index_vector = tel_index_vectors[tel_type] if self.storage_mode == 'tel_type' else all_tel_index_vector
+            if values is None:
+                index_vector.append(0)
+                continue
+
+            image_writer = image_writers[key]
+            next_index = image_writer.nrows
+            image_row = image_writer.row()
+            for column,value in values.items():
+                if column == 'sparse':
+                    offset,num_pixels = sparse_writers[key].append(*value)
+                    image_row['pixel_offset'] = offset
+                    image_row['num_pixels']   = num_pixels
+                else:
+                    image_row[column] = value
+            image_row["event_index"] = event_index
+            image_writer.append()
+            index_vector.append(next_index)
+            num_images += 1
+
+        if self.storage_mode == 'tel_type':
+            for tel_type in tel_index_vectors:
+                event_row[tel_type+'_indices'] = tel_index_vectors[tel_type]
+        elif self.storage_mode == 'tel_id':
+            event_row['indices'] = all_tel_index_vector
+
+        event_row['event_number'] = i 
+        for column,value in sim_values.items():
+            event_row[column] = value
+        event_row['h_first_int']  = 0 
+        # files written before the column was added have no multiplicity
+        if 'num_images' in event_row.dtype.names:
+            event_row['num_images'] = num_images
+
+        if replace_row is None:
+            event_writer.append()
+        else:
+            replacer.append()
+
+    def create_image_table(self,f,name,tel_type,description,title,rows_per_event):
+        """
+        Create an image table with its blank image at index 0
+        (and its pixel arrays in sparse mode).
+        """
+        table = f.create_table(f.root,name,description,title,
+                               **self.output_profile.table_kwargs(rows_per_event,image_table=True))
+
+        #append blank image at index 0
+        image_row = table.row
+        
+        if self.img_mode == '2D':
+            image_row['image'] = self.trace_converter.convert(np.zeros(500))  
+        
+        elif self.img_mode == '1D':
+            shape = (image.TEL_NUM_PIXELS_OVER_SAMPLED[tel_type],) if self.one_D_image_oversampled else (image.TEL_NUM_PIXELS[tel_type],)
+            image_row['image_charge'] = np.zeros(shape,dtype=self.img_dtypes[tel_type])
+            image_row['image_peak_times'] = np.zeros(shape,dtype=self.img_dtypes[tel_type])
+            image_row['event_index'] = -1
+
+        elif self.img_mode == 'sparse':
+            num_pixels = image.TEL_NUM_PIXELS_OVER_SAMPLED[tel_type] if self.one_D_image_oversampled else image.TEL_NUM_PIXELS[tel_type]
+            expected_events = self.output_profile.expected_events
+            sparse.create_sparse_arrays(f,name,num_pixels,dtype=self.img_dtypes[tel_type],
+                                        filters=self.output_profile.filters(),
+                                        expectedrows=None if expected_events is None else expected_events*rows_per_event*num_pixels//10)
+            image_row['event_index'] = -1
+            image_row['pixel_offset'] = 0
+            image_row['num_pixels'] = 0
+
+        image_row.append()
+        table.flush()
+        return table
+
+    def process_data_parallel(self,filename,n_workers,**kwargs):
+        """
+        Convert a stage 2 file with n_workers processes, each writing a shard
+        of the entries, and merge the shards into the output file.
+        See vimgextractor.parallel.convert_parallel for the keyword arguments.
+        """
+        self.stats = instrument.RunStats(progress_interval=self.progress_interval)
+        num_events = parallel.convert_parallel(self,filename,n_workers,stats=self.stats,**kwargs)
+        self.stats.stop()
+        self.stats.log_report()
+        return num_events
+
+    def process_batch(self,input_files,n_workers=1,**kwargs):
+        """
+        Convert several stage 2 files (or glob patterns) into the output file,
+        skipping files already recorded in its manifest.
+        See vimgextractor.batch.convert_batch for the keyword arguments.
+        """
+        self.stats = instrument.RunStats(progress_interval=self.progress_interval)
+        num_events = batch.convert_batch(self,input_files,n_workers=n_workers,stats=self.stats,**kwargs)
+        self.stats.stop()
+        self.stats.log_report()
+        return num_events
+
+    def process_data(self,filename,max_events=None,start_event=None,stop_event=None,evtlist=None,selection=None):
+        """
+        Convert the events of a stage 2 file and append them to the output file.
+
+        :param filename: stage 2 file, 'synthetic:NUM_EVENTS[:SEED[:RUN]]', or an EventSource
+
+        :param max_events: maximum number of events to convert
+        :param start_event: first calibrated tree entry to convert
+        :param stop_event: last calibrated tree entry to convert (inclusive)
+        :param evtlist: list of calibrated tree entries to convert, instead of a range
+        :param selection: cuts replacing those of the extractor (see vimgextractor.selection);
+                          the header cuts are applied to the headers of the entries
+                          before their channel data is read
+        """
+        selection = self.selection if selection is None else get_selection(selection)
+        stats = instrument.RunStats(progress_interval=self.progress_interval)
+        self.stats = stats
+        size_before = instrument.file_size(self.output_path)
+
+        #Open output hdf5 file (or array store)
+        f = arraystore.open_output(self.output_path, mode="a", title="Output File",
+                                   output_format=self.output_format)
        
-        # Open Root File 
-        root_file = VARootFile(filename)
-        self.write_metadata(f,root_file)
+        # Open event source (a stage 2 file, or any EventSource)
+        data_source = open_source(filename,**self.source_options)
+        self.write_metadata(f,data_source)
 
-        selected_tels, num_tel = self.select_telescopes(root_file)
-        arr_info = root_file.get_array_info() 
+        selected_tels, num_tel = self.select_telescopes(data_source)
+        arr_info = data_source.get_array_info() 
 
         if not f.__contains__('/Array_Info'):
             arr_table = f.create_table(f.root, 'Array_Info',
@@ -100,20 +384,12 @@ class ImageExtractor:
                     arr_row.append()
 
         if not f.__contains__('/Telescope_Info'):
-            tel_table = f.create_table(f.root, 'Telescope_Info',
-                                       row_types.Tel,
-                                       ("Table of telescope data"))
-
-            descr = tel_table.description._v_colobjects
-            descr2 = descr.copy()
+            descr2 = tables.Description(row_types.Tel.columns)._v_colobjects.copy()
             if(self.one_D_image_oversampled):            
                 logger.debug('Save dummy pixel pos')
                 descr2["pixel_pos"] = tables.Float32Col(shape=(2, 54*54))
 
-                tel_table2 = f.create_table(f.root, 'temp', descr2, "Table of telescope data")
-                tel_table.attrs._f_copy(tel_table2)
-                tel_table.remove()
-                tel_table2.move(f.root, 'Telescope_Info')
+                tel_table2 = f.create_table(f.root, 'Telescope_Info', descr2, "Table of telescope data")
 
                 tel_row = tel_table2.row
 
@@ -130,10 +406,7 @@ class ImageExtractor:
                 logger.debug('Save real pixel pos')
                 descr2["pixel_pos"] = tables.Float32Col(shape=(2,499))
 
-                tel_table2 = f.create_table(f.root, 'temp', descr2, "Table of telescope data")
-                tel_table.attrs._f_copy(tel_table2)
-                tel_table.remove()
-                tel_table2.move(f.root, 'Telescope_Info')
+                tel_table2 = f.create_table(f.root, 'Telescope_Info', descr2, "Table of telescope data")
 
                 tel_row = tel_table2.row
 
@@ -148,12 +421,8 @@ class ImageExtractor:
         
         #create event table
         if not f.__contains__('/Event_Info'):
-            table = f.create_table(f.root, 'Event_Info',
-                                   row_types.Event,
-                                   "Table of Event metadata")
-
-            descr = table.description._v_colobjects
-            descr2 = descr.copy()
+            event_table_kwargs = self.output_profile.table_kwargs()
+            descr2 = tables.Description(row_types.Event.columns)._v_colobjects.copy()
 
             if self.storage_mode == 'tel_type':
                 for tel_type in selected_tels:
@@ -161,10 +430,7 @@ class ImageExtractor:
             elif self.storage_mode == 'tel_id':
                 descr2["indices"] = tables.Int32Col(shape=(num_tel))
 
-            table2 = f.create_table(f.root, 'temp', descr2, "Table of Events")
-            table.attrs._f_copy(table2)
-            table.remove()
-            table2.move(f.root, 'Event_Info')
+            table2 = f.create_table(f.root, 'Event_Info', descr2, "Table of Events",**event_table_kwargs)
 
             #add units to table attributes
             table2.attrs.core_pos_units    = 'm' 
@@ -193,45 +459,22 @@ class ImageExtractor:
                                 "event_index":tables.Int32Col(),
                                 "image_peak_times":tables.Col.from_dtype(np_type)}
 
+            elif self.img_mode == 'sparse':
+                columns_dict = sparse.image_columns()
+
             description = type('description', (tables.IsDescription,), columns_dict)
             if self.storage_mode == 'tel_type':
                 if not f.__contains__('/' + tel_type):
-                    table = f.create_table(f.root,tel_type,description,"Table of {} images".format(tel_type))
-
-                    #append blank image at index 0
-                    image_row = table.row
-                    
-                    if self.img_mode == '2D':
-                        image_row['image'] =  self.trace_converter.convert(np.zeros(500))  
- 
-                    elif self.img_mode == '1D':
-                        shape = (image.TEL_NUM_PIXELS_OVER_SAMPLED[tel_type],) if self.one_D_image_oversampled else (image.TEL_NUM_PIXELS[tel_type],)
-                        image_row['image_charge'] = np.zeros(shape,dtype=self.img_dtypes[tel_type])
-                        image_row['image_peak_times'] = np.zeros(shape,dtype=self.img_dtypes[tel_type])
-                        image_row['event_index'] = -1
-
-                    image_row.append()
-                    table.flush()
+                    self.create_image_table(f,tel_type,tel_type,description,
+                                            "Table of {} images".format(tel_type),
+                                            len(selected_tels[tel_type]))
                      
             elif self.storage_mode == 'tel_id':
                 for tel_id in selected_tels[tel_type]:
 
                     if not f.__contains__('/T' + str(tel_id)):
-                        table = f.create_table(f.root,'T'+str(tel_id),description,"Table of T{} images".format(str(tel_id)))
-                        #append blank image at index 0
-                        image_row = table.row
-                        
-                        if self.img_mode == '2D':
-                            image_row['image'] = self.trace_converter.convert(np.zeros(500))  
-                        
-                        elif self.img_mode == '1D':
-                            shape = (image.TEL_NUM_PIXELS_OVER_SAMPLED[tel_type],) if self.one_D_image_oversampled else (image.TEL_NUM_PIXELS[tel_type],)
-                            image_row['image_charge'] = np.zeros(shape,dtype=self.img_dtypes[tel_type])
-                            image_row['image_peak_times'] = np.zeros(shape,dtype=self.img_dtypes[tel_type])
-                            image_row['event_index'] = -1
-
-                        image_row.append()
-                        table.flush()
+                        self.create_image_table(f,'T'+str(tel_id),tel_type,description,
+                                                "Table of T{} images".format(str(tel_id)),1)
 
         # specify calibration and other processing options
 
@@ -239,105 +482,133 @@ class ImageExtractor:
 
         event_count = 0
         passing_count = 0
-        if(max_events is None):
-            source = root_file.read_st2_calib_channel_charge(tels=[ i-1 for i in selected_tels[tel_type]],cleaning=None)   
-        else:
-            source = root_file.read_st2_calib_channel_charge(tels=[ i-1 for i in selected_tels[tel_type]],cleaning=None,stop_event=max_events)   
-
-        for i,simData,event,tzero,triggeredTels in source:
-            if((max_events is not None) and 
-               (event_count > max_events)):
-               break
-
-            event_count += 1
-     
-            table = f.root.Event_Info
-            table.flush()
-            event_row = table.row
-            event_index = table.nrows
-
+        if(max_events is not None):
+            if(evtlist is not None):
+                evtlist = np.unique(evtlist)[:max_events]
+            else:
+                first = 0 if start_event is None else start_event
+                last  = first + max_events - 1
+                stop_event = last if stop_event is None else min(stop_event,last)
+        tels = [ i-1 for i in selected_tels[tel_type]]
+        # header pass: the cuts and key tests below drop entries before their channel data is read
+        headers = data_source.read_headers(start_event=start_event,stop_event=stop_event,
+                                           evtlist=evtlist,stats=stats)
+        if selection is not None and selection.header_cuts:
+            num_headers = len(headers)
+            headers = headers[selection.select_headers(headers,tels)]
+            logger.info("{} of {} events pass the header cuts".format(len(headers),num_headers))
+
+        replace_rows = {}
+        key_index = None
+        with stats.timer('dedup'):
+            num_headers = len(headers)
+            keys = dedup.header_keys(headers)
+            if self.dedup != 'append':
+                key_index = dedup.KeyIndex.load(dedup.index_path(self.output_path),f.root.Event_Info)
+                keep = dedup.first_occurrences(keys)
+                old_rows = key_index.lookup(keys)
+                if self.dedup == 'skip':
+                    keep &= old_rows < 0
+                else:
+                    replace_rows = {key:row for key,row in zip(keys[keep].tolist(),old_rows[keep].tolist()) if row >= 0}
+                if not keep.all():
+                    logger.info("{} events already in the output file or repeated are skipped".format(
+                        np.count_nonzero(~keep)))
+                headers,keys = headers[keep],keys[keep]
+            if self.known_keys is not None:
+                # keys of the output file a shard will be merged into
+                known = dedup.KeyIndex.read(self.known_keys)
+                if known is not None:
+                    keep = known.lookup(keys) < 0
+                    headers,keys = headers[keep],keys[keep]
+            if num_headers and not len(headers):
+                logger.warning("All {} events of {} are already in the output file: none is converted".format(
+                    num_headers,filename))
+        stats.total = len(headers)
+        # the source decodes into a ring of blocks; an event is released once
+        # converted, so the ring only needs to hold the events read ahead
+        read_ahead = self.queue_size + 2 if self.pipelined else 1
+        pool = buffers.BufferPool(read_ahead // self.buffer_block_size + 2,self.buffer_block_size)
+        events = data_source.read_events(tels=tels,cleaning=self.cleaning,stats=stats,headers=headers,pool=pool)
+
+        events_before = f.root.Event_Info.nrows
+        event_writer = BlockWriter(f.root.Event_Info,self.block_size)
+        image_writers = {}
+        for tel_type in selected_tels:
             if self.storage_mode == 'tel_type':
-                tel_index_vectors = {tel_type:[] for tel_type in selected_tels}
+                image_writers[tel_type] = BlockWriter(f.get_node('/' + tel_type),self.block_size)
             elif self.storage_mode == 'tel_id':
-                all_tel_index_vector = []
-
-            for tel_type in selected_tels.keys():
-                for tel_id in sorted(selected_tels[tel_type]):
-                    if self.storage_mode == 'tel_type':
-                        index_vector = tel_index_vectors[tel_type]
-                    elif self.storage_mode == 'tel_id':
-                        index_vector = all_tel_index_vector
-
-                    if(self.force_all_telescopes):
-                        triggeredTels=[1,2,3,4]        
-
-                    if tel_id in triggeredTels:
-                        pixel_vector = event[tel_id -1,:] 
-                        timing_vector = tzero[tel_id -1,:] 
-                        logger.debug('Storing image from tel_type {} ({} pixels)'.format(tel_type,len(pixel_vector)))
-
-                        if self.storage_mode == 'tel_type':
-                            table = eval('f.root.{}'.format(tel_type))
-                        elif self.storage_mode == 'tel_id':
-                            table = eval('f.root.T{}'.format(tel_id))
-                        next_index = table.nrows
-                        image_row = table.row
-                        imgs       = self.trace_converter.convert(pixel_vector)
-                        time_imgs  = self.trace_converter.convert(timing_vector)*4  
-                        if self.img_mode == '2D':
-                            image_row['image'] = imgs  
-
-                        elif self.img_mode == '1D':
-                            if(self.one_D_image_oversampled):
-                                image_row['image_charge']     = imgs.reshape(array_shape).copy() 
-                                image_row['image_peak_times'] = time_imgs.reshape(array_shape).copy() 
-                            else:
-                                image_row['image_charge']     =  pixel_vector[:499].copy() 
-                                image_row['image_peak_times'] =  timing_vector[:499].copy() 
-           
-                        image_row["event_index"] = event_index
-
-                        image_row.append()
-                        index_vector.append(next_index)
-                        table.flush()
-                    else:
-                        index_vector.append(0)
-
-                if self.storage_mode == 'tel_type':
-                    for tel_type in tel_index_vectors:
-                        event_row[tel_type+'_indices'] = tel_index_vectors[tel_type]
-                elif self.storage_mode == 'tel_id':
-                    event_row['indices'] = all_tel_index_vector
-
-                event_row['event_number'] = i 
-                if(simData is not None):
-                    event_row['run_number']   = simData.fRunNum 
-                    event_row['particle_id']  = simData.fCORSIKAParticleID 
-                    event_row['core_x']       = simData.fCoreEastM 
-                    event_row['core_y']       = simData.fCoreSouthM*-1 
-                    event_row['mc_energy']    = simData.fEnergyGeV/1000. 
-                    event_row['alt'] = (90 - simData.fPrimaryZenithDeg)*np.pi/180. 
-                    event_row['az']  = simData.fPrimaryAzimuthDeg*np.pi/180.
-
-                else:
-                    event_row['run_number']   = 0 
-                    event_row['particle_id']  = 0 
-                    event_row['core_x']       = 0 
-                    event_row['core_y']       = 0 
-                    event_row['mc_energy']    = 0 
-                    event_row['alt'] = 0 
-                    event_row['az']  = 0 
-
-                event_row['h_first_int']  = 0 
-
-                event_row.append()
-                table.flush()
-        f.root.Event_Info.flush()
+                for tel_id in selected_tels[tel_type]:
+                    image_writers[tel_id] = BlockWriter(f.get_node('/T' + str(tel_id)),self.block_size)
+        sparse_writers = {}
+        if self.img_mode == 'sparse':
+            for key,image_writer in image_writers.items():
+                name = image_writer.table.name
+                sparse_writers[key] = sparse.SparseArrayWriter(f.get_node('/' + sparse.sparse_group_name(name)))
+        replacer = dedup.RowReplacer(f,parallel._image_tables(f)) if replace_rows else None
+
+        writers = (event_writer,image_writers,sparse_writers,replacer)
+        run_numbers = headers['fRunNum'].tolist()
+        if self.pipelined:
+            # read, convert and write in separate threads connected by bounded queues
+            def read_events():
+                for run,(i,simData,event,tzero,triggeredTels) in zip(run_numbers,events):
+                    yield i,self.get_sim_values(simData,run),event,tzero,list(triggeredTels)
+
+            def transform_event(event):
+                try:
+                    with stats.timer('convert'):
+                        return self.transform_event(event,selected_tels,selection)
+                finally:
+                    pool.release()
+
+            def write_event(record):
+                if record is not None:
+                    with stats.timer('write'):
+                        self.write_event(record,selected_tels,writers,self.replace_row(record,replace_rows))
+                stats.event_done()
+
+            event_count = pipeline.run_pipeline(read_events(),transform_event,write_event,
+                                                queue_size=self.queue_size,on_stop=pool.close)
+        else:
+            for run,(i,simData,event,tzero,triggeredTels) in zip(run_numbers,events):
+                event_count += 1
+                with stats.timer('convert'):
+                    record = self.transform_event((i,self.get_sim_values(simData,run),event,tzero,triggeredTels),
+                                                  selected_tels,selection)
+                pool.release()
+                if record is not None:
+                    with stats.timer('write'):
+                        self.write_event(record,selected_tels,writers,self.replace_row(record,replace_rows))
+                stats.event_done()
+
+        with stats.timer('write'):
+            for image_writer in image_writers.values():
+                image_writer.close()
+            for sparse_writer in sparse_writers.values():
+                sparse_writer.close()
+            event_writer.close()
+            num_replaced = replacer.close() if replacer is not None else 0
         total_num_events = f.root.Event_Info.nrows
+        passing_count = total_num_events - events_before + num_replaced
+        if key_index is not None:
+            with stats.timer('dedup'):
+                key_index.catch_up(f.root.Event_Info)
+                key_index.save(dedup.index_path(self.output_path),f.root.Event_Info)
 
         f.close()
+        if self.index_columns:
+            with stats.timer('index'):
+                query.index_output(self.output_path,self.index_columns,self.output_format)
+        stats.stop()
+        stats.bytes_written = instrument.file_size(self.output_path) - size_before
 
         logger.info("{} events read in file".format(event_count))
+        if selection is not None:
+            logger.info("{} events pass the selection".format(passing_count))
+        if num_replaced:
+            logger.info("{} events replaced in the output file".format(num_replaced))
         logger.info("{} total events in output file.".format(total_num_events))
+        stats.log_report()
         logger.info("Done!")
 
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Module for instrumenting conversions.
+
+RunStats accumulates the time spent in each stage of a conversion
+(e.g. read, decode, clean, convert, write), counts events, logs periodic
+progress with the rate and the estimated time left, and produces a
+JSON-serializable report with the bytes written and the peak RSS.
+
+Stage timers of the pipelined mode run in different threads, so their
+sum can exceed the wall time.
+
+profiled wraps a block in cProfile or tracemalloc.
+"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ['cprofile', 'tracemalloc']
+
+
+def peak_rss(children=False):
+    """
+    Peak resident set size in bytes of the process, or of its largest
+    terminated child process.
+    """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class RunStats:
+    """Stage timers, event counter and progress of a conversion.
+
+    Parameters
+    ----------
+    total : int or None
+        Expected number of events, used for the ETA.
+    progress_interval : float or None
+        Seconds between progress log messages, None for no progress messages.
+    enabled : bool
+        With False, timer(), add() and event_done() do nothing.
+    """
+
+    def __init__(self, total=None, progress_interval=None, enabled=True):
+        self.total = total
+        self.progress_interval = progress_interval
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self.events = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._stop = None
+        self._next_progress = None if progress_interval is None else self._start + progress_interval
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, calls=1):
+        """Add time spent in a stage."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0., 0]
+            entry[0] += seconds
+            entry[1] += calls
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Context manager adding the time spent in its block to a stage."""
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+    @property
+    def elapsed(self):
+        return (self._stop or time.perf_counter()) - self._start
+
+    def event_done(self, n=1):
+        """Count converted events and log the progress when it is due."""
+        if not self.enabled:
+            return
+        self.events += n
+        if self._next_progress is not None:
+            now = time.perf_counter()
+            if now >= self._next_progress:
+                self._next_progress = now + self.progress_interval
+                self.log_progress()
+
+    def log_progress(self):
+        elapsed = self.elapsed
+        rate = self.events / elapsed if elapsed > 0 else 0.
+        if self.total:
+            eta = (self.total - self.events) / rate if rate > 0 else float('inf')
+            logger.info("{}/{} events ({:.1f}%), {:.1f} events/s, ETA {}".format(
+                self.events, self.total, 100. * self.events / self.total, rate, format_seconds(eta)))
+        else:
+            logger.info("{} events, {:.1f} events/s".format(self.events, rate))
+
+    def stop(self):
+        if self._stop is None:
+            self._stop = time.perf_counter()
+
+    def report(self):
+        """
+        :return: dict with the event count, wall time, rate, stage times,
+                 bytes written and peak RSS (self and children)
+        """
+        elapsed = self.elapsed
+        with self._lock:
+            stages = OrderedDict((name, {'seconds': seconds, 'calls': calls,
+                                         'fraction': seconds / elapsed if elapsed > 0 else 0.})
+                                 for name, (seconds, calls) in self.stages.items())
+        out = OrderedDict([('events', int(self.events)),
+                           ('seconds', elapsed),
+                           ('events_per_second', self.events / elapsed if elapsed > 0 else 0.),
+                           ('bytes_written', int(self.bytes_written)),
+                           ('peak_rss', peak_rss()),
+                           ('peak_rss_children', peak_rss(children=True)),
+                           ('stages', stages)])
+        return out
+
+    def log_report(self):
+        report = self.report()
+        logger.info("{} events in {:.1f} s ({:.1f} events/s), {:.1f} MiB written, peak RSS {:.0f} MiB".format(
+            report['events'], report['seconds'], report['events_per_second'],
+            report['bytes_written'] / 2.**20, report['peak_rss'] / 2.**20))
+        for name, stage in report['stages'].items():
+            logger.info("  {:<10s} {:8.2f} s ({:5.1f}%)".format(name, stage['seconds'], 100. * stage['fraction']))
+
+
+# shared disabled instance for callers that do not collect stats
+NO_STATS = RunStats(enabled=False)
+
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return '?'
+    seconds = int(round(seconds))
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def file_size(path):
+    """Size in bytes of a file, or of the files in a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+@contextlib.contextmanager
+def profiled(profiler, output_path, top=30):
+    """
+    Run a block under a profiler.
+
+    :param profiler: 'cprofile' (stats dumped to output_path, readable with pstats),
+                     'tracemalloc' (the top allocation sites written to output_path
+                     as text) or None for no profiling
+    :param top: number of allocation sites written by tracemalloc
+    """
+    if profiler is None:
+        yield
+        return
+    if profiler not in PROFILERS:
+        raise ValueError('Invalid profiler: {}.'.format(profiler))
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_path)
+            logger.info("cProfile stats written to {}".format(output_path))
+    else:
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(output_path, 'w') as f:
+                f.write('current {} bytes, peak {} bytes\n\n'.format(current, peak))
+                for stat in snapshot.statistics('lineno')[:top]:
+                    f.write('{}\n'.format(stat))
+            logger.info("tracemalloc statistics written to {}".format(output_path))
@@ -1,27 +1,43 @@
 from vimgextractor.root_lib_util import SingletonDecorator
-from ROOT import gSystem
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
+
+# VEGAS shared libraries, in loading order
+VEGAS_LIBRARIES = OrderedDict([
+    ('common', 'libVEGAScommon'),
+    ('stage1', 'libVEGASstage1'),
+    ('stage2', 'libVEGASstage2'),
+    ('stage4', 'libVEGASstage4'),
+    ('stage5', 'libVEGASstage5'),
+    ('stage6', 'libVEGASstage6'),
+])
+
 class VEGASStatus:
-    __vegas_loaded = False
     def __init__(self):
-        pass
+        self.loaded = set()
+
+    def loadVEGAS(self, libraries=None):
+        """
+        Load VEGAS libraries that are not loaded yet. ROOT is only imported here.
 
-    def loadVEGAS(self):
-        if(not self.__vegas_loaded):
-            logger.debug('Load VEGAS lib')
-            if gSystem.Load("libVEGAScommon") not in [0,1]:
-                raise Exception("Problem loading VEGAS Common libraries - please check this before proceeding")
-            if gSystem.Load("libVEGASstage1") not in [0,1]:
-                raise Exception("Problem loading VEGAS Stage 1 libraries - please check this before proceeding")
-            if gSystem.Load("libVEGASstage2") not in [0,1]:
-                raise Exception("Problem loading VEGAS Stage 2 libraries - please check this before proceeding")
-            if gSystem.Load("libVEGASstage4") not in [0,1]:
-                raise Exception("Problem loading VEGAS Stage 2 libraries - please check this before proceeding")
-            if gSystem.Load("libVEGASstage5") not in [0,1]:
-                raise Exception("Problem loading VEGAS Stage 5 libraries - please check this before proceeding")
-            if gSystem.Load("libVEGASstage6") not in [0,1]:
-                raise Exception("Problem loading VEGAS Stage 6 libraries - please check this before proceeding") 
-            self.__vegas_loaded = True
+        :param libraries: names of VEGAS_LIBRARIES to load, defaults to all of them;
+                          the common library is always loaded first
+        """
+        if libraries is None:
+            libraries = list(VEGAS_LIBRARIES)
+        for name in libraries:
+            if name not in VEGAS_LIBRARIES:
+                raise ValueError('Invalid VEGAS library: {}.'.format(name))
+        todo = [name for name in VEGAS_LIBRARIES
+                if (name in libraries or name == 'common') and name not in self.loaded]
+        if not todo:
+            return
+        from ROOT import gSystem
+        for name in todo:
+            logger.debug('Load VEGAS lib {}'.format(VEGAS_LIBRARIES[name]))
+            if gSystem.Load(VEGAS_LIBRARIES[name]) not in [0,1]:
+                raise Exception("Problem loading VEGAS {} libraries - please check this before proceeding".format(name))
+            self.loaded.add(name)
 
 VEGASStatus = SingletonDecorator(VEGASStatus)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Module for mapping the hexagonal VERITAS camera onto square images.
+
+A mapping is a sparse (grid cells x pixels) weight matrix, so that the
+images of any batch of pixel vectors are one sparse matrix product:
+
+    oversampling: every pixel copied into 4 cells at a quarter of its value
+                  (the SquareCam layout)
+    rebinning   : every pixel spread over the cells it overlaps, in
+                  proportion to the overlapping area (the total charge is kept)
+    bilinear    : linear interpolation between the three pixels of the
+                  Delaunay triangle around each cell centre
+    nearest     : every cell takes the value of the pixel it lies in
+
+The oversampling grid is fixed by the SquareCam geometry; the other
+methods use a pic_size x pic_size grid covering the camera, in a frame
+where the pixel pitch is 1. Images are indexed [x, y] in all methods.
+
+Matrices are built once per (method, pic_size, num_pixels), kept in
+memory and cached on disk as .npz files (see get_mapping).
+"""
+
+import logging
+import os
+
+import numpy as np
+import scipy.sparse
+
+from vimgextractor.squarecam import SquareCam
+
+logger = logging.getLogger(__name__)
+
+MAPPING_METHODS = ['oversampling', 'rebinning', 'bilinear', 'nearest']
+
+# bumped when the matrices of a method change, to invalidate cached files
+MAPPING_VERSION = 1
+
+CACHE_DIR_ENV = 'VIMGEXTRACTOR_CACHE_DIR'
+
+_mappings = {}
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV, os.path.join(os.path.expanduser('~'), '.cache', 'vimgextractor'))
+
+
+class CameraMapping:
+    """Sparse mapping of pixel vectors onto square images.
+
+    Parameters
+    ----------
+    method : str
+        One of MAPPING_METHODS.
+    weights : scipy.sparse matrix
+        Weights of dimension (pic_size * pic_size, num_pixels).
+    pic_size : int
+        Side of the square images.
+    """
+
+    def __init__(self, method, weights, pic_size):
+        self.method = method
+        self.weights = scipy.sparse.csr_matrix(weights, dtype=np.float64)
+        self.pic_size = pic_size
+        self.num_pixels = self.weights.shape[1]
+        # total weight of each cell, used to average intensive values (e.g. times)
+        self.cell_weights = np.asarray(self.weights.sum(axis=1)).ravel()
+        self._inv_cell_weights = np.divide(1., self.cell_weights, out=np.zeros_like(self.cell_weights),
+                                           where=self.cell_weights > 0)
+
+    def apply(self, pixVals, dtype='float64', normalize=False):
+        """
+        :param pixVals: numpy array of dimension (..., num_pixels), e.g. (500, ) or (N, 4, 500)
+        :param dtype: dtype of the returned images
+        :param normalize: divide each cell by its total weight, i.e. return the
+                          weighted average of the pixels instead of their weighted
+                          sum (for peak times)
+        :return: images numpy array of dimension (..., pic_size, pic_size)
+        """
+        pixVals = np.asarray(pixVals)
+        lead_shape = pixVals.shape[:-1]
+        flat = pixVals.reshape(-1, self.num_pixels)
+        images = (self.weights @ flat.T).T
+        if normalize:
+            images *= self._inv_cell_weights
+        return images.astype(dtype, copy=False).reshape(lead_shape + (self.pic_size, self.pic_size))
+
+
+def camera_pixel_positions():
+    """
+    :return: (positions, num_camera_pixels), the SquareCam positions of the
+             500 pixel slots (x steps of 1 and y steps of 2 between
+             neighbours) and the number of actual camera pixels (499)
+    """
+    camera = SquareCam(np.zeros(500))
+    return camera.pos, len(camera.pixNumArr)
+
+
+def hexagon_centres():
+    """Camera pixel centres in a frame where the pixel pitch is 1."""
+    pos, n = camera_pixel_positions()
+    return np.column_stack([pos[:n, 0] / 2., pos[:n, 1] * np.sqrt(3) / 4.])
+
+
+def _grid(centres, pic_size):
+    """(lower edge, cell size) of a square grid covering the hexagons."""
+    half = np.max(np.abs(centres)) + 1. / np.sqrt(3)
+    return -half, 2. * half / pic_size
+
+
+def _cell_centres(pic_size, lower, size):
+    axis = lower + (np.arange(pic_size) + 0.5) * size
+    x, y = np.meshgrid(axis, axis, indexing='ij')
+    return np.column_stack([x.ravel(), y.ravel()])
+
+
+def _hexagon(centre):
+    """Vertices of the pixel hexagon (flat sides facing +-x, pitch 1)."""
+    angles = np.radians(90. + 60. * np.arange(6))
+    return centre + np.column_stack([np.cos(angles), np.sin(angles)]) / np.sqrt(3)
+
+
+def _clip(polygon, axis, bound, keep_below):
+    """Sutherland-Hodgman clipping of a convex polygon by x or y <= / >= bound."""
+    out = []
+    n = len(polygon)
+    for k in range(n):
+        p, q = polygon[k], polygon[(k + 1) % n]
+        p_in = p[axis] <= bound if keep_below else p[axis] >= bound
+        q_in = q[axis] <= bound if keep_below else q[axis] >= bound
+        if p_in:
+            out.append(p)
+        if p_in != q_in:
+            t = (bound - p[axis]) / (q[axis] - p[axis])
+            out.append(p + t * (q - p))
+    return np.array(out)
+
+
+def _area(polygon):
+    if len(polygon) < 3:
+        return 0.
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def build_oversampling(pic_size, num_pixels):
+    camera = SquareCam(np.zeros(500), pic_size=pic_size)
+    keep = camera.pix_index < num_pixels
+    weights = scipy.sparse.coo_matrix((np.full(np.count_nonzero(keep), 0.25),
+                                       (camera.cell_index[keep], camera.pix_index[keep])),
+                                      shape=(camera.pic_size ** 2, num_pixels))
+    return CameraMapping('oversampling', weights, camera.pic_size)
+
+
+def build_rebinning(pic_size, num_pixels):
+    centres = hexagon_centres()[:num_pixels]
+    lower, size = _grid(centres, pic_size)
+    hex_area = np.sqrt(3) / 2.
+    rows, cols, values = [], [], []
+    for pixel, centre in enumerate(centres):
+        hexagon = _hexagon(centre)
+        lo = np.floor((hexagon.min(axis=0) - lower) / size).astype(int)
+        hi = np.floor((hexagon.max(axis=0) - lower) / size).astype(int)
+        for i in range(max(lo[0], 0), min(hi[0], pic_size - 1) + 1):
+            x0 = lower + i * size
+            strip = _clip(_clip(hexagon, 0, x0, False), 0, x0 + size, True)
+            for j in range(max(lo[1], 0), min(hi[1], pic_size - 1) + 1):
+                y0 = lower + j * size
+                area = _area(_clip(_clip(strip, 1, y0, False), 1, y0 + size, True)) if len(strip) else 0.
+                if area > 0:
+                    rows.append(i * pic_size + j)
+                    cols.append(pixel)
+                    values.append(area / hex_area)
+    weights = scipy.sparse.coo_matrix((values, (rows, cols)), shape=(pic_size ** 2, num_pixels))
+    return CameraMapping('rebinning', weights, pic_size)
+
+
+def build_bilinear(pic_size, num_pixels):
+    from scipy.spatial import Delaunay
+    centres = hexagon_centres()[:num_pixels]
+    lower, size = _grid(centres, pic_size)
+    cells = _cell_centres(pic_size, lower, size)
+    triangulation = Delaunay(centres)
+    simplex = triangulation.find_simplex(cells)
+    inside = np.flatnonzero(simplex >= 0)
+    transform = triangulation.transform[simplex[inside]]
+    # barycentric coordinates of the cell centres in their triangle
+    bary = np.einsum('nij,nj->ni', transform[:, :2], cells[inside] - transform[:, 2])
+    bary = np.column_stack([bary, 1. - bary.sum(axis=1)])
+    vertices = triangulation.simplices[simplex[inside]]
+    weights = scipy.sparse.coo_matrix((bary.ravel(), (np.repeat(inside, 3), vertices.ravel())),
+                                      shape=(pic_size ** 2, num_pixels))
+    weights.eliminate_zeros()
+    return CameraMapping('bilinear', weights, pic_size)
+
+
+def build_nearest(pic_size, num_pixels):
+    from scipy.spatial import cKDTree
+    centres = hexagon_centres()[:num_pixels]
+    lower, size = _grid(centres, pic_size)
+    cells = _cell_centres(pic_size, lower, size)
+    _, nearest = cKDTree(centres).query(cells)
+    # the nearest centre is the hexagon of the cell centre if it lies in it
+    d = np.abs(cells - centres[nearest])
+    inside = np.flatnonzero((d[:, 0] <= 0.5) & (d[:, 0] / 2. + d[:, 1] * np.sqrt(3) / 2. <= 0.5))
+    weights = scipy.sparse.coo_matrix((np.ones(len(inside)), (inside, nearest[inside])),
+                                      shape=(pic_size ** 2, num_pixels))
+    return CameraMapping('nearest', weights, pic_size)
+
+
+BUILDERS = {'oversampling': build_oversampling, 'rebinning': build_rebinning,
+            'bilinear': build_bilinear, 'nearest': build_nearest}
+
+
+def cache_path(method, pic_size, num_pixels, cache_dir=None):
+    return os.path.join(cache_dir or default_cache_dir(),
+                        'mapping_{}_{}_{}_v{}.npz'.format(method, pic_size, num_pixels, MAPPING_VERSION))
+
+
+def get_mapping(method='oversampling', pic_size=54, num_pixels=500, cache=True, cache_dir=None):
+    """
+    Mapping of a method, built once per process and cached on disk.
+
+    :param num_pixels: length of the pixel vectors, 500 for the charge
+                       vectors of VARootFile or 499 for the 1D images
+    :param cache: read and write the on-disk cache (cache_dir, by default
+                  $VIMGEXTRACTOR_CACHE_DIR or ~/.cache/vimgextractor)
+    :return: CameraMapping
+    """
+    if method not in MAPPING_METHODS:
+        raise ValueError('Invalid mapping method: {}.'.format(method))
+    key = (method, pic_size, num_pixels)
+    if key in _mappings:
+        return _mappings[key]
+
+    path = cache_path(method, pic_size, num_pixels, cache_dir)
+    mapping = None
+    if cache and os.path.exists(path):
+        try:
+            weights = scipy.sparse.load_npz(path)
+            mapping = CameraMapping(method, weights, int(np.sqrt(weights.shape[0])))
+        except Exception as e:
+            logger.warning('Cannot read camera mapping {}: {}'.format(path, e))
+    if mapping is None:
+        mapping = BUILDERS[method](pic_size, num_pixels)
+        if cache:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+                scipy.sparse.save_npz(tmp, mapping.weights)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.warning('Cannot cache camera mapping {}: {}'.format(path, e))
+    _mappings[key] = mapping
+    return mapping
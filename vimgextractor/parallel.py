@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Module for multi-process conversion of a single stage 2 file.
+
+The calibrated event tree is split into entry ranges, each range is
+converted into its own shard file by a worker process, and the shards are
+then merged in entry order into the output file, rebasing the
+event_index and *_indices cross-references. The merged tables hold the
+same rows as a serial conversion of the same entries.
+
+With the skip and replace policies of vimgextractor.dedup, the workers
+skip the events already in the output file (according to its key index)
+before decoding them, and the keys of the shard events are tested again
+when merging, so that events converted by another shard or file since are
+not duplicated either.
+"""
+
+import copy
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import vimgextractor.sparse as sparse
+from vimgextractor.arraystore import SHARD_EXTENSIONS, open_output, remove_output
+from vimgextractor.dedup import (KeyIndex, index_path, checked_index_path, row_keys, first_occurrences,
+                                 image_references, detach_images)
+from vimgextractor.instrument import NO_STATS, file_size
+from vimgextractor.query import index_output
+from vimgextractor.sources import open_source
+
+logger = logging.getLogger(__name__)
+
+# number of rows copied at a time while merging
+MERGE_BLOCK_SIZE = 10000
+
+
+def split_entries(num_events, n_shards, start_event=None, stop_event=None):
+    """
+    Split the entries [start_event, stop_event] (inclusive) into at most
+    n_shards contiguous ranges of nearly equal size.
+
+    :return: list of (start, stop) tuples, stop inclusive
+    """
+    if start_event is None:
+        start_event = 0
+    if stop_event is None:
+        stop_event = num_events - 1
+    stop_event = min(stop_event, num_events - 1)
+    if stop_event < start_event:
+        return []
+    n_shards = max(1, min(n_shards, stop_event + 1 - start_event))
+    edges = np.linspace(start_event, stop_event + 1, n_shards + 1).astype(int)
+    return [(int(a), int(b) - 1) for a, b in zip(edges[:-1], edges[1:])]
+
+
+def convert_shard(extractor, filename, shard_path, start_event, stop_event, known_keys=None):
+    """
+    Convert the entries [start_event, stop_event] of a file into shard_path
+    with a copy of the extractor.
+
+    :param known_keys: key index sidecar of the output file (see
+                       dedup.checked_index_path), whose events are skipped
+    """
+    extractor = copy.copy(extractor)
+    extractor.known_keys = known_keys
+    # the keys are tested against the output file when merging
+    extractor.dedup = 'append'
+    # the output file is indexed after the merge
+    extractor.index_columns = None
+    extractor.output_path = shard_path
+    extractor.process_data(filename, start_event=start_event, stop_event=stop_event)
+    return shard_path
+
+
+def _image_tables(h5file):
+    """
+    Names of the image tables of a file: the telescope type tables in
+    'tel_type' mode, or T1, T2, ... (sorted by id) in 'tel_id' mode.
+    """
+    names = [node._v_name for node in h5file.root._f_iter_nodes('Table')
+             if 'event_index' in node.colnames]
+    return sorted(names, key=lambda n: (len(n), n))
+
+
+def _copy_structure(src, dst):
+    """
+    Create in dst the tables of src that dst does not have yet: info tables
+    are copied whole, Event_Info empty and image tables with their blank row 0.
+    """
+    for name, value in ((name, src.root._v_attrs[name]) for name in src.root._v_attrs._f_list('user')):
+        if name not in dst.root._v_attrs:
+            dst.root._v_attrs[name] = value
+    for node in src.root._f_iter_nodes('Table'):
+        if ('/' + node._v_name) in dst:
+            continue
+        if node._v_name == 'Event_Info':
+            node._f_copy(newparent=dst.root, start=0, stop=0)
+        elif 'event_index' in node.colnames:
+            node._f_copy(newparent=dst.root, start=0, stop=1)
+        else:
+            node._f_copy(newparent=dst.root)
+    # pixel arrays of sparse image tables, empty
+    for group in src.root._f_iter_nodes('Group'):
+        if ('/' + group._v_name) in dst:
+            continue
+        new_group = group._f_copy(newparent=dst.root, recursive=False)
+        for array in group._f_iter_nodes('EArray'):
+            array._f_copy(newparent=new_group, start=0, stop=0)
+
+
+def merge_shards(shard_paths, output_path, output_format='hdf5', dedup='append'):
+    """
+    Append the events of the shard files, in order, to the output file.
+
+    Image rows (except the blank row 0 of each shard) are appended to the
+    matching output table with their event_index shifted to the output
+    Event_Info, and the non-zero image indices of Event_Info are shifted to
+    the output image tables.
+
+    :param output_format: format of the shards and of the output ('hdf5' or 'npy')
+    :param dedup: policy for the events already in the output file (see vimgextractor.dedup)
+    :return: number of events merged
+    """
+    num_merged = 0
+    with open_output(output_path, mode="a", title="Output File", output_format=output_format) as out:
+        key_index = load_key_index(out, output_path) if dedup != 'append' else None
+        for shard_path in shard_paths:
+            num_merged += merge_shard(out, shard_path, output_format, key_index, dedup)
+        if key_index is not None and '/Event_Info' in out:
+            key_index.save(index_path(output_path), out.root.Event_Info)
+    return num_merged
+
+
+def load_key_index(out, output_path):
+    """Key index of an open output file, which may have no Event_Info yet."""
+    return KeyIndex.load(index_path(output_path), out.root.Event_Info if '/Event_Info' in out else None)
+
+
+def merge_shard(out, shard_path, output_format='hdf5', key_index=None, dedup='skip', name=None):
+    """
+    Append the events of one shard file to the open output file.
+
+    :param key_index: KeyIndex of the output file, updated with the merged
+                      events, or None to append every event
+    :param dedup: 'skip' or 'replace', policy for the events of the shard
+                  whose key is in key_index
+    :param name: name of the shard events in log messages, e.g. their input
+                 file (the shard path if None)
+    :return: number of events merged (appended or replaced)
+    """
+    with open_output(shard_path, mode="r", output_format=output_format) as shard:
+        _copy_structure(shard, out)
+        num_events = shard.root.Event_Info.nrows
+        num_merged = _append_shard(shard, out, key_index, dedup)
+    if num_events and not num_merged:
+        logger.warning("All {} events of {} are already in the output file: none is merged".format(
+            num_events, name or shard_path))
+    if key_index is not None:
+        key_index.catch_up(out.root.Event_Info)
+    return num_merged
+
+
+def _append_sparse_arrays(shard, out, name):
+    """
+    Append the pixel arrays of a sparse image table.
+
+    :return: offset of the shard values in the output arrays
+    """
+    src_group = shard.get_node('/' + sparse.sparse_group_name(name))
+    dst_group = out.get_node('/' + sparse.sparse_group_name(name))
+    value_offset = dst_group._f_get_child(sparse.SPARSE_ARRAYS[0]).nrows
+    block = MERGE_BLOCK_SIZE * 100
+    for array_name in sparse.SPARSE_ARRAYS:
+        src = src_group._f_get_child(array_name)
+        dst = dst_group._f_get_child(array_name)
+        for start in range(0, src.nrows, block):
+            dst.append(src.read(start, min(start + block, src.nrows)))
+        dst.flush()
+    return value_offset
+
+
+def _as_dtype(rows, dtype):
+    """Rows converted to the dtype of another table, keeping the common columns."""
+    if rows.dtype == dtype:
+        return rows
+    out = np.zeros(len(rows), dtype=dtype)
+    for name in dtype.names:
+        if name in rows.dtype.names:
+            out[name] = rows[name]
+    return out
+
+
+def _append_shard(shard, out, key_index=None, dedup='skip'):
+    src = shard.root.Event_Info
+    dst = out.root.Event_Info
+    # output row of each shard event: appended, replacing an output row, or -1 if skipped
+    out_rows = np.arange(dst.nrows, dst.nrows + src.nrows)
+    appended = np.ones(src.nrows, dtype=bool)
+    replaced = np.zeros(src.nrows, dtype=bool)
+    if key_index is not None and src.nrows:
+        keys = row_keys(src.read(field='run_number'), src.read(field='event_number'))
+        old_rows = key_index.lookup(keys)
+        keep = first_occurrences(keys)
+        if dedup == 'skip':
+            keep &= old_rows < 0
+        replaced = keep & (old_rows >= 0)
+        appended = keep & ~replaced
+        out_rows = np.full(src.nrows, -1, dtype=np.int64)
+        out_rows[appended] = dst.nrows + np.arange(np.count_nonzero(appended))
+        out_rows[replaced] = old_rows[replaced]
+
+    image_names = _image_tables(shard)
+    image_rows = {}
+    for name in image_names:
+        src_images = shard.get_node('/' + name)
+        dst_images = out.get_node('/' + name)
+        # output row of each shard image row, 0 for the blank row and the images of skipped events
+        event_index = src_images.read(field='event_index').astype(np.int64)
+        kept = event_index >= 0
+        kept[kept] = out_rows[event_index[kept]] >= 0
+        kept[0] = False
+        image_rows[name] = np.zeros(src_images.nrows, dtype=np.int64)
+        image_rows[name][kept] = dst_images.nrows + np.arange(np.count_nonzero(kept))
+        value_offset = _append_sparse_arrays(shard, out, name) if 'pixel_offset' in src_images.colnames else 0
+        for start in range(1, src_images.nrows, MERGE_BLOCK_SIZE):
+            stop = min(start + MERGE_BLOCK_SIZE, src_images.nrows)
+            rows = src_images.read(start, stop)[kept[start:stop]]
+            rows['event_index'] = out_rows[rows['event_index']]
+            if value_offset:
+                rows['pixel_offset'] += value_offset
+            dst_images.append(rows)
+        dst_images.flush()
+
+    replacements = []
+    for start in range(0, src.nrows, MERGE_BLOCK_SIZE):
+        stop = min(start + MERGE_BLOCK_SIZE, src.nrows)
+        rows = src.read(start, stop)
+        for name, col in image_references(rows, image_names):
+            col[...] = image_rows[name][col]
+        # outputs written before a column was added to Event_Info lack it
+        rows = _as_dtype(rows, dst.dtype)
+        dst.append(rows[appended[start:stop]])
+        if replaced[start:stop].any():
+            replacements.append(rows[replaced[start:stop]])
+    dst.flush()
+    if replacements:
+        coords = out_rows[replaced]
+        detach_images(out, dst.read_coordinates(coords), _image_tables(out))
+        dst.modify_coordinates(coords, np.concatenate(replacements))
+        dst.flush()
+    return int(np.count_nonzero(out_rows >= 0))
+
+
+def convert_parallel(extractor, filename, n_workers, n_shards=None,
+                     max_events=None, start_event=None, stop_event=None,
+                     shard_dir=None, keep_shards=False, mp_context='spawn', stats=None):
+    """
+    Convert a stage 2 file with several worker processes.
+
+    :param extractor: configured ImageExtractor; the shards are written with
+                      copies of it and merged into its output file
+    :param n_workers: number of worker processes
+    :param n_shards: number of entry ranges, defaults to n_workers
+    :param shard_dir: directory for the shard files, defaults to a
+                      directory next to the output file
+    :param keep_shards: do not delete the shard files after the merge
+    :param mp_context: multiprocessing start method of the workers
+    :param stats: instrument.RunStats collecting the shard and merge times
+    :return: number of events merged into the output file
+    """
+    stats = stats or NO_STATS
+    num_events = open_source(filename, **extractor.source_options).get_num_events()
+    if max_events is not None:
+        first = 0 if start_event is None else start_event
+        last = first + max_events - 1
+        stop_event = last if stop_event is None else min(stop_event, last)
+    ranges = split_entries(num_events, n_shards or n_workers, start_event, stop_event)
+    stats.total = sum(stop + 1 - start for start, stop in ranges)
+    logger.info("Converting {} entry ranges with {} workers".format(len(ranges), n_workers))
+
+    if shard_dir is None:
+        shard_dir = extractor.output_path + '.shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(extractor.output_path))[0]
+    extension = SHARD_EXTENSIONS[extractor.output_format]
+    shard_paths = [os.path.join(shard_dir, '{}.{:05d}{}'.format(base, k, extension)) for k in range(len(ranges))]
+    for shard_path in shard_paths:
+        remove_output(shard_path)
+
+    size_before = file_size(extractor.output_path)
+    known_keys = checked_index_path(extractor.output_path, extractor.output_format) \
+        if extractor.dedup == 'skip' else None
+    context = multiprocessing.get_context(mp_context) if mp_context else None
+    with stats.timer('shards'):
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+            futures = [pool.submit(convert_shard, extractor, filename, shard_path, start, stop, known_keys)
+                       for shard_path, (start, stop) in zip(shard_paths, ranges)]
+            for future in futures:
+                future.result()
+
+    logger.info("Merging {} shards into {}".format(len(shard_paths), extractor.output_path))
+    with stats.timer('merge'):
+        num_merged = merge_shards(shard_paths, extractor.output_path, extractor.output_format, extractor.dedup)
+    if extractor.index_columns:
+        with stats.timer('index'):
+            index_output(extractor.output_path, extractor.index_columns, extractor.output_format)
+    stats.event_done(num_merged)
+    stats.bytes_written += file_size(extractor.output_path) - size_before
+
+    if not keep_shards:
+        for shard_path in shard_paths:
+            remove_output(shard_path)
+        if not os.listdir(shard_dir):
+            shutil.rmtree(shard_dir)
+    return num_merged
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Module for running the conversion as a read -> transform -> write pipeline.
+
+The source is iterated in a reader thread and the transform runs in a
+worker thread; they are connected to the sink (run in the calling thread)
+by bounded queues, so that ROOT reading, image conversion and HDF5
+writing overlap. A full queue blocks its producer (backpressure), and an
+error in any stage stops the other stages and is re-raised to the caller.
+Items keep their source order.
+"""
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# seconds between checks of the stop flag while waiting on a queue
+_POLL = 0.1
+
+
+class _Pipeline:
+
+    def __init__(self, queue_size):
+        self.stop = threading.Event()
+        self.errors = []
+        self.queues = [queue.Queue(queue_size), queue.Queue(queue_size)]
+
+    def put(self, q, item):
+        """Put item in q, unless the pipeline is stopped first."""
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        """Get an item from q, or _STOP once the pipeline is stopped."""
+        while True:
+            try:
+                return q.get(timeout=_POLL)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return _STOP
+
+    def fail(self, error):
+        self.errors.append(error)
+        self.stop.set()
+
+    def read(self, source):
+        try:
+            for item in source:
+                if not self.put(self.queues[0], item):
+                    break
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.put(self.queues[0], _STOP)
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    def transform(self, function):
+        try:
+            while True:
+                item = self.get(self.queues[0])
+                if item is _STOP:
+                    break
+                if not self.put(self.queues[1], function(item)):
+                    break
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.put(self.queues[1], _STOP)
+
+
+def run_pipeline(source, transform, sink, queue_size=64, on_stop=None):
+    """
+    Run sink(transform(item)) for every item of source, with the three
+    stages in different threads.
+
+    :param source: iterable (e.g. a generator reading events)
+    :param transform: function applied to every item in a worker thread
+    :param sink: function consuming the transformed items in the calling thread
+    :param queue_size: capacity of each of the two queues
+    :param on_stop: function called once the stages are stopped, before
+                    waiting for them, to wake up a source blocked outside
+                    the queues (e.g. on a buffer pool)
+    :return: number of items passed to the sink
+    """
+    pipe = _Pipeline(queue_size)
+    threads = [threading.Thread(target=pipe.read, args=(iter(source),), name='pipeline-read'),
+               threading.Thread(target=pipe.transform, args=(transform,), name='pipeline-transform')]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    count = 0
+    try:
+        while True:
+            item = pipe.get(pipe.queues[1])
+            if item is _STOP:
+                break
+            sink(item)
+            count += 1
+    except BaseException:
+        pipe.stop.set()
+        raise
+    finally:
+        pipe.stop.set()
+        if on_stop is not None:
+            on_stop()
+        for thread in threads:
+            thread.join()
+
+    if pipe.errors:
+        raise pipe.errors[0]
+    return count
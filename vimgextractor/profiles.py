@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Module for HDF5 output profiles.
+
+A profile sets the compression filters, the chunk shape and the
+expected-row hints of the tables created by ImageExtractor.
+"""
+
+import tables
+
+# Compression libraries accepted in profiles (PyTables names).
+COMPLIBS = ['zlib', 'lzo', 'bzip2', 'blosc', 'blosc:blosclz', 'blosc:lz4',
+            'blosc:lz4hc', 'blosc:snappy', 'blosc:zlib', 'blosc:zstd']
+
+CHUNK_MODES = ['auto', 'batch', 'row']
+
+
+class OutputProfile:
+    """HDF5 storage settings of the output tables.
+
+    Parameters
+    ----------
+    complib : str or None
+        Compression library (see COMPLIBS), or None for no compression.
+    complevel : int
+        Compression level, 0-9.
+    shuffle : bool
+        Apply the byte-shuffle filter before compression.
+    bitshuffle : bool
+        Apply the bit-shuffle filter instead (blosc only).
+    chunk_mode : str
+        'auto' lets PyTables choose the chunk shape, 'batch' stores
+        chunk_rows images per chunk (for loaders reading batches of
+        consecutive images) and 'row' one image per chunk (for random access).
+    chunk_rows : int
+        Number of image rows per chunk in 'batch' mode.
+    expected_events : int or None
+        Hint for the number of events of the output, used to size the
+        chunks in 'auto' mode.
+    """
+
+    def __init__(self, complib=None, complevel=0, shuffle=True, bitshuffle=False,
+                 chunk_mode='auto', chunk_rows=64, expected_events=None):
+        if complib is not None and complib not in COMPLIBS:
+            raise ValueError('Invalid compression library: {}.'.format(complib))
+        if not 0 <= complevel <= 9:
+            raise ValueError('Invalid compression level: {}.'.format(complevel))
+        if chunk_mode not in CHUNK_MODES:
+            raise ValueError('Invalid chunk mode: {}.'.format(chunk_mode))
+        if chunk_rows < 1:
+            raise ValueError('Invalid number of rows per chunk: {}.'.format(chunk_rows))
+        self.complib = complib
+        self.complevel = complevel if complib is not None else 0
+        self.shuffle = shuffle
+        self.bitshuffle = bitshuffle
+        self.chunk_mode = chunk_mode
+        self.chunk_rows = chunk_rows
+        self.expected_events = expected_events
+
+    def copy(self, **overrides):
+        """Return a copy of the profile with some settings replaced."""
+        settings = dict(vars(self))
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        if overrides.get('complib') is not None and overrides.get('complevel') is None:
+            settings['complevel'] = settings['complevel'] or 5
+        return OutputProfile(**settings)
+
+    def filters(self):
+        """tables.Filters of the profile, or None for PyTables defaults."""
+        if self.complib is None:
+            return None
+        return tables.Filters(complevel=self.complevel, complib=self.complib,
+                              shuffle=self.shuffle and not self.bitshuffle,
+                              bitshuffle=self.bitshuffle)
+
+    def table_kwargs(self, rows_per_event=1, image_table=False):
+        """
+        Keyword arguments for File.create_table.
+
+        :param rows_per_event: expected number of rows per event in the table
+        :param image_table: the chunk mode applies to image tables only
+        """
+        kwargs = {}
+        filters = self.filters()
+        if filters is not None:
+            kwargs['filters'] = filters
+        if self.expected_events is not None:
+            kwargs['expectedrows'] = max(1, int(self.expected_events * rows_per_event))
+        if image_table:
+            if self.chunk_mode == 'batch':
+                kwargs['chunkshape'] = (self.chunk_rows,)
+            elif self.chunk_mode == 'row':
+                kwargs['chunkshape'] = (1,)
+        return kwargs
+
+
+OUTPUT_PROFILES = {
+    # PyTables defaults: no compression, automatic chunk shape
+    'default': OutputProfile(),
+    # training loaders reading batches of consecutive images
+    'training': OutputProfile(complib='blosc:lz4', complevel=5, shuffle=True,
+                              chunk_mode='batch', chunk_rows=64),
+    # random access to single images
+    'random_access': OutputProfile(complib='blosc:lz4', complevel=3, shuffle=True,
+                                   chunk_mode='row'),
+    # smallest files, for storage and transfer
+    'archive': OutputProfile(complib='blosc:zstd', complevel=7, bitshuffle=True,
+                             chunk_mode='batch', chunk_rows=256),
+}
+
+
+def get_output_profile(profile='default', **overrides):
+    """
+    :param profile: name of a profile in OUTPUT_PROFILES, or an OutputProfile
+    :param overrides: settings replacing those of the profile (None is ignored)
+    :return: OutputProfile
+    """
+    if isinstance(profile, OutputProfile):
+        return profile.copy(**overrides)
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError('Invalid output profile: {}.'.format(profile))
+    return OUTPUT_PROFILES[profile].copy(**overrides)
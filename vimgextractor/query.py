@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Module for selecting events of converted files without reading Event_Info whole.
+
+The Event_Info columns most used to select events (INDEX_COLUMNS) can be
+given completely sorted (CSI) PyTables indexes after a conversion (see
+the index_columns option of ImageExtractor), so that a condition such as
+
+    '(mc_energy > 0.3) & (mc_energy < 1.) & (num_images >= 2)'
+
+is answered from the indexes instead of a scan of the table. Conditions
+are numexpr expressions on the Event_Info columns, as for
+tables.Table.read_where; conditions on columns without an index are
+answered with an in-kernel scan.
+
+npy array stores have no indexes: their conditions are evaluated with
+numexpr on the memory-mapped shards of the referenced columns.
+
+ImageReader.query returns the images of the matching events (see
+vimgextractor.reader).
+"""
+
+import logging
+
+import numpy as np
+import tables
+
+from vimgextractor.arraystore import open_output
+
+logger = logging.getLogger(__name__)
+
+INDEX_COLUMNS = ['mc_energy', 'run_number', 'particle_id', 'alt', 'az', 'num_images']
+
+
+def create_indexes(f, columns=INDEX_COLUMNS):
+    """
+    Create (or complete) CSI indexes of Event_Info columns of an HDF5 file.
+
+    Existing indexes are kept up to date by PyTables when rows are
+    appended, so they are only rebuilt if they are dirty (e.g. rows modified
+    with Table.autoindex off). The rows appended to a CSI index are no
+    longer completely sorted, which Table.reindex() restores at the cost of
+    a full rebuild.
+
+    :param f: open tables.File or ArrayStore (which has no indexes)
+    :param columns: Event_Info columns to index
+    :return: names of the columns indexed
+    """
+    if '/Event_Info' not in f:
+        return []
+    table = f.root.Event_Info
+    if not isinstance(table, tables.Table):
+        logger.info('No column indexes in npy array stores, queries scan Event_Info')
+        return []
+    indexed = []
+    for name in columns:
+        if name not in table.colnames:
+            logger.warning('Cannot index Event_Info column {}: no such column'.format(name))
+            continue
+        column = table.colinstances[name]
+        if not column.is_indexed:
+            column.create_csindex()
+        elif column.index.dirty:
+            column.reindex_dirty()
+        indexed.append(name)
+    table.flush()
+    return indexed
+
+
+def index_output(output_path, columns=INDEX_COLUMNS, output_format='hdf5'):
+    """Create (or complete) the Event_Info indexes of a closed output file."""
+    with open_output(output_path, mode='a', output_format=output_format) as f:
+        return create_indexes(f, columns)
+
+
+def where(table, condition, condvars=None):
+    """
+    :param table: Event_Info table of a tables.File or ArrayStore
+    :param condition: numexpr condition on the columns of the table
+    :param condvars: values of the other variables of the condition
+    :return: sorted row numbers of the rows satisfying the condition
+    """
+    return np.asarray(table.get_where_list(condition, condvars=condvars, sort=True), dtype=np.int64)
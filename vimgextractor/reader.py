@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Module for reading converted files in batches, e.g. to feed training jobs.
+
+ImageReader follows the *_indices (tel_type mode) or indices (tel_id mode)
+columns of Event_Info into the image tables and returns, for a batch of
+events, the stacked images of dimension (batch, tels) + image shape, the
+trigger mask and the Event_Info label columns. Index 0 (the blank image
+row of untriggered telescopes) is not read: its images are zeros.
+
+The rows needed by a batch are sorted and read as contiguous slices (rows
+closer than max_gap are read together), and iterating over a reader can
+shuffle the events by chunks of consecutive events and prefetch batches in
+worker processes. Dense (1D/2D) and sparse image tables are supported, in
+HDF5 files and npy array stores, and pixel images can be mapped to square
+images on the fly with any method of vimgextractor.mapping.
+
+query reads the events satisfying a condition on the Event_Info columns
+(answered from the column indexes of the file, see vimgextractor.query),
+in batches of sorted rows.
+"""
+
+import atexit
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tables
+
+import vimgextractor.sparse as sparse
+import vimgextractor.image as image
+from vimgextractor.arraystore import ArrayStore
+from vimgextractor.mapping import get_mapping
+from vimgextractor.parallel import _image_tables
+from vimgextractor.query import where
+
+# Event_Info columns returned with the images by default
+DEFAULT_LABELS = ['event_number', 'run_number', 'particle_id', 'core_x', 'core_y',
+                  'mc_energy', 'alt', 'az']
+
+
+def coalesce(rows, max_gap=0):
+    """
+    Group sorted unique rows into slices.
+
+    :param rows: sorted unique row numbers
+    :param max_gap: rows at most max_gap apart are read in the same slice
+    :return: list of (start, stop) slices, stop exclusive
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return []
+    splits = np.flatnonzero(np.diff(rows) > max_gap + 1) + 1
+    starts = np.concatenate([rows[:1], rows[splits]])
+    stops = np.concatenate([rows[splits - 1], rows[-1:]]) + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def read_rows(table, rows, field=None, max_gap=64):
+    """
+    Read rows of a table (in any order, with repeats) with coalesced slice reads.
+
+    :return: numpy array of the rows (or of one field) in the order of rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    unique, inverse = np.unique(rows, return_inverse=True)
+    parts = []
+    for start, stop in coalesce(unique, max_gap):
+        block = table.read(start, stop, field=field)
+        parts.append(block[unique[(unique >= start) & (unique < stop)] - start])
+    if not parts:
+        return table.read(0, 0, field=field)
+    return np.concatenate(parts)[inverse]
+
+
+def open_file(path):
+    """Open a converted HDF5 file or npy array store for reading."""
+    if os.path.isdir(path):
+        return ArrayStore(path, mode='r')
+    return tables.open_file(path, mode='r')
+
+
+class ImageReader:
+    """Batched reader of the images and labels of a converted file.
+
+    Parameters
+    ----------
+    path : str
+        HDF5 file or npy array store written by ImageExtractor.
+    tel_type : str
+        Telescope type of the images (tel_type storage mode).
+    labels : list of str
+        Event_Info columns returned with the images.
+    peak_times : bool
+        Also return the peak time images (1D and sparse modes).
+    max_gap : int
+        Rows closer than max_gap are read in one slice.
+    mapping : str or None
+        Camera mapping method (see vimgextractor.mapping) turning the pixel
+        images of 1D and sparse files into square images, None to return
+        the stored images.
+    """
+
+    def __init__(self, path, tel_type='VTS', labels=DEFAULT_LABELS, peak_times=False, max_gap=64,
+                 mapping=None):
+        self.path = path
+        self.tel_type = tel_type
+        self.labels = list(labels)
+        self.peak_times = peak_times
+        self.max_gap = max_gap
+        self.mapping = mapping
+        self.h5file = open_file(path)
+        events = self.h5file.get_node('/Event_Info')
+        self.num_events = events.nrows
+        if tel_type + '_indices' in events.colnames:
+            self.index_column = tel_type + '_indices'
+            self.image_tables = [tel_type]
+        elif 'indices' in events.colnames:
+            self.index_column = 'indices'
+            self.image_tables = _image_tables(self.h5file)
+        else:
+            raise ValueError('Invalid file, no image indices in Event_Info: {}.'.format(path))
+
+        table = self.h5file.get_node('/' + self.image_tables[0])
+        if 'pixel_offset' in table.colnames:
+            self.img_mode = 'sparse'
+            group = self.h5file.get_node('/' + sparse.sparse_group_name(self.image_tables[0]))
+            self.image_shape = (int(group._v_attrs.num_pixels),)
+            self.dtype = group._f_get_child('charge').dtype
+            self.image_field = None
+        else:
+            self.image_field = 'image' if 'image' in table.colnames else 'image_charge'
+            self.img_mode = '2D' if self.image_field == 'image' else '1D'
+            self.image_shape = table.dtype[self.image_field].shape
+            self.dtype = table.dtype[self.image_field].base
+        if peak_times and self.img_mode == '2D':
+            raise ValueError('Invalid option: no peak time images in 2D mode.')
+        self.camera_mapping = None
+        if mapping is not None:
+            if self.image_shape != (image.TEL_NUM_PIXELS[tel_type],):
+                raise ValueError('Invalid option: mapping needs {} pixel images.'.format(
+                    image.TEL_NUM_PIXELS[tel_type]))
+            self.camera_mapping = get_mapping(mapping, image.IMAGE_SHAPES[tel_type][0], self.image_shape[0])
+
+    def close(self):
+        self.h5file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.num_events
+
+    def _read_images(self, name, rows):
+        """(charge, peak_times or None) of non-zero image rows of a table."""
+        if self.img_mode == 'sparse':
+            charge, peak_times = sparse.read_sparse_images(self.h5file, name, rows,
+                                                           max_gap=self.max_gap * self.image_shape[0])
+            return charge, (peak_times if self.peak_times else None)
+        table = self.h5file.get_node('/' + name)
+        if self.peak_times:
+            block = read_rows(table, rows, max_gap=self.max_gap)
+            return block[self.image_field], block['image_peak_times']
+        return read_rows(table, rows, field=self.image_field, max_gap=self.max_gap), None
+
+    def read_batch(self, event_rows):
+        """
+        Read the images and labels of Event_Info rows.
+
+        :param event_rows: Event_Info row numbers, in the order of the batch
+        :return: dict with 'images' (batch, tels) + image shape, 'peak_times'
+                 (if requested), 'triggered' (batch, tels) bool, 'event_rows',
+                 'image_rows' (batch, tels), the rows of the images in their
+                 tables (0 for none), and one array per label column
+        """
+        event_rows = np.asarray(event_rows, dtype=np.int64)
+        events = read_rows(self.h5file.get_node('/Event_Info'), event_rows, max_gap=self.max_gap)
+        indices = events[self.index_column].reshape(len(event_rows), -1)
+        n_tels = indices.shape[1]
+
+        shape = (len(event_rows), n_tels) + self.image_shape
+        images = np.zeros(shape, dtype=self.dtype)
+        peak_times = np.zeros(shape, dtype=self.dtype) if self.peak_times else None
+        triggered = indices > 0
+        for j in range(n_tels):
+            name = self.image_tables[0] if len(self.image_tables) == 1 else self.image_tables[j]
+            for_table = np.flatnonzero(triggered[:, j])
+            if len(for_table) == 0:
+                continue
+            charge, times = self._read_images(name, indices[for_table, j])
+            images[for_table, j] = charge.reshape((len(for_table),) + self.image_shape)
+            if peak_times is not None:
+                peak_times[for_table, j] = times.reshape((len(for_table),) + self.image_shape)
+
+        if self.camera_mapping is not None:
+            images = self.camera_mapping.apply(images, dtype=self.dtype)
+            if peak_times is not None:
+                peak_times = self.camera_mapping.apply(peak_times, dtype=self.dtype, normalize=True)
+
+        out = {'event_rows': event_rows, 'image_rows': indices, 'images': images, 'triggered': triggered}
+        if peak_times is not None:
+            out['peak_times'] = peak_times
+        for label in self.labels:
+            out[label] = events[label]
+        return out
+
+    def batch_order(self, batch_size, shuffle=False, chunk_size=None, seed=None,
+                    start=0, stop=None, drop_last=False):
+        """
+        Split the events [start, stop) into batches of Event_Info rows.
+
+        With shuffle, the events are split into chunks of chunk_size
+        consecutive events; the chunks are visited in random order and the
+        events are shuffled within each chunk, so that a batch only touches
+        one or two chunks of the file.
+
+        :return: list of arrays of Event_Info rows
+        """
+        stop = self.num_events if stop is None else min(stop, self.num_events)
+        rows = np.arange(start, stop)
+        if shuffle:
+            rng = np.random.default_rng(seed)
+            chunk_size = chunk_size or 16 * batch_size
+            chunks = [rows[k:k + chunk_size] for k in range(0, len(rows), chunk_size)]
+            rows = np.concatenate([rng.permutation(chunks[k]) for k in rng.permutation(len(chunks))]) \
+                if chunks else rows
+        batches = [rows[k:k + batch_size] for k in range(0, len(rows), batch_size)]
+        if drop_last and batches and len(batches[-1]) < batch_size:
+            batches.pop()
+        return batches
+
+    def iter_batches(self, batch_size=64, shuffle=False, chunk_size=None, seed=None,
+                     start=0, stop=None, drop_last=False, workers=0, prefetch=2, mp_context='spawn'):
+        """
+        Iterate over batches (see read_batch) of the events [start, stop).
+
+        :param workers: number of worker processes reading batches ahead,
+                        0 to read in the calling process
+        :param prefetch: number of batches queued per worker
+        """
+        batches = self.batch_order(batch_size, shuffle=shuffle, chunk_size=chunk_size, seed=seed,
+                                   start=start, stop=stop, drop_last=drop_last)
+        if workers <= 0:
+            for rows in batches:
+                yield self.read_batch(rows)
+            return
+
+        config = dict(path=self.path, tel_type=self.tel_type, labels=self.labels,
+                      peak_times=self.peak_times, max_gap=self.max_gap, mapping=self.mapping)
+        context = multiprocessing.get_context(mp_context) if mp_context else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(config,)) as pool:
+            pending = deque()
+            batches = iter(batches)
+            for rows in batches:
+                pending.append(pool.submit(_read_batch, rows))
+                if len(pending) >= workers * prefetch:
+                    break
+            while pending:
+                batch = pending.popleft().result()
+                for rows in batches:
+                    pending.append(pool.submit(_read_batch, rows))
+                    break
+                yield batch
+
+    def __iter__(self):
+        return self.iter_batches()
+
+    def where(self, condition, condvars=None):
+        """
+        :param condition: numexpr condition on the Event_Info columns, e.g.
+                          '(mc_energy > 1.) & (run_number == 77)'
+        :param condvars: values of the other variables of the condition
+        :return: sorted Event_Info rows of the events satisfying the condition
+        """
+        return where(self.h5file.get_node('/Event_Info'), condition, condvars)
+
+    def query(self, condition, batch_size=64, condvars=None):
+        """
+        Iterate over batches (see read_batch) of the events satisfying a
+        condition (see where), in Event_Info order.
+        """
+        rows = self.where(condition, condvars)
+        for k in range(0, len(rows), batch_size):
+            yield self.read_batch(rows[k:k + batch_size])
+
+
+_worker_reader = None
+
+
+def _init_worker(config):
+    global _worker_reader
+    _worker_reader = ImageReader(**config)
+    atexit.register(_worker_reader.close)
+
+
+def _read_batch(rows):
+    return _worker_reader.read_batch(rows)
@@ -1,8 +1,7 @@
-import ROOT
-from ROOT import gSystem,gROOT
 import contextlib
 @contextlib.contextmanager
 def CppPrintContext(verbose=True):
+    from ROOT import gROOT
     if(not verbose):
         gROOT.ProcessLine("std::cout.setstate(std::ios_base::failbit)")
     else:
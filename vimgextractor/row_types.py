@@ -5,7 +5,7 @@ the output file.
 
 """
 
-from tables import (IsDescription, UInt32Col, UInt8Col,
+from tables import (IsDescription, UInt32Col, UInt8Col, Int64Col,
                     Float64Col, Float32Col, StringCol)
 
 
@@ -41,6 +41,9 @@ class Event(IsDescription):
         Float32 placeholder type for the shower azimuth angle.
     alt : Float32Col
         Float32 placeholder type for the shower altitude (zenith) angle
+    num_images : UInt8Col
+        UInt8 placeholder type for the number of telescope images stored
+        for the event (the event multiplicity)
     """
     event_number = UInt32Col()
     run_number = UInt32Col()
@@ -51,6 +54,7 @@ class Event(IsDescription):
     mc_energy = Float32Col()
     az = Float32Col()
     alt = Float32Col()
+    num_images = UInt8Col()
 
 
 class Tel(IsDescription):
@@ -105,3 +109,27 @@ class Array(IsDescription):
     tel_z = Float32Col()
     tel_type = StringCol(8)
     run_array_direction = Float32Col(2)
+
+
+class Manifest(IsDescription):
+    """Row descriptor class for Pytables conversion manifest table.
+
+    Contains one row for each input file (or entry range of an input file)
+    whose events have been written to the output file.
+
+    Attributes
+    ----------
+    input_file : StringCol
+        String placeholder type for the absolute path of the stage 2 file
+    start_event : Int64Col
+        Int64 placeholder type for the first requested entry (-1 if unset)
+    stop_event : Int64Col
+        Int64 placeholder type for the last requested entry (-1 if unset)
+    num_events : UInt32Col
+        UInt32 placeholder type for the number of events written
+    """
+
+    input_file = StringCol(1024)
+    start_event = Int64Col()
+    stop_event = Int64Col()
+    num_events = UInt32Col()
@@ -0,0 +1,46 @@
+import click
+import logging
+
+from vimgextractor.script.convert import add_dir_name,conversion_options,build_extractor
+from vimgextractor.instrument import save_report
+
+
+logger = logging.getLogger(__name__)
+
+@click.command()
+@click.argument('vegas_st2_files',nargs=-1,type=str)
+@click.option('--output','-o','output_file',nargs=1,type=click.Path(exists=False),required=True)
+@click.option('--file-list','-l',nargs=1,type=click.Path(exists=True),default=None,help='Text file with one stage 2 file (or glob pattern) per line.')
+@click.option('--nevt','-n',nargs=1,type=int,help='Maximum number of events converted per file.')
+@click.option('--start-event',nargs=1,type=int,default=None,help='First entry of the calibrated event tree of each file to convert.')
+@click.option('--stop-event',nargs=1,type=int,default=None,help='Last entry of the calibrated event tree of each file to convert (inclusive).')
+@click.option('--workers','-j',nargs=1,type=int,default=1,help='Number of files converted concurrently.')
+@conversion_options
+@click.option('--report',nargs=1,type=click.Path(),default=None,help='Write the run statistics (merge times, events/s, bytes written, peak RSS) as JSON to this file.')
+@click.option('--debug','-d',is_flag=True,default=False)
+def cli(vegas_st2_files,output_file,file_list,nevt,start_event,stop_event,workers,report,debug,**options):
+    """
+    Convert many VEGAS stage 2 files (paths or glob patterns) into OUTPUT.
+    Files already recorded in the manifest of OUTPUT are skipped, so an
+    interrupted batch can simply be rerun.
+    """
+    if(debug):
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    inputs = list(vegas_st2_files)
+    if(file_list is not None):
+        with open(file_list) as fl:
+            inputs += [line.strip() for line in fl if line.strip() and not line.startswith('#')]
+    if(len(inputs) == 0):
+        raise click.UsageError('No input file given.')
+
+    output_file = add_dir_name(output_file)
+    ext = build_extractor(output_file,**options)
+    try:
+        ext.process_batch(inputs,n_workers=workers,max_events=nevt,
+                          start_event=start_event,stop_event=stop_event)
+    finally:
+        if(report is not None and ext.stats is not None):
+            save_report(ext.stats.report(),report)
@@ -0,0 +1,71 @@
+import click
+import logging
+import os
+
+from vimgextractor.benchmark import (BENCHMARKS, DEFAULT_TOLERANCE, run_benchmarks,
+                                     save_report, load_report, compare_reports)
+
+
+logger = logging.getLogger(__name__)
+
+def format_bytes(n):
+    if(n is None):
+        return '-'
+    for unit in ['B','KiB','MiB']:
+        if(n < 1024):
+            return '{:.0f} {}'.format(n,unit)
+        n /= 1024.
+    return '{:.1f} GiB'.format(n)
+
+@click.command()
+@click.argument('names',nargs=-1,type=click.Choice(list(BENCHMARKS)))
+@click.option('--baseline','-b',type=click.Path(),default='benchmarks/baseline.json',show_default=True,
+              help='Baseline report to compare against (skipped if it does not exist).')
+@click.option('--save-baseline',is_flag=True,default=False,help='Write the results to the baseline file instead of comparing.')
+@click.option('--output','-o',type=click.Path(),default=None,help='Also write the JSON report to this file.')
+@click.option('--tolerance',type=click.FloatRange(0,1),default=DEFAULT_TOLERANCE,show_default=True,
+              help='Relative drop of throughput reported as a regression.')
+@click.option('--scale',type=click.FloatRange(min=0,min_open=True),default=1.0,show_default=True,
+              help='Factor applied to the amount of work of each benchmark.')
+@click.option('--repeat','-r',type=click.IntRange(min=1),default=3,show_default=True,help='Timed runs per benchmark (best is kept).')
+@click.option('--no-memory',is_flag=True,default=False,help='Skip the peak memory measurement.')
+@click.option('--debug','-d',is_flag=True,default=False)
+def cli(names,baseline,save_baseline,output,tolerance,scale,repeat,no_memory,debug):
+    """
+    Benchmark the conversion hot paths on synthetic events (all benchmarks
+    unless NAMES are given). Exits with status 1 if a throughput dropped
+    by more than the tolerance with respect to the baseline.
+    """
+    if(debug):
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    def show(name,result):
+        click.echo('{:<20s} {:>12.1f} {:<10s} peak mem {:>10s}'.format(
+            name,result['throughput'],result['unit']+'/s',format_bytes(result['peak_memory'])))
+
+    report = run_benchmarks(names or None,scale=scale,repeat=repeat,memory=not no_memory,callback=show)
+    click.echo('peak RSS of the process: {}'.format(format_bytes(report['peak_rss'])))
+
+    if(output is not None):
+        save_report(report,output)
+    if(save_baseline):
+        if(os.path.dirname(baseline)):
+            os.makedirs(os.path.dirname(baseline),exist_ok=True)
+        save_report(report,baseline)
+        click.echo('Baseline written to {}'.format(baseline))
+        return
+    if(not os.path.exists(baseline)):
+        click.echo('No baseline at {}, nothing to compare.'.format(baseline))
+        return
+
+    regressed = []
+    click.echo('\ncomparison with {}:'.format(baseline))
+    for name,value,ref,ratio,slower in compare_reports(report,load_report(baseline),tolerance):
+        click.echo('{:<20s} {:>12.1f} vs {:>12.1f}  x{:.2f}{}'.format(
+            name,value,ref,ratio,'  REGRESSION' if slower else ''))
+        if(slower):
+            regressed.append(name)
+    if(regressed):
+        raise click.ClickException('{} benchmarks regressed: {}'.format(len(regressed),', '.join(regressed)))
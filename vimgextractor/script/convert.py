@@ -3,6 +3,14 @@ import click
 import logging
 import os
 
+from vimgextractor.arraystore import OUTPUT_FORMATS
+from vimgextractor.mapping import MAPPING_METHODS
+from vimgextractor.profiles import OUTPUT_PROFILES,COMPLIBS,CHUNK_MODES,get_output_profile
+from vimgextractor.dedup import DEDUP_POLICIES
+from vimgextractor.query import INDEX_COLUMNS
+from vimgextractor.sources import SYNTHETIC_PREFIX,BACKENDS,EXPERIMENTAL_BACKENDS
+from vimgextractor.instrument import PROFILERS,profiled,save_report
+from vimgextractor.selection import HEADER_CUTS,IMAGE_CUTS,Selection
 
 
 logger = logging.getLogger(__name__)
@@ -13,13 +21,92 @@ def add_dir_name(fname):
     else:
         return fname
 
+def parse_cuts(ctx,param,value):
+    """Click callback turning the --cut values into a Selection (or None)."""
+    if(not value):
+        return None
+    try:
+        return Selection(list(value))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+CUT_HELP = ('Convert only the events within NAME:MIN:MAX (inclusive, empty for no bound), e.g. n_tels:2: '
+            'or mc_energy:0.3:30; can be repeated. Header cuts ({}) are applied before the channel data '
+            'is read, image cuts ({}) before writing.'.format(', '.join(HEADER_CUTS),', '.join(IMAGE_CUTS)))
+
+# options of the converted images and of the output, shared by the single file and batch converters
+CONVERSION_OPTIONS = [
+    click.option('--oversampled','-s',is_flag=True,default=False),
+    click.option('--mapping',type=click.Choice(MAPPING_METHODS),default='oversampling',show_default=True,
+                 help='Camera mapping of the oversampled images.'),
+    click.option('--output-profile','-p',type=click.Choice(sorted(OUTPUT_PROFILES)),default='default',
+                 help='HDF5 compression and chunking profile of the output tables.'),
+    click.option('--complib',type=click.Choice(COMPLIBS),default=None,help='Override the compression library of the profile.'),
+    click.option('--complevel',type=click.IntRange(0,9),default=None,help='Override the compression level of the profile.'),
+    click.option('--chunk-rows',type=click.IntRange(min=1),default=None,help='Images per chunk (batch chunk mode).'),
+    click.option('--chunk-mode',type=click.Choice(CHUNK_MODES),default=None,help='Override the chunk mode of the profile.'),
+    click.option('--expected-events',type=click.IntRange(min=1),default=None,help='Expected number of events, used to size chunks.'),
+    click.option('--format','output_format',type=click.Choice(OUTPUT_FORMATS),default='hdf5',show_default=True,
+                 help='Output format: an HDF5 file, or an npy array-store directory.'),
+    click.option('--sparse','sparse_images',is_flag=True,default=False,help='Store only the non-zero pixels of each image.'),
+    click.option('--clean',nargs=2,type=float,default=None,metavar='PICTURE BOUNDARY',help='Apply two-threshold cleaning with these SNR thresholds.'),
+    click.option('--pipeline','pipelined',is_flag=True,default=False,help='Overlap reading, image conversion and writing in separate threads.'),
+    click.option('--progress',nargs=1,type=click.FloatRange(min=0,min_open=True),default=60.,show_default=True,
+                 help='Seconds between progress messages.'),
+    click.option('--backend',type=click.Choice(BACKENDS),default='python',show_default=True,
+                 help='Stage 2 reading backend: python entry loop, RDataFrame with C++ decoding and cleaning, or uproot '
+                      '(no ROOT or VEGAS needed). Experimental, not yet checked on real stage 2 files: {}.'.format(
+                          ', '.join(EXPERIMENTAL_BACKENDS))),
+    click.option('--threads',nargs=1,type=click.IntRange(min=0),default=None,
+                 help='Enable ROOT implicit multithreading with this many threads (0 for all cores).'),
+    click.option('--cut','selection',multiple=True,metavar='NAME:MIN:MAX',callback=parse_cuts,help=CUT_HELP),
+    click.option('--dedup',type=click.Choice(DEDUP_POLICIES),default='skip',show_default=True,
+                 help='Events already in the output file (same run and event number): skip them before decoding, replace them, or append them again.'),
+    click.option('--index',is_flag=True,default=False,
+                 help='Index the Event_Info columns {} for fast queries (HDF5 output).'.format(', '.join(INDEX_COLUMNS))),
+]
+
+def conversion_options(func):
+    """Decorator adding the CONVERSION_OPTIONS to a click command."""
+    for option in reversed(CONVERSION_OPTIONS):
+        func = option(func)
+    return func
+
+def build_extractor(output_file,oversampled,mapping,output_profile,complib,complevel,chunk_rows,chunk_mode,
+                    expected_events,output_format,sparse_images,clean,pipelined,progress,backend,threads,
+                    selection,dedup,index):
+    """ImageExtractor of the output file configured by the CONVERSION_OPTIONS values."""
+    if(backend in EXPERIMENTAL_BACKENDS):
+        logger.warning('The {} backend is experimental: its events have not yet been compared with those of the '
+                       'python backend on real stage 2 files.'.format(backend))
+    # ROOT and VEGAS are only loaded once a stage 2 file is opened
+    import vimgextractor.image_extractor as image_extractor
+    return image_extractor.ImageExtractor(output_file,storage_mode="tel_type",
+                                          img_mode="sparse" if sparse_images else "1D",force_all_telescopes=False,
+                                          cleaning={'img':clean[0],'brd':clean[1]} if clean else None,
+                                          pipelined=pipelined,output_format=output_format,progress_interval=progress,
+                                          one_D_image_oversampled=oversampled,mapping=mapping,
+                                          source_options={'backend':backend,'threads':threads},
+                                          selection=selection,dedup=dedup,
+                                          index_columns=INDEX_COLUMNS if index else None,
+                                          output_profile=get_output_profile(output_profile,complib=complib,
+                                                                            complevel=complevel,chunk_rows=chunk_rows,
+                                                                            chunk_mode=chunk_mode,
+                                                                            expected_events=expected_events))
+
 @click.command()
-@click.argument('vegas_st2_file',nargs=1,type=click.Path(exists=True))
+@click.argument('vegas_st2_file',nargs=1,type=str)
 @click.argument('output_file',nargs=1,type=click.Path(exists=False))
 @click.option('--nevt','-n',nargs=1,type=int)
-@click.option('--oversampled','-s',is_flag=True,default=False)
+@click.option('--start-event',nargs=1,type=int,default=None,help='First entry of the calibrated event tree to convert.')
+@click.option('--stop-event',nargs=1,type=int,default=None,help='Last entry of the calibrated event tree to convert (inclusive).')
+@click.option('--workers','-j',nargs=1,type=int,default=1,help='Number of worker processes.')
+@conversion_options
+@click.option('--report',nargs=1,type=click.Path(),default=None,help='Write the run statistics (stage times, events/s, bytes written, peak RSS) as JSON to this file.')
+@click.option('--profile','profiler',type=click.Choice(PROFILERS),default=None,help='Run the conversion under cProfile or tracemalloc.')
+@click.option('--profile-output',nargs=1,type=click.Path(),default=None,help='Profiler output file, defaults to OUTPUT_FILE.prof or OUTPUT_FILE.tracemalloc.txt.')
 @click.option('--debug','-d',is_flag=True,default=False)
-def cli(vegas_st2_file,output_file,nevt,oversampled,debug):
+def cli(vegas_st2_file,output_file,nevt,start_event,stop_event,workers,report,profiler,profile_output,debug,**options):
     if(debug):
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -27,16 +114,23 @@ def cli(vegas_st2_file,output_file,nevt,oversampled,debug):
 
     logger  = logging.getLogger(__name__)
 
-    import vimgextractor.image_extractor as image_extractor
-
     output_file = add_dir_name(output_file)
-    vegas_st2_file = add_dir_name(vegas_st2_file)
-    ext = image_extractor.ImageExtractor(output_file,storage_mode="tel_type",
-                                         img_mode="1D",force_all_telescopes=False,
-                                         one_D_image_oversampled=oversampled)
+    if(not vegas_st2_file.startswith(SYNTHETIC_PREFIX)):
+        if(not os.path.exists(vegas_st2_file)):
+            raise click.BadParameter('File {} does not exist.'.format(vegas_st2_file),param_hint='VEGAS_ST2_FILE')
+        vegas_st2_file = add_dir_name(vegas_st2_file)
 
-    if(nevt is not None):
-        ext.process_data(vegas_st2_file,max_events=nevt)
-    else:
-        ext.process_data(vegas_st2_file)
+    ext = build_extractor(output_file,**options)
+
+    if(profiler is not None and profile_output is None):
+        profile_output = output_file + ('.prof' if profiler == 'cprofile' else '.tracemalloc.txt')
+    with profiled(profiler,profile_output):
+        if(workers > 1):
+            ext.process_data_parallel(vegas_st2_file,workers,max_events=nevt,
+                                      start_event=start_event,stop_event=stop_event)
+        else:
+            ext.process_data(vegas_st2_file,max_events=nevt,
+                             start_event=start_event,stop_event=stop_event)
+    if(report is not None):
+        save_report(ext.stats.report(),report)
     
@@ -0,0 +1,47 @@
+import click
+import logging
+
+from vimgextractor.validation import is_identical, validate_file, validate_uproot_fixture
+
+
+logger = logging.getLogger(__name__)
+
+@click.command()
+@click.argument('vegas_st2_file',type=click.Path(exists=True),required=False)
+@click.option('--nevt','-n',type=click.IntRange(min=1),default=200,show_default=True,
+              help='Number of entries compared.')
+@click.option('--start-event',type=click.IntRange(min=0),default=0,show_default=True,
+              help='First entry compared (with VEGAS_ST2_FILE).')
+@click.option('--backend',type=click.Choice(['uproot','rdf']),default='uproot',show_default=True,
+              help='Backend compared with the python backend (rdf needs VEGAS_ST2_FILE).')
+@click.option('--chunk-size',type=click.IntRange(min=1),default=64,show_default=True,
+              help='Entries read at a time by the uproot reader.')
+@click.option('--debug','-d',is_flag=True,default=False)
+def cli(vegas_st2_file,nevt,start_event,backend,chunk_size,debug):
+    """
+    Check that the uproot reader (or the rdf backend) yields the same headers
+    and events as a reference. With VEGAS_ST2_FILE (which needs ROOT and
+    VEGAS) the reference is the python backend on the same file, which also
+    checks the default tree and branch names of the uproot reader; without
+    it, a fixture written from synthetic events is compared with the
+    synthetic source (uproot only). Exits with status 1 if they differ.
+    """
+    if(debug):
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    if(vegas_st2_file is None):
+        if(backend != 'uproot'):
+            raise click.UsageError('--backend {} needs VEGAS_ST2_FILE.'.format(backend))
+        header_diff,results = validate_uproot_fixture(nevt,chunk_size=chunk_size)
+    else:
+        header_diff,results = validate_file(vegas_st2_file,backend,start_event,start_event+nevt-1,
+                                            chunk_size=chunk_size)
+
+    click.echo('headers: {}'.format('identical' if not header_diff else 'differ in ' + ', '.join(header_diff)))
+    for options,result in results:
+        click.echo('{}: {}'.format(options,', '.join('{} {}'.format(k,v) for k,v in result.items())))
+    if(not is_identical(header_diff,results)):
+        raise click.ClickException('the {} backend does not yield the same events'.format(backend))
+    click.echo('identical')
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Module for selecting events during a conversion.
+
+A Selection holds range cuts of two kinds:
+
+* header cuts, on values known from the headers of the entries (see
+  EventSource.read_headers), evaluated on the header arrays of the whole
+  entry range before any channel data is read, so that the rejected
+  entries are never decoded:
+
+    n_tels        : number of L2 triggered telescopes (among the converted ones)
+    mc_energy     : simulated energy (TeV)
+    core_x, core_y: simulated core position (m), as in Event_Info
+    core_distance : distance of the core to the array centre (m)
+    alt, az       : simulated direction (rad)
+
+  The simulation values are those written to Event_Info, i.e. zero for
+  entries without simulation data.
+
+* image cuts, evaluated on the cleaned images before they are written:
+
+    size          : total charge (dc) of a telescope image; images out of
+                    range are written as untriggered
+    n_images      : number of images passing the size cut; events out of
+                    range are not written
+
+Cuts are inclusive (min, max) ranges, None for an open bound, and can be
+parsed from 'NAME:MIN:MAX' strings (e.g. 'n_tels:2:', 'mc_energy:0.3:30').
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HEADER_CUTS = ['n_tels', 'mc_energy', 'core_x', 'core_y', 'core_distance', 'alt', 'az']
+IMAGE_CUTS = ['size', 'n_images']
+
+
+def parse_cut(spec):
+    """
+    :param spec: 'NAME:MIN:MAX' string, with an empty MIN or MAX for an open bound
+    :return: (name, (min, max))
+    """
+    fields = spec.split(':')
+    if len(fields) != 3:
+        raise ValueError('Invalid cut: {}.'.format(spec))
+    try:
+        bounds = tuple(float(value) if value.strip() else None for value in fields[1:])
+    except ValueError:
+        raise ValueError('Invalid cut: {}.'.format(spec))
+    return fields[0].strip(), bounds
+
+
+def in_range(values, bounds):
+    """Boolean mask of the values within the inclusive (min, max) bounds."""
+    low, high = bounds
+    mask = np.ones(np.shape(values), dtype=bool)
+    if low is not None:
+        mask &= values >= low
+    if high is not None:
+        mask &= values <= high
+    return mask
+
+
+def header_values(headers, tels=None):
+    """
+    Values of the header cuts of header arrays.
+
+    :param headers: numpy array of dtype sources.HEADER_DTYPE
+    :param tels: telescope indices (id - 1) counted in n_tels, None for all
+    :return: dict of HEADER_CUTS name -> array
+    """
+    triggered = headers['triggered'] if tels is None else headers['triggered'][:, tels]
+    has_sim = headers['has_sim']
+    core_x = headers['fCoreEastM']
+    core_y = -headers['fCoreSouthM']
+    values = {'mc_energy': headers['fEnergyGeV'] / 1000.,
+              'core_x': core_x,
+              'core_y': core_y,
+              'core_distance': np.hypot(core_x, core_y),
+              'alt': (90. - headers['fPrimaryZenithDeg']) * np.pi / 180.,
+              'az': headers['fPrimaryAzimuthDeg'] * np.pi / 180.}
+    # same values as ImageExtractor.get_sim_values without simulation data
+    values = {name: np.where(has_sim, value, 0.) for name, value in values.items()}
+    values['n_tels'] = np.count_nonzero(triggered, axis=1)
+    return values
+
+
+class Selection:
+    """Header and image cuts of a conversion.
+
+    Parameters
+    ----------
+    cuts : dict or list
+        Cut name (one of HEADER_CUTS or IMAGE_CUTS) -> (min, max) bounds,
+        or list of 'NAME:MIN:MAX' strings.
+    """
+
+    def __init__(self, cuts=None):
+        if cuts is None:
+            cuts = {}
+        elif not isinstance(cuts, dict):
+            cuts = dict(parse_cut(spec) for spec in cuts)
+        self.header_cuts = {}
+        self.image_cuts = {}
+        for name, bounds in cuts.items():
+            if name in HEADER_CUTS:
+                self.header_cuts[name] = tuple(bounds)
+            elif name in IMAGE_CUTS:
+                self.image_cuts[name] = tuple(bounds)
+            else:
+                raise ValueError('Invalid cut: {}.'.format(name))
+
+    def __bool__(self):
+        return bool(self.header_cuts or self.image_cuts)
+
+    def __repr__(self):
+        return 'Selection({!r})'.format(dict(self.header_cuts, **self.image_cuts))
+
+    def select_headers(self, headers, tels=None):
+        """
+        :param headers: numpy array of dtype sources.HEADER_DTYPE
+        :param tels: telescope indices (id - 1) counted in n_tels, None for all
+        :return: boolean mask of the entries passing the header cuts
+        """
+        mask = np.ones(len(headers), dtype=bool)
+        if not self.header_cuts:
+            return mask
+        values = header_values(headers, tels)
+        for name, bounds in self.header_cuts.items():
+            mask &= in_range(values[name], bounds)
+        return mask
+
+    def pass_image(self, charge):
+        """
+        :param charge: cleaned charge vector of a telescope image
+        :return: True if the image passes the size cut
+        """
+        bounds = self.image_cuts.get('size')
+        return bounds is None or bool(in_range(np.sum(charge), bounds))
+
+    def pass_event(self, num_images):
+        """
+        :param num_images: number of images of an event passing the size cut
+        :return: True if the event passes the n_images cut
+        """
+        bounds = self.image_cuts.get('n_images')
+        return bounds is None or bool(in_range(num_images, bounds))
+
+
+def get_selection(selection):
+    """
+    :param selection: Selection, dict or list of cuts (see Selection), or None
+    :return: Selection, or None if there are no cuts
+    """
+    if selection is None or isinstance(selection, Selection):
+        return selection or None
+    return get_selection(Selection(selection))
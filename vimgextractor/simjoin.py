@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Module for joining calibrated events with their simulation data.
+
+The simulation fields of the whole simulation tree are read once as
+arrays and sorted by their (run number, array event number) key. The
+calibrated events are then matched with one sorted merge of their keys,
+so that the simulation data of every calibrated entry is a lookup in
+memory instead of a seek in the simulation tree.
+
+A join can be saved as a sidecar file next to the stage 2 file
+(<file>.simjoin.npz) and is reused as long as the stage 2 file is not
+modified.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from vimgextractor.sources import SimData
+
+logger = logging.getLogger(__name__)
+
+SIM_FIELDS = list(SimData._fields)
+
+SIM_DTYPE = np.dtype([('fRunNum', np.int64), ('fArrayEventNum', np.int64),
+                      ('fCORSIKAParticleID', np.int64),
+                      ('fCoreEastM', np.float64), ('fCoreSouthM', np.float64),
+                      ('fEnergyGeV', np.float64), ('fPrimaryZenithDeg', np.float64),
+                      ('fPrimaryAzimuthDeg', np.float64)])
+
+SIDECAR_SUFFIX = '.simjoin.npz'
+
+# bumped when the sidecar content changes
+SIDECAR_VERSION = 1
+
+
+def event_keys(run, event):
+    """
+    Combine run and array event numbers into sortable int64 keys.
+    """
+    run = np.asarray(run, dtype=np.int64)
+    event = np.asarray(event, dtype=np.int64)
+    return (run << 32) | (event & 0xffffffff)
+
+
+def sidecar_path(filename):
+    return filename + SIDECAR_SUFFIX
+
+
+def file_stamp(filename):
+    """(size, modification time in ns) identifying a version of a file."""
+    st = os.stat(filename)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+class SimJoin:
+    """Simulation data of calibrated events.
+
+    Parameters
+    ----------
+    sim : numpy structured array
+        Simulation fields (SIM_DTYPE) of the simulation tree.
+    calib_keys : numpy array or None
+        event_keys of the calibrated entries, in entry order. Without them
+        the entries are matched one by one with the keys passed to get().
+    """
+
+    def __init__(self, sim, calib_keys=None):
+        sim = np.asarray(sim, dtype=SIM_DTYPE)
+        keys = event_keys(sim['fRunNum'], sim['fArrayEventNum'])
+        # keep the first simulation entry of duplicated keys
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        if not first.all():
+            logger.warning('{} duplicated simulation events ignored'.format(np.count_nonzero(~first)))
+        self.keys = keys[first]
+        self.sim = sim[order[first]]
+        self.calib_index = None
+        if calib_keys is not None:
+            self.calib_index = self.match(calib_keys)
+
+    def match(self, keys):
+        """
+        :param keys: event_keys to look up
+        :return: row of self.sim of each key, -1 for keys without simulation data
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, pos, -1)
+
+    @property
+    def num_unmatched(self):
+        """Number of calibrated entries without simulation data, if known."""
+        if self.calib_index is None:
+            return None
+        return int(np.count_nonzero(self.calib_index < 0))
+
+    def get(self, entry, run=None, event=None):
+        """
+        Simulation data of a calibrated entry, or None if it has none.
+
+        :param entry: calibrated tree entry
+        :param run: run number of the entry, used when there are no calib_keys
+        :param event: array event number of the entry, used when there are no calib_keys
+        :return: SimData or None
+        """
+        if self.calib_index is not None:
+            k = self.calib_index[entry]
+        else:
+            k = self.match([event_keys(run, event)])[0]
+        if k < 0:
+            return None
+        return SimData(*self.sim[k].tolist())
+
+    def save(self, path, stamp):
+        """
+        Write the join to path, atomically so that concurrent readers never
+        see a partial file.
+        """
+        tmp = '{}.{}.tmp.npz'.format(path, os.getpid())
+        arrays = {'version': np.array(SIDECAR_VERSION), 'stamp': stamp, 'sim': self.sim}
+        if self.calib_index is not None:
+            arrays['calib_index'] = self.calib_index
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, stamp):
+        """
+        :return: SimJoin saved in path, or None if there is none for this stamp
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != SIDECAR_VERSION or not np.array_equal(data['stamp'], stamp):
+                    logger.info('Ignoring outdated simulation join {}'.format(path))
+                    return None
+                join = cls.__new__(cls)
+                join.sim = data['sim']
+                join.keys = event_keys(join.sim['fRunNum'], join.sim['fArrayEventNum'])
+                join.calib_index = data['calib_index'] if 'calib_index' in data else None
+        except Exception as e:
+            logger.warning('Cannot read simulation join {}: {}'.format(path, e))
+            return None
+        return join
+
+
+def cached_join(filename, build, cache=True):
+    """
+    Simulation join of a stage 2 file, loaded from its sidecar file if it
+    is up to date, otherwise built and saved in the sidecar.
+
+    :param build: function returning the SimJoin of the file
+    :param cache: use the sidecar file
+    :return: SimJoin
+    """
+    path = sidecar_path(filename) if cache else None
+    stamp = None
+    if path is not None:
+        try:
+            stamp = file_stamp(filename)
+        except OSError:
+            path = None
+    if path is not None:
+        join = SimJoin.load(path, stamp)
+        if join is not None:
+            logger.debug('Loaded simulation join from {}'.format(path))
+            return join
+
+    logger.debug('Start joining calibrated and simulation events')
+    join = build()
+    if join.num_unmatched:
+        logger.warning('{} calibrated events have no simulation data'.format(join.num_unmatched))
+    logger.debug('Done joining calibrated and simulation events')
+
+    if path is not None:
+        try:
+            join.save(path, stamp)
+        except OSError as e:
+            logger.debug('Cannot write simulation join {}: {}'.format(path, e))
+    return join
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Module for event sources.
+
+An event source provides the array information and the calibrated events
+of a run. ImageExtractor only talks to sources through the EventSource
+interface, so the conversion can run on any implementation:
+
+* VARootFile (vimgextractor.vegas_io), reading VEGAS stage 2 files with ROOT
+* UprootSource (vimgextractor.uproot_io), reading them with uproot,
+  without ROOT or VEGAS
+* SyntheticSource, a seeded generator of VERITAS-like events that needs
+  neither ROOT nor VEGAS, for tests and benchmarks
+"""
+
+import os.path as path
+from collections import namedtuple
+
+import numpy as np
+
+from vimgextractor.buffers import BufferPool, iter_slots
+from vimgextractor.cleaning import L2_CHANNELS, tailcut_clean, average_l2_channels
+from vimgextractor.instrument import NO_STATS
+
+data_dir = path.dirname(__file__) + '/data/'
+
+# Simulation fields of an event, named like the VASimulationData members.
+SimData = namedtuple('SimData', ['fRunNum', 'fArrayEventNum', 'fCORSIKAParticleID',
+                                 'fCoreEastM', 'fCoreSouthM', 'fEnergyGeV',
+                                 'fPrimaryZenithDeg', 'fPrimaryAzimuthDeg'])
+
+SYNTHETIC_PREFIX = 'synthetic:'
+
+# readers of stage 2 files: VARootFile entry loop ('python') or RDataFrame
+# graph ('rdf'), or UprootSource ('uproot')
+BACKENDS = ['python', 'rdf', 'uproot']
+
+# backends whose events have not yet been compared with those of the python
+# backend on real stage 2 files
+EXPERIMENTAL_BACKENDS = ['rdf', 'uproot']
+
+NUM_TELS = 4
+
+# Per-entry header fields of read_headers: the entry, event keys, trigger
+# mask (indexed by telescope id - 1), whether the entry has simulation data
+# and the other SimData fields (zero without simulation data).
+HEADER_DTYPE = np.dtype([('entry', np.int64), ('fRunNum', np.int64), ('fArrayEventNum', np.int64),
+                         ('triggered', bool, (NUM_TELS,)), ('has_sim', bool),
+                         ('fCORSIKAParticleID', np.int64),
+                         ('fCoreEastM', np.float64), ('fCoreSouthM', np.float64),
+                         ('fEnergyGeV', np.float64), ('fPrimaryZenithDeg', np.float64),
+                         ('fPrimaryAzimuthDeg', np.float64)])
+
+
+def header_sim_data(header):
+    """
+    :param header: row of a HEADER_DTYPE array
+    :return: SimData of the row, or None if it has no simulation data
+    """
+    if not header['has_sim']:
+        return None
+    return SimData(*[header[field].item() for field in SimData._fields])
+
+
+def triggered_tels(mask):
+    """List of the triggered telescope ids (starting at 1) of a trigger mask."""
+    return (np.flatnonzero(mask) + 1).tolist()
+
+
+class EventSource:
+    """Interface of event sources.
+
+    Events are yielded by read_events as tuples
+    (event number, sim data, charge, tzero, triggered tels) where sim data
+    has the attributes of SimData (or is None for real data), charge and
+    tzero are arrays of dimension (4, 500) indexed by telescope id - 1 and
+    channel id, and triggered tels is the list of triggered telescope ids
+    (starting at 1).
+
+    The charge and tzero arrays are views of slots of vimgextractor.buffers
+    blocks: with a recycling pool, they belong to the consumer until it
+    releases them (pool.release(), once per event in order); without a
+    pool, they are never overwritten by later events.
+    """
+
+    def get_array_info(self):
+        """
+        :return: dict of telescope id (starting at 1) -> dict with tel_id,
+                 tel_x, tel_y, tel_z, tel_type and run_array_direction
+        """
+        raise NotImplementedError
+
+    def get_num_events(self):
+        """
+        :return: number of entries that can be read
+        """
+        raise NotImplementedError
+
+    def read_headers(self, start_event=None, stop_event=None, evtlist=None, stats=None):
+        """
+        Read the headers of the entries [start_event, stop_event] (inclusive),
+        or of the entries in evtlist, without reading their channel data.
+
+        :return: numpy array of dtype HEADER_DTYPE, in increasing entry order
+        """
+        raise NotImplementedError
+
+    def read_events(self, tels=[0, 1, 2, 3], maskL2=True, l2channels=L2_CHANNELS,
+                    start_event=None, stop_event=None, evtlist=None, cleaning=None, stats=None,
+                    headers=None, pool=None):
+        """
+        Yield the events of the entries [start_event, stop_event] (inclusive),
+        or of the entries in evtlist, in increasing entry order.
+
+        :param tels: telescope indices (id - 1) to read
+        :param maskL2: replace the L2 channels by the mean of their neighbors
+        :param cleaning: picture/boundary thresholds, e.g. {'img':5.0,'brd':2.5}, or None
+        :param stats: instrument.RunStats collecting the time of the read stages
+        :param headers: rows of a read_headers array, to read their entries
+                        without a second header pass (e.g. after selecting them)
+        :param pool: buffers.BufferPool whose slots receive the events, None
+                     to decode them into new blocks
+        """
+        raise NotImplementedError
+
+
+def get_entry_list(nentries, start_event=None, stop_event=None, evtlist=None):
+    """
+    Sorted, unique entry numbers to read. stop_event is inclusive.
+    """
+    if evtlist is None:
+        if start_event is None:
+            start_event = 0
+        if stop_event is None:
+            stop_event = nentries - 1
+        stop_event = min(stop_event, nentries - 1)
+        assert (0 <= start_event <= stop_event), "Please specify sensible start_event and stop_event numbers. "
+        return np.arange(start_event, stop_event + 1)
+    evtlist = np.unique(np.asarray(evtlist, dtype=np.int64))
+    if len(evtlist) > 0 and (evtlist[0] < 0 or evtlist[-1] >= nentries):
+        raise ValueError('Entries in evtlist out of range [0, {}).'.format(nentries))
+    return evtlist
+
+
+class SyntheticSource(EventSource):
+    """Seeded generator of VERITAS-like calibrated events.
+
+    Every channel gets Gaussian pedestal noise (pedvar of 4-7 dc); showers
+    are elliptical Gaussian images on the real pixel positions, with a size
+    growing with the (power-law distributed) energy and a peak time gradient
+    along the major axis. Each event is generated from its own seed (seed, entry), so
+    an entry is the same whatever range it is read in.
+
+    Parameters
+    ----------
+    num_events : int
+        Number of entries of the source.
+    seed : int
+        Seed of the generator.
+    trigger_prob : float
+        Probability for each telescope to be triggered.
+    particle_id : int
+        CORSIKA particle id of the simulated primaries (1 for gammas).
+    energy_range : tuple
+        Energy range (TeV) of the E^-spectral_index spectrum.
+    spectral_index : float
+        Spectral index of the energy spectrum.
+    max_core_distance : float
+        Radius (m) of the disk the shower cores are drawn in.
+    run_number : int or None
+        Run number of the events, seed + 1 if None, so that sources of
+        different seeds give different (run number, event number) keys.
+    """
+
+    # digital counts per photo-electron
+    dc_per_pe = 5.
+
+    tel_positions = [(135.48, -8.61, 12.23), (44.1, -124.4, 4.8),
+                     (29.4, 101.9, 8.3), (-207.6, 31.2, -7.4)]
+
+    def __init__(self, num_events, seed=0, trigger_prob=0.6, particle_id=1,
+                 energy_range=(0.1, 100.), spectral_index=2.0, max_core_distance=300.,
+                 run_number=None):
+        self.num_events = num_events
+        self.seed = seed
+        self.trigger_prob = trigger_prob
+        self.particle_id = particle_id
+        self.energy_range = energy_range
+        self.spectral_index = spectral_index
+        self.max_core_distance = max_core_distance
+        self.run_number = seed + 1 if run_number is None else run_number
+        self.pix_pos = np.loadtxt(data_dir + '/pixel_position.txt')
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Build a source from a 'synthetic:NUM_EVENTS[:SEED[:RUN]]' string.
+        """
+        fields = spec[len(SYNTHETIC_PREFIX):].split(':')
+        try:
+            if len(fields) > 3:
+                raise ValueError(spec)
+            num_events = int(fields[0])
+            seed = int(fields[1]) if len(fields) > 1 else 0
+            run_number = int(fields[2]) if len(fields) > 2 else None
+        except (ValueError, IndexError):
+            raise ValueError('Invalid synthetic source: {}.'.format(spec))
+        return cls(num_events, seed=seed, run_number=run_number)
+
+    def get_array_info(self):
+        out = dict()
+        for i, (x, y, z) in enumerate(self.tel_positions):
+            out[i + 1] = {'tel_id': i, 'tel_x': x, 'tel_y': y, 'tel_z': z,
+                          'tel_type': 'VTS', 'run_array_direction': np.array([0, 0])}
+        return out
+
+    def get_num_events(self):
+        return self.num_events
+
+    def _generate_sim(self, rng, entry):
+        e_min, e_max = self.energy_range
+        g = 1. - self.spectral_index
+        u = rng.uniform()
+        if g == 0:
+            energy = e_min * (e_max / e_min) ** u
+        else:
+            energy = (e_min ** g + u * (e_max ** g - e_min ** g)) ** (1. / g)
+        r = self.max_core_distance * np.sqrt(rng.uniform())
+        phi = rng.uniform(0, 2 * np.pi)
+        sim = SimData(self.run_number, entry, self.particle_id,
+                      r * np.cos(phi), r * np.sin(phi), energy * 1000.,
+                      20., rng.uniform(0., 360.))
+        return sim, energy
+
+    def generate_header(self, entry):
+        """
+        :return: (sim data, trigger mask) of an entry, the same as generate_event
+        """
+        rng = np.random.default_rng([self.seed, entry])
+        sim, _ = self._generate_sim(rng, entry)
+        return sim, rng.uniform(size=4) < self.trigger_prob
+
+    def generate_pedvar(self, entry):
+        """
+        :return: pedestal variances (4, 500) of an entry, the snr of
+                 generate_event being charge / pedvar
+        """
+        rng = np.random.default_rng([self.seed, entry])
+        self._generate_sim(rng, entry)
+        rng.uniform(size=4)  # trigger mask
+        return rng.uniform(4., 7., size=(4, 500))
+
+    def generate_event(self, entry, out=None):
+        """
+        :param out: (charge, tzero) arrays of dimension (4, 500) to fill,
+                    None for new arrays
+        :return: (sim data, charge, tzero, snr, triggered tels) of an entry
+        """
+        rng = np.random.default_rng([self.seed, entry])
+        sim, energy = self._generate_sim(rng, entry)
+        # drawn first, so that generate_header does not draw the channels
+        triggered = rng.uniform(size=4) < self.trigger_prob
+        pedvar = rng.uniform(4., 7., size=(4, 500))
+        charge, tzero = out if out is not None else (np.empty((4, 500)), np.empty((4, 500)))
+        # same values as rng.normal(0., 1.) * pedvar and rng.normal(6., 2.)
+        rng.standard_normal(out=charge)
+        charge *= pedvar
+        rng.standard_normal(out=tzero)
+        tzero *= 2.
+        tzero += 6.
+
+        x, y = self.pix_pos[:, 0], self.pix_pos[:, 1]
+        for t in np.flatnonzero(triggered):
+            # image centroid, orientation and Hillas-like width/length (mm)
+            cx, cy = rng.normal(0., 120., size=2)
+            psi = rng.uniform(0, np.pi)
+            width = rng.uniform(20., 45.)
+            length = width * rng.uniform(1.5, 4.)
+            size = 400. * energy * rng.lognormal(0., 0.5)  # photo-electrons
+            du = (x - cx) * np.cos(psi) + (y - cy) * np.sin(psi)
+            dv = -(x - cx) * np.sin(psi) + (y - cy) * np.cos(psi)
+            shower = np.exp(-0.5 * ((du / length) ** 2 + (dv / width) ** 2))
+            shower *= size / shower.sum() if shower.sum() > 0 else 0.
+            charge[t, :499] += self.dc_per_pe * rng.poisson(np.minimum(shower, 1e6))
+            tzero[t, :499] += 0.02 * du * (shower > 1)
+        charge[:, 499] = 0
+        tzero[:, 499] = 0
+        snr = charge / pedvar
+        return sim, charge, tzero, snr, [t + 1 for t in np.flatnonzero(triggered)]
+
+    def read_headers(self, start_event=None, stop_event=None, evtlist=None, stats=None):
+        stats = stats or NO_STATS
+        entries = get_entry_list(self.num_events, start_event, stop_event, evtlist)
+        headers = np.zeros(len(entries), dtype=HEADER_DTYPE)
+        with stats.timer('headers'):
+            for k, entry in enumerate(entries):
+                sim, mask = self.generate_header(int(entry))
+                headers[k]['entry'] = entry
+                headers[k]['triggered'] = mask
+                headers[k]['has_sim'] = True
+                for field in SimData._fields:
+                    headers[k][field] = getattr(sim, field)
+        return headers
+
+    def read_events(self, tels=[0, 1, 2, 3], maskL2=True, l2channels=L2_CHANNELS,
+                    start_event=None, stop_event=None, evtlist=None, cleaning=None, stats=None,
+                    headers=None, pool=None):
+        stats = stats or NO_STATS
+        valid = np.zeros((4, 500), dtype=bool)
+        valid[tels, :499] = True
+        if headers is not None:
+            entries = headers['entry']
+        else:
+            entries = get_entry_list(self.num_events, start_event, stop_event, evtlist)
+        if pool is None:
+            pool = BufferPool()
+        try:
+            for block, start, piece in iter_slots(pool, entries):
+                for j, entry in enumerate(piece, start):
+                    with stats.timer('read'):
+                        sim, charge, tzero, snr, triggered = self.generate_event(
+                            int(entry), out=(block.charge[j], block.tzero[j]))
+                        charge[~valid] = 0
+                        tzero[~valid] = 0
+                    with stats.timer('clean'):
+                        if cleaning is not None:
+                            tailcut_clean(charge, tzero, snr, picture_thresh=cleaning['img'],
+                                          boundary_thresh=cleaning['brd'], valid=valid, inplace=True)
+                        if maskL2:
+                            average_l2_channels(charge, l2channels, tels=tels, inplace=True)
+                    yield sim.fArrayEventNum, sim, charge, tzero, triggered
+        finally:
+            pool.seal()
+
+
+def open_source(filename, backend='python', **kwargs):
+    """
+    Open an event source: a 'synthetic:NUM_EVENTS[:SEED[:RUN]]' string gives a
+    SyntheticSource, anything else is opened as a VEGAS stage 2 file.
+    EventSource instances are returned unchanged.
+
+    :param backend: reader of stage 2 files (see BACKENDS)
+    :param kwargs: options of VARootFile (e.g. threads) or UprootSource,
+                   ignored for the other sources
+    """
+    if isinstance(filename, EventSource):
+        return filename
+    if filename.startswith(SYNTHETIC_PREFIX):
+        return SyntheticSource.from_spec(filename)
+    if backend not in BACKENDS:
+        raise ValueError('Invalid backend: {}.'.format(backend))
+    if backend == 'uproot':
+        from vimgextractor.uproot_io import UprootSource
+        kwargs.pop('threads', None)
+        return UprootSource(filename, **kwargs)
+    from vimgextractor.vegas_io import VARootFile
+    return VARootFile(filename, backend=backend, **kwargs)
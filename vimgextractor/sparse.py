@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Module for zero-suppressed (sparse) image storage.
+
+In the 'sparse' image mode an image table holds, for every image, the
+offset and number of its surviving (non-zero charge) pixels in the CSR-style
+arrays of the group /<table name>_pixels:
+
+    index      : UInt16 pixel index in the 1D image layout
+    charge     : pixel charge
+    peak_times : pixel peak time
+
+The image table keeps the blank row 0 (with no pixels) and the event_index
+column, so Event_Info and its *_indices columns are the same as in the
+dense modes. read_sparse_images densifies rows into the '1D' layout.
+
+Only the charges of the stored pixels are kept: the densified charges are
+those of the '1D' layout, but the peak times of the other pixels (e.g.
+removed by the cleaning, or rejected boundary pixels, whose peak time is
+-1) are not stored. They are densified as MISSING_PEAK_TIME, the marker
+tailcut_clean gives rejected pixels, so densified peak times equal the
+'1D' ones only where the charge is non-zero.
+"""
+
+import numpy as np
+import tables
+
+SPARSE_ARRAYS = ['index', 'charge', 'peak_times']
+
+# peak time of the densified pixels that are not stored
+MISSING_PEAK_TIME = -1.
+
+
+def sparse_group_name(table_name):
+    return table_name + '_pixels'
+
+
+def image_columns():
+    """Columns of a sparse image table."""
+    return {"event_index": tables.Int32Col(pos=0),
+            "pixel_offset": tables.Int64Col(pos=1),
+            "num_pixels": tables.Int32Col(pos=2)}
+
+
+def create_sparse_arrays(h5file, table_name, num_pixels, dtype='float32',
+                         filters=None, expectedrows=None):
+    """
+    Create the group of pixel arrays of a sparse image table.
+
+    :param num_pixels: number of pixels of the dense 1D image
+    :return: tables.Group
+    """
+    group = h5file.create_group(h5file.root, sparse_group_name(table_name),
+                                "Pixels of the {} images".format(table_name))
+    group._v_attrs.num_pixels = num_pixels
+    kwargs = {}
+    if filters is not None:
+        kwargs['filters'] = filters
+    if expectedrows is not None:
+        kwargs['expectedrows'] = expectedrows
+    atoms = {'index': tables.UInt16Atom(),
+             'charge': tables.Atom.from_dtype(np.dtype(dtype)),
+             'peak_times': tables.Atom.from_dtype(np.dtype(dtype))}
+    for name in SPARSE_ARRAYS:
+        h5file.create_earray(group, name, atoms[name], shape=(0,), **kwargs)
+    return group
+
+
+class SparseArrayWriter:
+    """Buffer the surviving pixels of images and append them block by block.
+
+    Parameters
+    ----------
+    group : tables.Group
+        Group created by create_sparse_arrays.
+    block_size : int
+        Number of pixel values gathered before they are written.
+    """
+
+    def __init__(self, group, block_size=1 << 18):
+        self.group = group
+        self.arrays = [group._f_get_child(name) for name in SPARSE_ARRAYS]
+        self.block_size = block_size
+        self._blocks = [[] for _ in SPARSE_ARRAYS]
+        self._n = 0
+
+    @property
+    def nvalues(self):
+        """Number of pixel values in the arrays, including those not yet written."""
+        return self.arrays[0].nrows + self._n
+
+    def append(self, charge, peak_times):
+        """
+        Keep the non-zero charge pixels of a dense image.
+
+        :return: (offset, number of pixels) of the image in the arrays
+        """
+        offset = self.nvalues
+        index = np.flatnonzero(charge)
+        self._blocks[0].append(index.astype(np.uint16))
+        self._blocks[1].append(charge[index])
+        self._blocks[2].append(peak_times[index])
+        self._n += len(index)
+        if self._n >= self.block_size:
+            self.flush()
+        return offset, len(index)
+
+    def flush(self):
+        if self._n > 0:
+            for array, block in zip(self.arrays, self._blocks):
+                array.append(np.concatenate(block))
+                del block[:]
+            self._n = 0
+        for array in self.arrays:
+            array.flush()
+
+    def close(self):
+        self.flush()
+
+
+def read_sparse_images(h5file, table_name, rows, max_gap=4096, missing_peak_time=MISSING_PEAK_TIME):
+    """
+    Densify rows of a sparse image table into the '1D' layout.
+
+    Pixels that are not stored get a charge of 0 and a peak time of
+    missing_peak_time (except in the blank row 0, which is all zeros).
+    The pixel values of the requested rows are read as few contiguous
+    slices: rows are sorted and neighbouring slices closer than max_gap
+    values are coalesced.
+
+    :param h5file: open tables.File
+    :param table_name: name of the image table, e.g. 'VTS' or 'T1'
+    :param rows: image table row numbers (0 is the blank image)
+    :param missing_peak_time: peak time of the pixels that are not stored
+    :return: (charge, peak_times) numpy arrays of dimension (len(rows), num_pixels)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    table = h5file.get_node('/' + table_name)
+    group = h5file.get_node('/' + sparse_group_name(table_name))
+    arrays = [group._f_get_child(name) for name in SPARSE_ARRAYS]
+    num_pixels = group._v_attrs.num_pixels
+
+    charge = np.zeros((len(rows), num_pixels), dtype=arrays[1].dtype)
+    peak_times = np.full((len(rows), num_pixels), missing_peak_time, dtype=arrays[2].dtype)
+    peak_times[rows == 0] = 0
+    if len(rows) == 0:
+        return charge, peak_times
+
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    meta = table.read_coordinates(unique_rows, field=None)
+    offsets = meta['pixel_offset']
+    counts = meta['num_pixels'].astype(np.int64)
+
+    # coalesce the [offset, offset+count) slices of the sorted rows
+    order = np.argsort(offsets, kind='stable')
+    starts, stops = offsets[order], offsets[order] + counts[order]
+    new_span = np.ones(len(order), dtype=bool)
+    new_span[1:] = starts[1:] > np.maximum.accumulate(stops)[:-1] + max_gap
+    span_starts = starts[new_span]
+    span_stops = np.maximum.reduceat(stops, np.flatnonzero(new_span))
+
+    # output positions of each unique row
+    positions = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[positions], np.arange(len(unique_rows) + 1))
+
+    span_members = np.split(order, np.flatnonzero(new_span)[1:])
+    for members, start, stop in zip(span_members, span_starts, span_stops):
+        if stop <= start:
+            continue
+        values = [array.read(start, stop) for array in arrays]
+        for k in members:
+            lo = offsets[k] - start
+            hi = lo + counts[k]
+            dest = positions[bounds[k]:bounds[k + 1]]
+            index = values[0][lo:hi].astype(np.intp)
+            charge[dest[:, None], index] = values[1][lo:hi]
+            peak_times[dest[:, None], index] = values[2][lo:hi]
+    return charge, peak_times
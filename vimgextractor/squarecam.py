@@ -15,7 +15,6 @@ class SquareCam:
         self.pixVals = np.array(pixVals)
         self.buildSquareCamera()
         self.build_oversampled_camera(pic_size)
-        self.pic_size = pic_size
 
     ############################################################################
     #                         Generate the VERITAS camera pixel positions.     #
@@ -117,18 +116,29 @@ class SquareCam:
            y_S = int(round(y-pixel_size/2.))      
            camera.index[0,i,:] = np.array([x_L,x_S,x_S,x_L],dtype='int') 
            camera.index[1,i,:] = np.array([y_L,y_S,y_L,y_S],dtype='int') 
+        camera.pic_size = pic_size
+
+        # Flat scatter table: image.flat[cell_index] = pixVals[pix_index]/4.
+        # Pixels sharing a cell are resolved like the old per-pixel loop,
+        # i.e. the pixel written last wins, so only that entry is kept.
+        flat_index = (camera.index[0] * pic_size + camera.index[1]).ravel()
+        pix_index = np.repeat(np.arange(len(self.pixVals)), 4)
+        _, last = np.unique(flat_index[::-1], return_index=True)
+        keep = np.sort(len(flat_index) - 1 - last)
+        camera.cell_index = flat_index[keep]
+        camera.pix_index = pix_index[keep]
 
     def get_simple_oversampled_image(self):
-        pic_size = self.pic_size
-        image = np.zeros((pic_size, pic_size))
-        index_x = self.index[0]
-        index_y = self.index[1]
-
-        pix     = self.pixVals/4.
-        for x,y,value in zip(index_x,index_y,pix):
-            image[x[0],y[0]] = value
-            image[x[1],y[1]] = value
-            image[x[2],y[2]] = value
-            image[x[3],y[3]] = value
-
-        return image
+        return self.get_oversampled_images(self.pixVals)
+
+    def get_oversampled_images(self, pixVals, dtype='float64'):
+        """
+        :param pixVals: numpy array of dimension (..., npix), e.g. (500, ) or (N, 4, 500)
+        :param dtype: dtype of the returned images
+        :return: images numpy array of dimension (..., pic_size, pic_size)
+        """
+        pixVals = np.asarray(pixVals)
+        lead_shape = pixVals.shape[:-1]
+        image = np.zeros(lead_shape + (self.pic_size * self.pic_size,), dtype=dtype)
+        image[..., self.cell_index] = pixVals[..., self.pix_index] / 4.
+        return image.reshape(lead_shape + (self.pic_size, self.pic_size))
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Module for reading VEGAS stage 2 files with uproot, without ROOT or VEGAS.
+
+UprootSource reads the members of the calibrated event (C) and simulation
+(Sim) branches as columnar awkward arrays, in chunks of entries, and
+decodes, cleans and L2-averages the channel data of a whole chunk at once
+with NumPy, into consecutive slots of vimgextractor.buffers blocks, the
+same way as VARootFile.
+
+The branches are looked up by name (see DEFAULT_BRANCHES and
+DEFAULT_SIM_BRANCHES), so that files with another layout can be read by
+passing other names. The channel fields must read as (entries, telescopes,
+channels) jagged arrays. The default tree and branch names, and the reading
+of the doubly nested fTelEvents[].fChanData[] members, have not been
+verified against real stage 2 files, whose trees hold split
+VACalibratedArrayEvent objects: only fixtures have been read.
+vimgextractor.validation (extractImgValidateUproot) compares the reader with
+the python backend of VARootFile on a real file.
+
+The array information is not read from the file: the nominal VERITAS
+telescope positions are used unless other positions are given.
+
+write_fixture writes small files with this layout (as RNTuples, since
+uproot cannot write nested vectors in TTrees), to test the reader without
+real stage 2 files.
+"""
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from vimgextractor.buffers import BufferPool, iter_slots
+from vimgextractor.cleaning import L2_CHANNELS, tailcut_clean, average_l2_channels
+from vimgextractor.instrument import NO_STATS
+from vimgextractor.simjoin import SIM_FIELDS, SIM_DTYPE, SimJoin, event_keys, cached_join
+from vimgextractor.sources import (EventSource, SyntheticSource, HEADER_DTYPE, NUM_TELS, get_entry_list,
+                                   header_sim_data, triggered_tels)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TREES = {'calib': 'EventsTree', 'sim': 'SimulationEventTree'}
+
+# member -> branch name of the calibrated events
+DEFAULT_BRANCHES = OrderedDict([
+    ('fRunNum', 'C.fRunNum'),
+    ('fArrayEventNum', 'C.fArrayEventNum'),
+    ('fL2TriggeredTels', 'C.fL2TriggeredTels'),
+    ('fChanID', 'C.fTelEvents.fChanData.fChanID'),
+    ('fCharge', 'C.fTelEvents.fChanData.fCharge'),
+    ('fPedVar', 'C.fTelEvents.fChanData.fPedVar'),
+    ('fTZero', 'C.fTelEvents.fChanData.fTZero'),
+])
+
+# member -> branch name of the simulation events
+DEFAULT_SIM_BRANCHES = OrderedDict((field, 'Sim.' + field) for field in SIM_FIELDS)
+
+CHAN_FIELDS = ['fChanID', 'fCharge', 'fPedVar', 'fTZero']
+
+NUM_CHANNELS = 500
+
+
+class UprootSource(EventSource):
+    """VEGAS stage 2 file read with uproot.
+
+    Parameters
+    ----------
+    filename : str
+        Stage 2 file.
+    trees : dict or None
+        Names of the 'calib' and 'sim' trees, defaults to DEFAULT_TREES.
+    branches : dict or None
+        Branch names of the calibrated event members, defaults to DEFAULT_BRANCHES.
+    sim_branches : dict or None
+        Branch names of the simulation members, defaults to DEFAULT_SIM_BRANCHES.
+    sim_cache : bool
+        Save and reuse the simulation join in a sidecar file.
+    chunk_size : int
+        Number of entries read at a time.
+    tel_positions : list or None
+        (x, y, z) positions of the telescopes, defaults to the nominal
+        VERITAS positions.
+    """
+
+    def __init__(self, filename, trees=None, branches=None, sim_branches=None, sim_cache=True,
+                 chunk_size=1000, tel_positions=None):
+        import uproot
+        self.filename = filename
+        self.trees = dict(DEFAULT_TREES, **(trees or {}))
+        self.branches = dict(DEFAULT_BRANCHES, **(branches or {}))
+        self.sim_branches = dict(DEFAULT_SIM_BRANCHES, **(sim_branches or {}))
+        self.sim_cache = sim_cache
+        self.chunk_size = chunk_size
+        self.tel_positions = SyntheticSource.tel_positions if tel_positions is None else tel_positions
+        self.file = uproot.open(filename)
+        self.calib_tree = self.file[self.trees['calib']]
+        self.sim_tree = self.file[self.trees['sim']] if self.trees['sim'] in self.file else None
+
+    def get_array_info(self):
+        out = dict()
+        for i, (x, y, z) in enumerate(self.tel_positions):
+            out[i + 1] = {'tel_id': i, 'tel_x': x, 'tel_y': y, 'tel_z': z,
+                          'tel_type': 'VTS', 'run_array_direction': np.array([0, 0])}
+        return out
+
+    def get_num_events(self):
+        return int(self.calib_tree.num_entries)
+
+    def _read(self, tree, branches, fields, start, stop):
+        """Fields of the entries [start, stop) of a tree, as a dict of awkward arrays."""
+        names = [branches[field] for field in fields]
+        arrays = tree.arrays(names, entry_start=int(start), entry_stop=int(stop), library='ak')
+        return {field: arrays[name] for field, name in zip(fields, names)}
+
+    def _iter_chunks(self, entries):
+        """Split sorted entries into chunks spanning at most chunk_size entries."""
+        if len(entries) == 0:
+            return
+        chunk_ids = (entries - entries[0]) // self.chunk_size
+        splits = np.flatnonzero(np.diff(chunk_ids)) + 1
+        for chunk in np.split(entries, splits):
+            yield chunk
+
+    def _build_join(self):
+        sim = np.zeros(int(self.sim_tree.num_entries), dtype=SIM_DTYPE)
+        columns = self._read(self.sim_tree, self.sim_branches, SIM_FIELDS, 0, len(sim))
+        for field in SIM_FIELDS:
+            sim[field] = np.asarray(columns[field])
+        n = self.get_num_events()
+        columns = self._read(self.calib_tree, self.branches, ['fRunNum', 'fArrayEventNum'], 0, n)
+        calib_keys = event_keys(np.asarray(columns['fRunNum']), np.asarray(columns['fArrayEventNum']))
+        return SimJoin(sim, calib_keys)
+
+    def join_simulation(self):
+        """
+        :return: SimJoin, or None if the file has no simulation tree
+        """
+        if self.sim_tree is None:
+            return None
+        return cached_join(self.filename, self._build_join, self.sim_cache)
+
+    def read_headers(self, start_event=None, stop_event=None, evtlist=None, stats=None):
+        import awkward as ak
+        stats = stats or NO_STATS
+        entries = get_entry_list(self.get_num_events(), start_event, stop_event, evtlist)
+        headers = np.zeros(len(entries), dtype=HEADER_DTYPE)
+        headers['entry'] = entries
+        with stats.timer('headers'):
+            offset = 0
+            for chunk in self._iter_chunks(entries):
+                columns = self._read(self.calib_tree, self.branches,
+                                     ['fRunNum', 'fArrayEventNum', 'fL2TriggeredTels'],
+                                     chunk[0], chunk[-1] + 1)
+                rows = chunk - chunk[0]
+                out = headers[offset:offset + len(chunk)]
+                out['fRunNum'] = np.asarray(columns['fRunNum'])[rows]
+                out['fArrayEventNum'] = np.asarray(columns['fArrayEventNum'])[rows]
+                # same test as VARootFile: the byte of the telescope is 1
+                trigger = ak.fill_none(ak.pad_none(columns['fL2TriggeredTels'], NUM_TELS, clip=True), 0)
+                out['triggered'] = ak.to_numpy(trigger).astype(np.uint8)[rows] == 1
+                offset += len(chunk)
+        with stats.timer('sim_join'):
+            join = self.join_simulation()
+        if join is not None:
+            index = join.calib_index[entries]
+            headers['has_sim'] = index >= 0
+            matched = np.flatnonzero(index >= 0)
+            for field in SIM_FIELDS[2:]:
+                headers[field][matched] = join.sim[field][index[matched]]
+        return headers
+
+    def decode_chunk(self, columns, rows, tels, out=None):
+        """
+        Decode the channel data of a chunk into dense arrays.
+
+        :param columns: dict of CHAN_FIELDS -> (entries, telescopes, channels) awkward arrays
+        :param rows: rows of the chunk to decode
+        :param tels: telescope indices (id - 1) to decode
+        :param out: zeroed (charge, tzero) arrays to decode into, None for new arrays
+        :return: (charge, tzero, snr, valid, decoded) numpy arrays of dimension
+                 (len(rows), 4, 500), and (len(rows), 4) for decoded
+        """
+        import awkward as ak
+        n = len(rows)
+        if out is None:
+            charge = np.zeros((n, NUM_TELS, NUM_CHANNELS))
+            tzero = np.zeros((n, NUM_TELS, NUM_CHANNELS))
+        else:
+            charge, tzero = out
+        snr = np.zeros((n, NUM_TELS, NUM_CHANNELS))
+        valid = np.zeros((n, NUM_TELS, NUM_CHANNELS), dtype=bool)
+
+        chan_id = columns['fChanID'][rows]
+        num_tels = ak.to_numpy(ak.num(chan_id, axis=1))
+        tel_index = np.arange(NUM_TELS)
+        decoded = (tel_index < num_tels[:, None]) & np.isin(tel_index, tels)
+
+        # (event, telescope, channel id) of every channel, in file order
+        counts = ak.num(chan_id, axis=2)
+        event = np.repeat(np.repeat(np.arange(n), num_tels), ak.to_numpy(ak.flatten(counts)))
+        tel = np.repeat(ak.to_numpy(ak.flatten(ak.local_index(counts, axis=1))), ak.to_numpy(ak.flatten(counts)))
+        flat = {field: ak.to_numpy(ak.flatten(columns[field][rows], axis=None)) for field in CHAN_FIELDS}
+        chan = flat['fChanID'].astype(np.int64)
+        keep = (tel < NUM_TELS) & (chan >= 0) & (chan < NUM_CHANNELS)
+        keep[keep] = decoded[event[keep], tel[keep]]
+        event, tel, chan = event[keep], tel[keep], chan[keep]
+        values = flat['fCharge'][keep].astype(np.float64)
+        charge[event, tel, chan] = values
+        tzero[event, tel, chan] = flat['fTZero'][keep]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snr[event, tel, chan] = values / flat['fPedVar'][keep].astype(np.float64)
+        valid[event, tel, chan] = True
+        return charge, tzero, snr, valid, decoded
+
+    def read_events(self, tels=[0, 1, 2, 3], maskL2=True, l2channels=L2_CHANNELS,
+                    start_event=None, stop_event=None, evtlist=None, cleaning=None, stats=None,
+                    headers=None, pool=None):
+        stats = stats or NO_STATS
+        if headers is None:
+            entries = get_entry_list(self.get_num_events(), start_event, stop_event, evtlist)
+            headers = self.read_headers(evtlist=entries, stats=stats)
+        entries = headers['entry']
+        evtNumbers = headers['fArrayEventNum'].tolist()
+        k = 0
+        try:
+            for chunk in self._iter_chunks(entries):
+                with stats.timer('read'):
+                    columns = self._read(self.calib_tree, self.branches, CHAN_FIELDS, chunk[0], chunk[-1] + 1)
+                chunk_pool = pool if pool is not None else BufferPool(block_size=len(chunk))
+                for block, start, piece in iter_slots(chunk_pool, chunk):
+                    stop = start + len(piece)
+                    with stats.timer('decode'):
+                        charge, tzero, snr, valid, decoded = self.decode_chunk(
+                            columns, piece - chunk[0], tels, out=(block.charge[start:stop], block.tzero[start:stop]))
+                    with stats.timer('clean'):
+                        if cleaning is not None:
+                            tailcut_clean(charge, tzero, snr, picture_thresh=cleaning['img'],
+                                          boundary_thresh=cleaning['brd'], valid=valid, inplace=True)
+                        if maskL2:
+                            np.copyto(charge, average_l2_channels(charge, l2channels), where=decoded[:, :, None])
+                    for j in range(start, stop):
+                        yield evtNumbers[k], header_sim_data(headers[k]), block.charge[j], block.tzero[j], \
+                            triggered_tels(headers['triggered'][k])
+                        k += 1
+        finally:
+            if pool is not None:
+                pool.seal()
+
+
+def write_fixture(path, calib, sim=None, trees=None, branches=None, sim_branches=None):
+    """
+    Write a small stage 2 like file readable by UprootSource.
+
+    :param calib: dict of calibrated event member (see DEFAULT_BRANCHES) ->
+                  array-like with one item per entry; the channel fields are
+                  nested lists (entries, telescopes, channels)
+    :param sim: dict of simulation member (see DEFAULT_SIM_BRANCHES) -> array, or None
+    """
+    import awkward as ak
+    import uproot
+    trees = dict(DEFAULT_TREES, **(trees or {}))
+    branches = dict(DEFAULT_BRANCHES, **(branches or {}))
+    sim_branches = dict(DEFAULT_SIM_BRANCHES, **(sim_branches or {}))
+    with uproot.recreate(path) as f:
+        f[trees['calib']] = {branches[field]: ak.Array(values) for field, values in calib.items()}
+        if sim is not None:
+            f[trees['sim']] = {sim_branches[field]: np.asarray(values) for field, values in sim.items()}
+
+
+def write_synthetic_fixture(path, source, entries=None, **kwargs):
+    """
+    Write the raw (not cleaned nor L2-averaged) events of a SyntheticSource,
+    with their simulation data, as a fixture with the channels 0-498 of
+    every telescope, to compare UprootSource with the source (see
+    vimgextractor.validation).
+
+    :param entries: entries of the source to write, all of them if None
+    :param kwargs: trees, branches and sim_branches of write_fixture
+    """
+    entries = np.arange(source.num_events) if entries is None else entries
+    calib = OrderedDict((field, []) for field in DEFAULT_BRANCHES)
+    sim = OrderedDict((field, []) for field in SIM_FIELDS)
+    channels = np.arange(NUM_CHANNELS - 1)
+    for entry in entries:
+        sim_data, charge, tzero, _, triggered = source.generate_event(int(entry))
+        pedvar = source.generate_pedvar(int(entry))
+        calib['fRunNum'].append(sim_data.fRunNum)
+        calib['fArrayEventNum'].append(sim_data.fArrayEventNum)
+        calib['fL2TriggeredTels'].append([int(telID + 1 in triggered) for telID in range(NUM_TELS)])
+        calib['fChanID'].append([channels] * NUM_TELS)
+        calib['fCharge'].append(charge[:, channels])
+        calib['fPedVar'].append(pedvar[:, channels])
+        calib['fTZero'].append(tzero[:, channels])
+        for field in SIM_FIELDS:
+            sim[field].append(getattr(sim_data, field))
+    write_fixture(path, calib, sim, **kwargs)
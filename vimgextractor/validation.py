@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Module for checking that two event sources read the same events.
+
+compare_sources reads the same entries from a source and a reference
+source (e.g. UprootSource and VARootFile on the same stage 2 file) with
+the read options of VALIDATION_READS, and compares their headers and
+events: event numbers, simulation data, triggered telescopes, and the
+charge and tzero arrays, which must be identical. validate_file compares
+the uproot or rdf backend with the python backend of VARootFile on a stage
+2 file, which needs ROOT and VEGAS.
+
+Without a stage 2 file, validate_uproot_fixture writes the events of a
+SyntheticSource into a fixture file (see uproot_io.write_synthetic_fixture)
+and compares UprootSource on the fixture with the SyntheticSource.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from vimgextractor.simjoin import SIM_DTYPE
+from vimgextractor.sources import HEADER_DTYPE
+
+# read_events options of the comparisons
+VALIDATION_READS = [
+    {'cleaning': None},
+    {'cleaning': {'img': 5.0, 'brd': 2.5}},
+    {'cleaning': {'img': 4.0, 'brd': 2.0}, 'tels': [0, 2]},
+    {'cleaning': None, 'maskL2': False},
+]
+
+
+def _sim_record(sim):
+    return None if sim is None else np.array(tuple(sim), dtype=SIM_DTYPE)
+
+
+def compare_headers(headers, reference):
+    """
+    :return: names of the HEADER_DTYPE fields that differ, 'entries' if
+             the headers are not of the same entries
+    """
+    if len(headers) != len(reference) or not np.array_equal(headers['entry'], reference['entry']):
+        return ['entries']
+    return [name for name in HEADER_DTYPE.names if not np.array_equal(headers[name], reference[name])]
+
+
+def compare_events(events, reference):
+    """
+    Compare two sequences of read_events tuples, event by event.
+
+    :return: dict of the number of events compared ('events'), of events
+             missing in either sequence ('missing') and of events whose
+             'event_number', 'sim', 'triggered', 'charge' or 'tzero' differ,
+             with the largest charge and tzero differences
+    """
+    out = dict(events=0, missing=0, event_number=0, sim=0, triggered=0, charge=0, tzero=0,
+               max_charge_diff=0., max_tzero_diff=0.)
+    events, reference = iter(events), iter(reference)
+    while True:
+        event, ref = next(events, None), next(reference, None)
+        if event is None and ref is None:
+            return out
+        if event is None or ref is None:
+            out['missing'] += 1 + sum(1 for _ in (reference if event is None else events))
+            return out
+        out['events'] += 1
+        out['event_number'] += int(event[0] != ref[0])
+        sim, ref_sim = _sim_record(event[1]), _sim_record(ref[1])
+        out['sim'] += int((sim is None) != (ref_sim is None) or (sim is not None and sim != ref_sim))
+        out['triggered'] += int(list(event[4]) != list(ref[4]))
+        for name, k in [('charge', 2), ('tzero', 3)]:
+            if not np.array_equal(event[k], ref[k]):
+                out[name] += 1
+                key = 'max_{}_diff'.format(name)
+                out[key] = max(out[key], float(np.nanmax(np.abs(event[k] - ref[k]))))
+
+
+def compare_sources(source, reference, start_event=None, stop_event=None, reads=VALIDATION_READS):
+    """
+    Compare the headers and events of the entries [start_event, stop_event]
+    (inclusive) of two sources.
+
+    :return: (header fields that differ, list of (read options, compare_events result))
+    """
+    header_diff = compare_headers(source.read_headers(start_event, stop_event),
+                                  reference.read_headers(start_event, stop_event))
+    results = []
+    for options in reads:
+        results.append((options, compare_events(
+            source.read_events(start_event=start_event, stop_event=stop_event, **options),
+            reference.read_events(start_event=start_event, stop_event=stop_event, **options))))
+    return header_diff, results
+
+
+def is_identical(header_diff, results):
+    """Whether a compare_sources result has no difference."""
+    return not header_diff and all(
+        r[name] == 0 for _, r in results for name in ['missing', 'event_number', 'sim', 'triggered', 'charge', 'tzero'])
+
+
+def validate_file(filename, backend='uproot', start_event=None, stop_event=None, chunk_size=64):
+    """
+    Compare a backend with the python backend of VARootFile on the entries
+    [start_event, stop_event] (inclusive) of a stage 2 file.
+
+    :param backend: 'uproot' (UprootSource) or 'rdf' (RDataFrame backend of VARootFile)
+    :param chunk_size: entries read at a time by the uproot reader
+    :return: compare_sources result
+    """
+    from vimgextractor.vegas_io import VARootFile
+    if backend == 'uproot':
+        from vimgextractor.uproot_io import UprootSource
+        source = UprootSource(filename, sim_cache=False, chunk_size=chunk_size)
+    elif backend == 'rdf':
+        source = VARootFile(filename, sim_cache=False, backend='rdf')
+    else:
+        raise ValueError('Invalid backend: {}.'.format(backend))
+    reference = VARootFile(filename, sim_cache=False)
+    return compare_sources(source, reference, start_event, stop_event)
+
+
+def validate_uproot_fixture(num_events=200, seed=0, chunk_size=64, path=None):
+    """
+    Compare UprootSource on a fixture written from a SyntheticSource with
+    the SyntheticSource itself.
+
+    :param path: fixture file, a temporary file if None
+    :return: compare_sources result
+    """
+    from vimgextractor.sources import SyntheticSource
+    from vimgextractor.uproot_io import UprootSource, write_synthetic_fixture
+    reference = SyntheticSource(num_events, seed=seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = path or os.path.join(tmp, 'fixture.root')
+        write_synthetic_fixture(path, reference)
+        source = UprootSource(path, sim_cache=False, chunk_size=chunk_size)
+        try:
+            return compare_sources(source, reference)
+        finally:
+            source.file.close()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Module for block-buffered writing of PyTables tables.
+
+Rows are gathered into a fixed-size NumPy structured array and written
+with a single Table.append per block, instead of one Row.append (and
+flush) per image.
+"""
+
+import numpy as np
+
+
+class BlockWriter:
+    """Buffer rows for a PyTables table and append them block by block.
+
+    Parameters
+    ----------
+    table : tables.Table
+        Destination table. The block dtype is taken from the table.
+    block_size : int
+        Number of rows gathered before they are written to the table.
+    """
+
+    def __init__(self, table, block_size=1024):
+        if block_size < 1:
+            raise ValueError('Invalid block size: {}.'.format(block_size))
+        self.table = table
+        self.block_size = block_size
+        self._block = np.zeros(block_size, dtype=table.dtype)
+        self._blank = np.zeros(1, dtype=table.dtype)[0]
+        self._n = 0
+
+    @property
+    def nrows(self):
+        """Number of rows in the table, including rows not yet written."""
+        return self.table.nrows + self._n
+
+    def row(self):
+        """Return a zeroed record for the next row.
+
+        The record is a view into the block buffer: fill its fields and
+        call append() to commit it.
+        """
+        self._block[self._n] = self._blank
+        return self._block[self._n]
+
+    def append(self):
+        """Commit the record returned by the last call to row()."""
+        self._n += 1
+        if self._n == self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the table."""
+        if self._n > 0:
+            self.table.append(self._block[:self._n])
+            self._n = 0
+        self.table.flush()
+
+    def close(self):
+        self.flush()